@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+'''
+	all spyserver instances supervised from one asyncio event loop
+
+	every spyserver runs as asyncio subprocess with stdout on a pty
+	(so its output is line buffered, same as with pexpect),
+	lines are parsed by SpyServerMonitor.LineHandler and events are appended
+	to per instance journal (same files as threads mode, so switching modes keeps pending events).
+	Journal writes (and fsync) run on a single writer thread, so they never block the loop.
+	Journals are shipped to DB by one coroutine per instance, HTTP requests
+	go through one shared urllib3 keep-alive pool on a single worker thread.
+
+	./AsyncMonitor.py ./user.ini
+'''
+
+import os
+import sys
+import pty
+import signal
+import asyncio
+import concurrent.futures
+from pprint import pprint
+
+from cfg import cfg
+import Logger
+import Metrics
+from EventSpool import EventSpool
+from SpyServerMonitor import SpyServerMonitor, JOURNALS
+
+
+class AsyncSpyServers():
+	def __init__(self, spyserver_path, config_files, http_addr_pair, no_lan_skip = False,
+					spool_dir = './spool', spool_batch = 100, spool_fsync = False,
+					retry_interval = 5.0, http_timeout = 10.0, stop_timeout = 10.0, restart_options = None):
+		self.__ss = spyserver_path
+		self.__spool_batch = spool_batch
+		self.__retry_interval = retry_interval
+		self.__stop_timeout = stop_timeout
+
+		# one thread for blocking HTTP, SpyServerMonitor.SendEvents uses module wide urllib3 PoolManager
+		self.__http_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'AsyncMonitorHTTP')
+		# one thread for journal writes, single worker keeps order of events
+		self.__spool_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'AsyncMonitorSpool')
+
+		self.__instances = [] # (config_file, monitor, spool)
+		for config_file in config_files:
+			spool = EventSpool( os.path.join(spool_dir, os.path.basename(config_file) + '.journal'), fsync = spool_fsync,
+								source = os.path.basename(config_file) )
+			monitor = SpyServerMonitor(	spyserver_path, config_file, http_addr_pair, no_lan_skip = no_lan_skip,
+										http_timeout = http_timeout, event_sink = self.__sink(config_file, spool),
+										restart_options = restart_options )
+			self.__instances.append( (config_file, monitor, spool) )
+			JOURNALS[monitor.Id()] = spool
+
+		self.__procs = {} # instance id -> asyncio.subprocess.Process
+		self.__stats = { m.Id(): {'lines': 0, 'sent': 0, 'failures': 0} for c, m, s in self.__instances }
+		self.__stop = None
+		self.__spooled = None # set when last events of stopped instances are in journals
+		self.__logger = Logger.Get()
+
+
+	def __sink(self, config_file, spool):
+		'''
+		event_sink of one instance, called on event loop - append is done on spool writer thread
+		'''
+		iid = os.path.basename(config_file)
+		def _append(event):
+			try:
+				spool.Append(event)
+			except:
+				self.__logger.Exception(iid, "Journal write failed")
+		return lambda event: self.__spool_executor.submit(_append, event)
+
+
+	def Stats(self):
+		res = {}
+		for config_file, monitor, spool in self.__instances:
+			res[monitor.Id()] = dict( self.__stats[monitor.Id()], pending = len(spool), process = monitor.restarts.Stats() )
+		return res
+
+
+	async def __spawn(self, monitor, config_file):
+		master_fd, slave_fd = pty.openpty()
+		try:
+			proc = await asyncio.create_subprocess_exec(	self.__ss, config_file,
+															stdin = asyncio.subprocess.DEVNULL,
+															stdout = slave_fd, stderr = slave_fd,
+															start_new_session = True )
+		finally:
+			os.close(slave_fd)
+		self.__procs[monitor.Id()] = proc
+		return proc, master_fd
+
+
+	async def __read(self, monitor, master_fd):
+		loop = asyncio.get_running_loop()
+		reader = asyncio.StreamReader()
+		transport, _ = await loop.connect_read_pipe(	lambda: asyncio.StreamReaderProtocol(reader),
+														os.fdopen(master_fd, 'rb', 0) )
+		stats = self.__stats[monitor.Id()]
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+				except OSError:
+					break # EIO - pty closed, child is gone
+				except ValueError:
+					continue # line over StreamReader limit, rest is dropped
+				if not line:
+					break
+				stats['lines'] += 1
+				monitor.restarts.Up()
+				try:
+					monitor.LineHandler(line)
+				except:
+					self.__logger.Exception(monitor.Id(), "Line handler failed")
+		finally:
+			transport.close()
+
+
+	async def __run_instance(self, monitor, config_file):
+		'''
+		run spyserver, restart it with backoff until stopped
+		'''
+		while not self.__stop.is_set():
+			monitor.restarts.Started()
+			rc = None
+			try:
+				proc, master_fd = await self.__spawn(monitor, config_file)
+				await self.__read(monitor, master_fd)
+				rc = await proc.wait()
+			except:
+				self.__logger.Exception(monitor.Id(), "spyserver failed")
+
+			if self.__stop.is_set():
+				monitor.restarts.Stopped()
+				monitor.CloseOpenConnections()
+				break
+			try:
+				await asyncio.wait_for( self.__stop.wait(), monitor.Exited(rc) )
+			except asyncio.TimeoutError:
+				pass
+
+
+	async def __ship(self, monitor, spool):
+		'''
+		send journaled events of one instance, until stopped and journal is empty
+		'''
+		loop = asyncio.get_running_loop()
+		stats = self.__stats[monitor.Id()]
+		while True:
+			if not len(spool):
+				if self.__spooled.is_set():
+					return
+				await asyncio.sleep(0.2)
+				continue
+
+			events = spool.Pending(self.__spool_batch)
+			try:
+				await loop.run_in_executor(self.__http_executor, monitor.SendEvents, events)
+			except:
+				stats['failures'] += 1
+				self.__logger.Exception(monitor.Id(), "Sending ", len(events), " events failed, ", len(spool), " pending")
+				if self.__stop.is_set():
+					return
+				try:
+					await asyncio.wait_for(self.__stop.wait(), self.__retry_interval)
+				except asyncio.TimeoutError:
+					pass
+				continue
+
+			spool.Ack(len(events))
+			stats['sent'] += len(events)
+
+
+	async def __terminate(self):
+		for iid, proc in self.__procs.items():
+			if proc.returncode is None:
+				self.__logger.Info(iid, "Sending Ctrl+C to spyserver")
+				try:
+					proc.send_signal(signal.SIGINT)
+				except ProcessLookupError:
+					pass
+
+		for iid, proc in self.__procs.items():
+			try:
+				await asyncio.wait_for(proc.wait(), self.__stop_timeout)
+			except asyncio.TimeoutError:
+				self.__logger.Warning(iid, "spyserver did not stop, killing it")
+				proc.kill()
+				await proc.wait()
+
+
+	async def Run(self):
+		'''
+		run until SIGINT / SIGTERM
+		'''
+		loop = asyncio.get_running_loop()
+		self.__stop = asyncio.Event()
+		self.__spooled = asyncio.Event()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, self.__stop.set)
+
+		shippers = [ asyncio.ensure_future( self.__ship(m, s) ) for c, m, s in self.__instances ]
+		readers = [ asyncio.ensure_future( self.__run_instance(m, c) ) for c, m, s in self.__instances ]
+
+		await self.__stop.wait()
+
+		await self.__terminate()
+		await asyncio.gather(*readers, return_exceptions = True)
+		# wait for queued journal writes (ie. closes of sessions left open)
+		await loop.run_in_executor(self.__spool_executor, lambda: None)
+		self.__spooled.set()
+		# shippers return when their journal is empty or first send fails
+		await asyncio.gather(*shippers, return_exceptions = True)
+
+		for config_file, monitor, spool in self.__instances:
+			spool.Close()
+		self.__spool_executor.shutdown()
+		self.__http_executor.shutdown()
+
+
+def Run(spyserver_path, config_files, http_addr_pair, **kwargs):
+	servers = AsyncSpyServers(spyserver_path, config_files, http_addr_pair, **kwargs)
+	asyncio.run( servers.Run() )
+	return servers
+
+
+def main():
+	config_file = './user.ini'
+	if len(sys.argv) > 1:
+		config_file = sys.argv[1]
+	cfg(config_file)
+	pprint(cfg())
+	print("\n")
+
+	Logger.Setup( **cfg()['LOG'] )
+
+	if cfg()['MONITOR']['metrics_port']:
+		Metrics.Serve( cfg()['MONITOR']['metrics_host'], cfg()['MONITOR']['metrics_port'] )
+
+	Run(	cfg()['SPYSERVER']['exe'], cfg()['SPYSERVER']['cfg_list'],
+			[cfg()['DB']['ip'], cfg()['DB']['port']],
+			no_lan_skip = not cfg()['MONITOR']['ignore_local_connections'],
+			spool_dir = cfg()['MONITOR']['spool_dir'],
+			spool_batch = cfg()['MONITOR']['spool_batch'],
+			spool_fsync = cfg()['MONITOR']['spool_fsync'],
+			retry_interval = cfg()['MONITOR']['retry_interval'],
+			http_timeout = cfg()['MONITOR']['http_timeout'],
+			restart_options = cfg()['MONITOR']['restart'] )
+	Logger.Get().Stop()
+
+
+if __name__ == "__main__":
+	main()
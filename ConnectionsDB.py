@@ -2,6 +2,11 @@
 
 import string
 import os
+import time
+import atexit
+import queue
+import itertools
+import contextlib
 import datetime
 import sqlite3
 import threading
@@ -12,6 +17,8 @@ import inspect
 from sqlite3 import Error as sqerr
 from pprint import pprint, pformat
 
+import Metrics
+
 
 class JSONEncoder(json.JSONEncoder):
 	def default(self, o):
@@ -75,17 +82,125 @@ class Connection:
 			return JSONEncoder().encode(self.C)
 
 
+class ActiveConnections():
+	'''
+	registry of opened connections
+	keyed by (ip, port, server_instance) and indexed by server_instance
+	'''
+	def __init__(self):
+		self.__mutex = threading.Lock()
+		self.__all = {} # key -> Connection
+		self.__per_srv_instance = {} # server_instance -> {key -> Connection}
+
+	@staticmethod
+	def Key(c):
+		return (c['ip'], c['port'], c['server_instance'])
+
+	def Add(self, c):
+		'''
+		return False if connection was already registered
+		'''
+		key = self.Key(c)
+		with self.__mutex:
+			is_new = key not in self.__all
+			self.__all[key] = c
+			self.__per_srv_instance.setdefault(c['server_instance'], {})[key] = c
+			return is_new
+
+	def Remove(self, c):
+		'''
+		return removed connection or None
+		'''
+		key = self.Key(c)
+		with self.__mutex:
+			res = self.__all.pop(key, None)
+			if c['server_instance'] in self.__per_srv_instance:
+				self.__per_srv_instance[ c['server_instance'] ].pop(key, None)
+			return res
+
+	def __len__(self):
+		return len(self.__all)
+
+	def __contains__(self, c):
+		return self.Key(c) in self.__all
+
+	def Counts(self):
+		'''
+		{'TOTAL': count, 'COUNT': {server_instance: count}}
+		'''
+		with self.__mutex:
+			return {
+				'TOTAL': len(self.__all),
+				'COUNT': { srv_inst: len(conns) for srv_inst, conns in self.__per_srv_instance.items() }
+			}
+
+	def Get(self):
+		'''
+		{
+			'TOTAL': count,
+			'COUNT': {server_instance: count},
+			'SERVER': {server_instance: [connections]}
+		}
+		'''
+		with self.__mutex:
+			res = {}
+			res['TOTAL'] = len(self.__all)
+			res['COUNT'] = {}
+			res['SERVER'] = {}
+			for srv_inst, conns in self.__per_srv_instance.items():
+				res['COUNT'][srv_inst] = len(conns)
+				res['SERVER'][srv_inst] = list( conns.values() )
+			return res
+
+
+# writer thread batch: statements execute + commit
+SQLITE_COMMIT = Metrics.Histogram('ssmon_sqlite_commit_seconds', 'SQLite writer batch execute and commit time')
+SQLITE_BATCH = Metrics.Histogram(	'ssmon_sqlite_commit_statements', 'statements per SQLite commit',
+									buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) )
+
+
 class ConnectionsDB():
 	'''
 	store connections in sqlite DB
+
+	All writes (open/close/geolocation update) are queued
+	and executed by a single writer thread, which commits them in batches
+	of up to batch_size statements or every flush_interval seconds.
+	DB is in WAL mode, so reads are not blocked by writer.
+	Every reading thread gets its own connection, so reads from
+	concurrent HTTP requests run in parallel.
+	synchronous - sqlite PRAGMA synchronous: OFF, NORMAL or FULL
 	'''
-	def __init__(self, sqldb_file):
-		self.__sqldb = None
+	def __init__(self, sqldb_file, batch_size = 100, flush_interval = 0.2, synchronous = 'NORMAL'):
+		self.__sqldb = None # writer connection, used only by writer thread after init
 		self.__sqldb_file = sqldb_file
-		self.__mutex = threading.Lock()
+		self.__local = threading.local() # per thread read connection
+		self.__batch_size = batch_size
+		self.__flush_interval = flush_interval
+		self.__synchronous = synchronous
+		self.__write_queue = queue.Queue()
+		self.__commits = 0
+		self.__writes = 0
+		self.__failures = 0 # failed batches
+		self.__failed = False # batch failed since last flush request
+		# every queued write gets next sequence number, writer stores number of last
+		# written one in writer_state with each batch, so readers know which writes
+		# their snapshot contains (live events carry number of their write)
+		self.__seq_lock = threading.Lock()
+		self.__queued_seq = 0
+		self.__written_seq = 0
+		# data version, bumped on every change visible to readers
+		self.__version_counter = itertools.count(1)
+		self.__version = 0
 		self.__initSQLDB()
-		self.__active_connections = [] # opened connections
-		self.__active_connections_per_srv_instance = {} # opened connections per server_instance
+		self.__active_connections = ActiveConnections()
+
+		self.__writer_thread = threading.Thread(target = self.__writer__, name = 'ConnectionsDB-writer')
+		self.__writer_thread.daemon = True
+		self.__writer_thread.start()
+		# queued writes are acknowledged to callers already,
+		# commit them on interpreter exit (Close() is also called by owners on shutdown)
+		atexit.register(self.Close)
 
 	def __initSQLDB(self):
 		if self.__sqldb:
@@ -94,111 +209,422 @@ class ConnectionsDB():
 						self.__sqldb_file,
 						check_same_thread=False,
 						detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES )
-		self.__createConnectionsTable()
-
-	def __createConnectionsTable(self):
-		_tb_cr = "CREATE TABLE IF NOT EXISTS connections ("
-		_tb_cr += "	ip text,"
-		_tb_cr += "	port text,"
-		_tb_cr += "	server_instance text,"
-		_tb_cr += "	sdr_version text,"
-		_tb_cr += "	os text,"
-		_tb_cr += "	start timestamp,"
-		_tb_cr += "	end timestamp,"
-		_tb_cr += "	duration real,"
-		_tb_cr += "	lat real,"
-		_tb_cr += "	lon real,"
-		_tb_cr += "	country text,"
-		_tb_cr += "	city text,"
-		_tb_cr += " PRIMARY KEY(ip, port, server_instance, start)"
-		_tb_cr += ");"
+		self.__sqldb.execute('PRAGMA journal_mode=WAL')
+		self.__sqldb.execute('PRAGMA synchronous={}'.format(self.__synchronous))
+		self.__migrate()
+		self.__queued_seq = self.__written_seq = \
+			self.__sqldb.execute('SELECT seq FROM writer_state').fetchone()[0]
+
+	@contextlib.contextmanager
+	def __reader(self):
+		'''
+		read connection of calling thread
+		'''
+		db = getattr(self.__local, 'db', None)
+		if db is None:
+			db = sqlite3.connect(
+						self.__sqldb_file,
+						detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES )
+			# IPs are exposed as hash(ip), this lets clients filter by that hash
+			db.create_function('py_hash', 1, hash, deterministic=True)
+			self.__local.db = db
+		yield db
 
+	@contextlib.contextmanager
+	def __snapshot(self):
+		'''
+		cursor of read transaction, all queries see the same committed state
+		'''
+		with self.__reader() as db:
+			cur = db.cursor()
+			cur.execute('BEGIN')
+			try:
+				yield cur
+			finally:
+				db.rollback()
+
+	def __write(self, sql, data):
+		'''
+		queue write for writer thread, return its sequence number
+		sql can be a list of statements (without parameters), committed together
+		'''
+		with self.__seq_lock:
+			self.__queued_seq += 1
+			self.__write_queue.put( (sql, data) )
+			return self.__queued_seq
+
+	def __writer__(self):
+		while True:
+			# wait for first write, then collect more
+			# until batch is full or flush_interval passes
+			batch = [ self.__write_queue.get() ]
+			deadline = time.time() + self.__flush_interval
+			while len(batch) < self.__batch_size and batch[-1][0]:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					batch.append( self.__write_queue.get(timeout = timeout) )
+				except queue.Empty:
+					break
+
+			if not self.__commitBatch(batch):
+				self.__failures += 1
+				self.__failed = True
+
+			# (None, event) is flush request, (None, None) stops writer
+			for sql, data in batch:
+				if sql is None and data is None:
+					return
+				if sql is None:
+					data.ok = not self.__failed
+					self.__failed = False
+					data.set()
+
+	def __commitBatch(self, batch):
+		'''
+		return False when any write or commit failed
+		'''
+		ok = True
+		_t = time.perf_counter()
+		cur = self.__sqldb.cursor()
+		for sql, data in batch:
+			if sql is None:
+				continue
+			self.__written_seq += 1
+			try:
+				if isinstance(sql, list):
+					for st in sql:
+						cur.execute(st)
+				else:
+					cur.execute(sql, data)
+				self.__writes += 1
+			except sqlite3.IntegrityError:
+				print(inspect.currentframe().f_lineno)
+				print("already inserted")
+			except sqerr as e:
+				ok = False
+				print(inspect.currentframe().f_lineno)
+				print(e)
+			except:
+				ok = False
+				print(inspect.currentframe().f_lineno)
+				print(traceback.format_exc())
 		try:
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
-				cur.execute(_tb_cr)
-				self.__sqldb.commit()
+			cur.execute('UPDATE writer_state SET seq = ?', (self.__written_seq,))
+			self.__sqldb.commit()
+			self.__commits += 1
+			self.__version = next(self.__version_counter)
 		except sqerr as e:
+			ok = False
 			print(inspect.currentframe().f_lineno)
 			print(e)
-			print(traceback.format_exc())
-		except:
+			try:
+				# do not leave failed batch open, it would be committed with next one
+				self.__sqldb.rollback()
+			except sqerr:
+				pass
+		SQLITE_COMMIT.Observe( time.perf_counter() - _t )
+		SQLITE_BATCH.Observe( sum(1 for sql, data in batch if sql is not None) )
+		return ok
+
+	def Flush(self, timeout = None):
+		'''
+		wait until all queued writes are committed
+		return False on timeout, or when a write queued before failed
+		'''
+		ev = threading.Event()
+		ev.ok = False
+		self.__write_queue.put( (None, ev) )
+		return ev.wait(timeout) and ev.ok
+
+	def Close(self):
+		'''
+		commit queued writes and stop writer thread
+		'''
+		if self.__writer_thread.is_alive():
+			self.__write_queue.put( (None, None) )
+			self.__writer_thread.join()
+		atexit.unregister(self.Close)
+
+	def File(self):
+		return self.__sqldb_file
+
+	def DataVersion(self):
+		'''
+		changes whenever committed data or active connections change
+		'''
+		return self.__version
+
+	def WriterStats(self):
+		return {
+			'queued': self.__write_queue.qsize(),
+			'writes': self.__writes,
+			'commits': self.__commits,
+			'failures': self.__failures,
+			'batch_size': self.__batch_size,
+			'flush_interval': self.__flush_interval
+		}
+
+	# recompute aggregate tables from connections
+	REBUILD_AGGREGATES = [
+		'DELETE FROM agg_counts',
+	] + [
+		'''INSERT INTO agg_counts
+			SELECT '{0}', {0}, COUNT({0}) FROM connections
+			WHERE {0} IS NOT NULL GROUP BY {0}'''.format(k)
+		for k in ['server_instance', 'country', 'city', 'ip']
+	] + [
+		'DELETE FROM agg_stats',
+		'''INSERT INTO agg_stats
+			SELECT 0, COUNT(*), IFNULL(SUM(duration), 0), COUNT(duration), MAX(duration)
+			FROM connections''',
+	]
+
+	# recompute map points (agg_locations) from connections
+	REBUILD_LOCATIONS = [
+		'DELETE FROM agg_locations',
+		'''INSERT INTO agg_locations
+			SELECT lat, lon, country, city, COUNT(*) FROM connections
+			WHERE lat IS NOT NULL AND lon IS NOT NULL GROUP BY lat, lon''',
+	]
+
+	# schema migrations
+	# (version, [statements]) applied in order to DB with lower PRAGMA user_version
+	# each migration runs in one transaction, together with user_version bump
+	# never edit released migration, add new one
+	MIGRATIONS = [
+		(1, [
+			'''CREATE TABLE IF NOT EXISTS connections (
+				ip text,
+				port text,
+				server_instance text,
+				sdr_version text,
+				os text,
+				start timestamp,
+				end timestamp,
+				duration real,
+				lat real,
+				lon real,
+				country text,
+				city text,
+				PRIMARY KEY(ip, port, server_instance, start)
+			)'''
+		]),
+		(2, [
+			# GROUP BY in GetConnectionCounts/GetConnectionStats
+			# ip is covered by primary key
+			'CREATE INDEX IF NOT EXISTS idx_connections_server_instance ON connections(server_instance)',
+			'CREATE INDEX IF NOT EXISTS idx_connections_country ON connections(country)',
+			'CREATE INDEX IF NOT EXISTS idx_connections_city ON connections(city)',
+			# longest connection
+			'CREATE INDEX IF NOT EXISTS idx_connections_duration ON connections(duration)',
+		]),
+		(3, [
+			# aggregates for GetConnectionCounts/GetConnectionStats,
+			# kept up to date by triggers, in the same transaction as each write
+			'''CREATE TABLE IF NOT EXISTS agg_counts (
+				key text,
+				value text,
+				count integer,
+				PRIMARY KEY(key, value)
+			)''',
+			'CREATE INDEX IF NOT EXISTS idx_agg_counts_count ON agg_counts(key, count)',
+			'''CREATE TABLE IF NOT EXISTS agg_stats (
+				id integer PRIMARY KEY CHECK (id = 0),
+				total integer,
+				duration_sum real,
+				duration_count integer,
+				longest_duration real
+			)''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_connections_insert AFTER INSERT ON connections
+			BEGIN
+				UPDATE agg_stats SET total = total + 1;
+				INSERT OR IGNORE INTO agg_counts VALUES('server_instance', NEW.server_instance, 0);
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'server_instance' AND value = NEW.server_instance;
+				INSERT OR IGNORE INTO agg_counts VALUES('ip', NEW.ip, 0);
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'ip' AND value = NEW.ip;
+				INSERT OR IGNORE INTO agg_counts SELECT 'country', NEW.country, 0 WHERE NEW.country IS NOT NULL;
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'country' AND value = NEW.country;
+				INSERT OR IGNORE INTO agg_counts SELECT 'city', NEW.city, 0 WHERE NEW.city IS NOT NULL;
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'city' AND value = NEW.city;
+			END''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_connections_country AFTER UPDATE OF country ON connections
+			WHEN OLD.country IS NOT NEW.country
+			BEGIN
+				UPDATE agg_counts SET count = count - 1 WHERE key = 'country' AND value = OLD.country;
+				DELETE FROM agg_counts WHERE key = 'country' AND value = OLD.country AND count <= 0;
+				INSERT OR IGNORE INTO agg_counts SELECT 'country', NEW.country, 0 WHERE NEW.country IS NOT NULL;
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'country' AND value = NEW.country;
+			END''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_connections_city AFTER UPDATE OF city ON connections
+			WHEN OLD.city IS NOT NEW.city
+			BEGIN
+				UPDATE agg_counts SET count = count - 1 WHERE key = 'city' AND value = OLD.city;
+				DELETE FROM agg_counts WHERE key = 'city' AND value = OLD.city AND count <= 0;
+				INSERT OR IGNORE INTO agg_counts SELECT 'city', NEW.city, 0 WHERE NEW.city IS NOT NULL;
+				UPDATE agg_counts SET count = count + 1 WHERE key = 'city' AND value = NEW.city;
+			END''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_connections_duration AFTER UPDATE OF duration ON connections
+			WHEN OLD.duration IS NOT NEW.duration
+			BEGIN
+				UPDATE agg_stats SET
+					duration_sum = duration_sum + IFNULL(NEW.duration, 0) - IFNULL(OLD.duration, 0),
+					duration_count = duration_count + (NEW.duration IS NOT NULL) - (OLD.duration IS NOT NULL);
+				UPDATE agg_stats SET longest_duration = NEW.duration
+					WHERE longest_duration IS NULL OR NEW.duration > longest_duration;
+			END''',
+		] + REBUILD_AGGREGATES),
+		(4, [
+			# GetHistory - time range scans ordered by keyset (start, ip, port)
+			'CREATE INDEX IF NOT EXISTS idx_connections_start ON connections(start, ip, port)',
+		]),
+		(5, [
+			# keyset has to be unique - same (start, ip, port) can be in more server instances
+			'DROP INDEX IF EXISTS idx_connections_start',
+			'CREATE INDEX IF NOT EXISTS idx_connections_start_key ON connections(start, ip, port, server_instance)',
+		]),
+		(6, [
+			# connections per map point for /location, kept up to date by triggers
+			# country and city are taken from first connection at that point
+			'''CREATE TABLE IF NOT EXISTS agg_locations (
+				lat real,
+				lon real,
+				country text,
+				city text,
+				count integer,
+				PRIMARY KEY(lat, lon)
+			)''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_locations_insert AFTER INSERT ON connections
+			WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL
+			BEGIN
+				INSERT OR IGNORE INTO agg_locations VALUES(NEW.lat, NEW.lon, NEW.country, NEW.city, 0);
+				UPDATE agg_locations SET count = count + 1 WHERE lat = NEW.lat AND lon = NEW.lon;
+			END''',
+			'''CREATE TRIGGER IF NOT EXISTS agg_locations_update AFTER UPDATE OF lat, lon ON connections
+			WHEN OLD.lat IS NOT NEW.lat OR OLD.lon IS NOT NEW.lon
+			BEGIN
+				UPDATE agg_locations SET count = count - 1 WHERE lat = OLD.lat AND lon = OLD.lon;
+				DELETE FROM agg_locations WHERE lat = OLD.lat AND lon = OLD.lon AND count <= 0;
+				INSERT OR IGNORE INTO agg_locations SELECT NEW.lat, NEW.lon, NEW.country, NEW.city, 0
+					WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+				UPDATE agg_locations SET count = count + 1 WHERE lat = NEW.lat AND lon = NEW.lon;
+			END''',
+		] + REBUILD_LOCATIONS),
+		(7, [
+			# sequence number of last write done by writer thread, see __write
+			'''CREATE TABLE IF NOT EXISTS writer_state (
+				id integer PRIMARY KEY CHECK (id = 0),
+				seq integer
+			)''',
+			'INSERT OR IGNORE INTO writer_state VALUES(0, 0)',
+		]),
+	]
+
+	def __migrate(self):
+		'''
+		bring DB schema up to date
+		'''
+		try:
+			cur = self.__sqldb.cursor()
+			cur.execute('PRAGMA user_version')
+			version = cur.fetchone()[0]
+			for mig_version, statements in self.MIGRATIONS:
+				if mig_version <= version:
+					continue
+				print("ConnectionsDB: migrating schema to version ", mig_version)
+				_script = 'BEGIN;\n'
+				for st in statements:
+					_script += st + ';\n'
+				_script += 'PRAGMA user_version = {};\n'.format(mig_version)
+				_script += 'COMMIT;\n'
+				cur.executescript(_script)
+				version = mig_version
+		except sqerr as e:
 			print(inspect.currentframe().f_lineno)
+			print(e)
 			print(traceback.format_exc())
+			self.__sqldb.rollback()
+			raise
+
+	def RebuildAggregates(self):
+		'''
+		recompute aggregate tables, ie. after editing connections table by hand
+		'''
+		self.__write(self.REBUILD_AGGREGATES + self.REBUILD_LOCATIONS, None)
+		self.Flush()
+
+	def SchemaVersion(self):
+		with self.__reader() as db:
+			cur = db.cursor()
+			cur.execute('PRAGMA user_version')
+			return cur.fetchone()[0]
 
 	def OpenConnection(self, c):
 		'''
 		count opened connection
+		return sequence number of insert
 		'''
-		if c not in self.__active_connections:
-			self.__active_connections.append(c)
-
-		if c['server_instance'] not in self.__active_connections_per_srv_instance:
-			self.__active_connections_per_srv_instance[ c['server_instance'] ] = []
-		self.__active_connections_per_srv_instance[ c['server_instance'] ].append(c)
+		self.__active_connections.Add(c)
+		self.__version = next(self.__version_counter)
 
 		sql_insert = "INSERT INTO connections('ip', 'port', 'server_instance', 'sdr_version', 'os', 'start')\n"
 		sql_insert += "VALUES(?,?,?,?,?,?);"
 		data = ( c['ip'], c['port'], c['server_instance'], c['sdr_version'] , c['os'] , c['start'] )
-
-		try:
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
-				cur.execute(sql_insert, data)
-				self.__sqldb.commit()
-		except sqlite3.IntegrityError:
-			print(inspect.currentframe().f_lineno)
-			print("already inserted")
-		except sqerr as e:
-			print(inspect.currentframe().f_lineno)
-			print(e)
+		seq = self.__write(sql_insert, data)
 
 		# update GPS
 		#
 		if 	'lat' in c and 'lon' in c and 'city' in c and 'country' in c:
-			sql_upd = "UPDATE connections\n"
-			sql_upd += "SET\n"
-			sql_upd += "\tlat = ?,\n"
-			sql_upd += "\tlon = ?,\n"
-			sql_upd += "\tcountry = ?,\n"
-			sql_upd += "\tcity = ?\n"
-			sql_upd += "WHERE\n"
-			sql_upd += '\tip = ? AND'
-			sql_upd += '\tport = ? AND'
-			sql_upd += '\tserver_instance = ? AND'
-			sql_upd += '\tstart = ?'
-
-			data = ( c['lat'], c['lon'], c['country'], c['city'],
-					c['ip'], c['port'], c['server_instance'], c['start'] )
+			self.UpdateGeoLocation(c)
+		return seq
 
-			try:
-				with self.__mutex:
-					cur = self.__sqldb.cursor()
-					cur.execute(sql_upd, data)
-					self.__sqldb.commit()
-			except sqlite3.IntegrityError:
-				print(inspect.currentframe().f_lineno)
-				print("already inserted")
-			except sqerr as e:
-				print(inspect.currentframe().f_lineno)
-				print(e)
-			except:
-				print(inspect.currentframe().f_lineno)
-				print(traceback.format_exc())
 
+	def UpdateGeoLocation(self, c):
+		'''
+		fill lat/lon/country/city of already opened connection
+		return sequence number of update
+		'''
+		sql_upd = "UPDATE connections\n"
+		sql_upd += "SET\n"
+		sql_upd += "\tlat = ?,\n"
+		sql_upd += "\tlon = ?,\n"
+		sql_upd += "\tcountry = ?,\n"
+		sql_upd += "\tcity = ?\n"
+		sql_upd += "WHERE\n"
+		sql_upd += '\tip = ? AND'
+		sql_upd += '\tport = ? AND'
+		sql_upd += '\tserver_instance = ? AND'
+		sql_upd += '\tstart = ?'
+
+		data = ( c['lat'], c['lon'], c['country'], c['city'],
+				c['ip'], c['port'], c['server_instance'], c['start'] )
+		return self.__write(sql_upd, data)
 
-	def CloseConnection(self, c):
+
+	def GetGeoLocation(self, c):
 		'''
-		update connection with end time/duration
+		return (lat, lon, country, city) stored for connection or None
 		'''
+		_q = "SELECT lat, lon, country, city FROM connections\n"
+		_q += "WHERE ip = ? AND port = ? AND server_instance = ? AND start = ?"
+		try:
+			with self.__reader() as db:
+				cur = db.cursor()
+				cur.execute(_q, (c['ip'], c['port'], c['server_instance'], c['start']))
+				return cur.fetchone()
+		except sqerr as e:
+			print(inspect.currentframe().f_lineno)
+			print(e)
 
-		if c in self.__active_connections:
-			self.__active_connections.remove(c)
 
-		if c['server_instance'] not in self.__active_connections_per_srv_instance:
-			self.__active_connections_per_srv_instance[ c['server_instance'] ] = []
-		if c in self.__active_connections_per_srv_instance[ c['server_instance'] ]:
-			self.__active_connections_per_srv_instance[ c['server_instance'] ].remove(c)
+	def CloseConnection(self, c):
+		'''
+		update connection with end time/duration
+		return sequence number of update
+		'''
+		self.__active_connections.Remove(c)
+		self.__version = next(self.__version_counter)
 
 		sql_upd = "UPDATE connections\n"
 		sql_upd += "SET end = ?,\n"
@@ -211,14 +637,77 @@ class ConnectionsDB():
 
 		data = ( c['end'], c['duration'],
 				c['ip'], c['port'], c['server_instance'], c['start'] )
+		return self.__write(sql_upd, data)
+
+	def GetActive(self):
+		'''
+		opened connections, from memory only
+		'''
+		return self.__active_connections.Get()
+
+	def GetActiveCounts(self):
+		'''
+		count of opened connections, total and per server_instance
+		'''
+		return self.__active_connections.Counts()
+
+	# constant SQL text, so sqlite3 statement cache prepares it once
+	# time range and keyset are always bound (open ends replaced by extreme dates),
+	# so idx_connections_start_key is used to seek directly to the page
+	_HISTORY_QUERY = '''SELECT rowid, * FROM connections
+		WHERE start >= ? AND start < ?
+			AND (start, ip, port, server_instance) > (?, ?, ?, ?)
+			AND (? IS NULL OR server_instance = ?)
+			AND (? IS NULL OR country = ?)
+			AND (? IS NULL OR py_hash(ip) = ?)
+		ORDER BY start, ip, port, server_instance
+		LIMIT ?'''
+	_HISTORY_KEYSET_QUERY = 'SELECT start, ip, port, server_instance FROM connections WHERE rowid = ?'
+
+	def GetHistory(self, time_from = None, time_to = None,
+					server_instance = None, country = None, ip_hash = None,
+					after = None, limit = 100):
+		'''
+		connections started in [time_from, time_to), oldest first
+		time_from, time_to - 'YYYY-MM-DD[ HH:MM:SS]' strings
+		ip_hash - hash of IP, as returned by other methods
+		after - cursor returned as 'next' by previous call
+		return {'rows': [...], 'next': cursor or None}
+		'''
+		time_from = str(time_from).replace('T', ' ') if time_from else ''
+		time_to = str(time_to).replace('T', ' ') if time_to else '9999-12-31'
+		keyset = ('', '', '', '')
+
 		try:
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
-				cur.execute(sql_upd, data)
-				self.__sqldb.commit()
-		except sqlite3.IntegrityError:
-			print(inspect.currentframe().f_lineno)
-			print("already inserted")
+			with self.__reader() as db:
+				cur = db.cursor()
+
+				if after is not None:
+					cur.execute(self._HISTORY_KEYSET_QUERY, (after,))
+					tmp = cur.fetchone()
+					if not tmp:
+						raise ValueError('Bad history cursor')
+					keyset = ( str(tmp[0]), tmp[1], tmp[2], tmp[3] )
+
+				cur.execute(self._HISTORY_QUERY, (
+							time_from, time_to,
+							keyset[0], keyset[1], keyset[2], keyset[3],
+							server_instance, server_instance,
+							country, country,
+							ip_hash, ip_hash,
+							limit) )
+				rows = cur.fetchall()
+
+			columns = [d[0] for d in cur.description]
+			res = {'rows': [], 'next': None}
+			for r in rows:
+				row = dict( zip(columns[1:], r[1:]) )
+				row['ip'] = hash(row['ip']) # hash IPs :)
+				res['rows'].append(row)
+			if len(rows) == limit:
+				res['next'] = rows[-1][0]
+			return res
+
 		except sqerr as e:
 			print(inspect.currentframe().f_lineno)
 			print(e)
@@ -226,8 +715,8 @@ class ConnectionsDB():
 	def GetAll(self):
 		try:
 			res = {}
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
+			with self.__reader() as db:
+				cur = db.cursor()
 				_q = "SELECT * from connections"
 				cur.execute(_q)
 				res = cur.fetchall()
@@ -241,30 +730,26 @@ class ConnectionsDB():
 	def GetConnectionCounts(self):
 		try:
 			res = {}
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
-
-				# count per key
+			with self.__snapshot() as cur:
+				# count per key, from aggregates
 				keys = ['server_instance', 'country', 'city', 'ip']
 				for k in keys:
-					_q = "SELECT {0}, COUNT({0}) from connections GROUP by {0}".format(k)
-					cur.execute(_q)
-					tmp = cur.fetchall()
-					if tmp:
-						res[k] = tmp
+					_q = "SELECT value, count from agg_counts WHERE key = ? ORDER BY value"
+					cur.execute(_q, (k,))
+					res[k] = cur.fetchall()
 
 				# TOTAL
-				_q = "SELECT COUNT(*) from connections"
+				_q = "SELECT total from agg_stats"
 				cur.execute(_q)
 				tmp = cur.fetchone()
 				if tmp:
 					res['TOTAL'] = tmp[0]
 
-			res['ACTIVE'] = {}
-			res['ACTIVE']['TOTAL'] =  len(self.__active_connections)
-			res['ACTIVE']['SERVER'] = {}
-			for srv_inst in self.__active_connections_per_srv_instance:
-				res['ACTIVE']['SERVER'][srv_inst] = self.__active_connections_per_srv_instance[srv_inst]
+				# last write counted in result, live events of later writes apply on top
+				cur.execute('SELECT seq FROM writer_state')
+				res['SEQ'] = cur.fetchone()[0]
+
+			res['ACTIVE'] = self.GetActive()
 
 			# hash IPs :)
 			for i in range( len(res['ip']) ):
@@ -279,8 +764,8 @@ class ConnectionsDB():
 	def GetConnectionCountsFull(self):
 		try:
 			res = {}
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
+			with self.__reader() as db:
+				cur = db.cursor()
 
 
 				# count per key
@@ -299,11 +784,7 @@ class ConnectionsDB():
 				if tmp:
 					res['TOTAL'] = tmp[0]
 
-			res['ACTIVE'] = {}
-			res['ACTIVE']['TOTAL'] =  len(self.__active_connections)
-			res['ACTIVE']['SERVER'] = {}
-			for srv_inst in self.__active_connections_per_srv_instance:
-				res['ACTIVE']['SERVER'][srv_inst] = self.__active_connections_per_srv_instance[srv_inst]
+			res['ACTIVE'] = self.GetActive()
 
 			# hash IPs :)
 			for i in range( len(res['ip']) ):
@@ -317,6 +798,26 @@ class ConnectionsDB():
 			print(inspect.currentframe().f_lineno)
 			print(e)
 
+	def GetLocations(self):
+		'''
+		connections count per map point (lat, lon), from aggregate
+		many IPs get the same lat/lon from geolocation, so they are one point
+		{'POINTS': [{count, city, country, lat, lon}], 'SEQ': last write counted in points}
+		'''
+		try:
+			with self.__snapshot() as cur:
+				cur.execute('SELECT lat, lon, country, city, count FROM agg_locations')
+				points = [
+					{'count': count, 'city': city, 'country': country, 'lat': lat, 'lon': lon}
+					for lat, lon, country, city, count in cur.fetchall()
+				]
+				cur.execute('SELECT seq FROM writer_state')
+				return { 'POINTS': points, 'SEQ': cur.fetchone()[0] }
+
+		except sqerr as e:
+			print(inspect.currentframe().f_lineno)
+			print(e)
+
 	def GetConnectionStats(self):
 		'''
 		longest
@@ -325,48 +826,44 @@ class ConnectionsDB():
 		'''
 
 		try:
-			with self.__mutex:
-				cur = self.__sqldb.cursor()
+			with self.__reader() as db:
+				cur = db.cursor()
 
 				res = {}
 
+				cur.execute('SELECT duration_sum, duration_count, longest_duration FROM agg_stats')
+				duration_sum, duration_count, longest_duration = cur.fetchone()
+
 				# longest
-				_q = 'SELECT * FROM connections ORDER BY duration DESC'
-				cur.execute(_q)
-				tmp = cur.fetchone()
-				if tmp:
-					res['longest'] = list( tmp )
-					res['longest'][0] = hash(res['longest'][0])
+				if longest_duration is not None:
+					_q = 'SELECT * FROM connections WHERE duration = ? LIMIT 1'
+					cur.execute(_q, (longest_duration,))
+					tmp = cur.fetchone()
+					if tmp:
+						res['longest'] = list( tmp )
+						res['longest'][0] = hash(res['longest'][0])
 
 				# most frequent ***
-				_q_template = r'''	SELECT {0},
-			 						COUNT({0}) AS value_occurrence
-									FROM connections
-									GROUP BY {0}
-									ORDER BY value_occurrence DESC
-									LIMIT    1;'''
+				_q = r'''	SELECT value, count
+							FROM agg_counts
+							WHERE key = ?
+							ORDER BY count DESC
+							LIMIT    1;'''
 
 				frequents = ['ip', 'country', 'city']
 				for column in frequents:
-					cur.execute( _q_template.format(column) )
+					cur.execute( _q, (column,) )
 					tmp = cur.fetchone()
 					if tmp:
 						res[column] = list( tmp )
 
-				# average duration
-				cur.execute('SELECT AVG(duration) FROM connections')
-				tmp = cur.fetchone()
-				if tmp:
-					res['avg'] = tmp[0]
-
-				# sum duration
-				cur.execute('SELECT SUM(duration) FROM connections')
-				tmp = cur.fetchone()
-				if tmp:
-					res['sum'] = tmp[0]
+				# average and sum duration
+				res['avg'] = duration_sum / duration_count if duration_count else None
+				res['sum'] = duration_sum if duration_count else None
 
 				# hash IP	 :)
-				res['ip'] = ( hash(res['ip'][0]), res['ip'][1] )
+				if 'ip' in res:
+					res['ip'] = ( hash(res['ip'][0]), res['ip'][1] )
 
 				return res
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import queue
+import threading
+import collections
+
+
+class Subscriber():
+	'''
+	one connected client, bounded queue of encoded events
+	'''
+	def __init__(self, queue_size):
+		self.queue = queue.Queue(maxsize = queue_size)
+		self.lagging = False # queue overflowed, client gets reset event and refetches state
+
+
+class EventHub():
+	'''
+	Fan-out of live events to Server-Sent Events clients.
+
+	Publish() encodes event once and puts it on every subscriber queue (put_nowait),
+	so publisher never waits for slow clients. Subscriber with full queue
+	is marked lagging, its queue is replaced by single 'reset' event
+	and client is expected to fetch full state again.
+
+	Last `history` events are kept, so reconnecting client (Last-Event-ID)
+	gets what it missed, or 'reset' when it is too old.
+	'''
+	def __init__(self, queue_size = 100, history = 100, keepalive = 15.0, max_subscribers = 8):
+		self.__queue_size = queue_size
+		self.__keepalive = keepalive
+		self.__max_subscribers = max_subscribers
+		self.__lock = threading.Lock()
+		self.__subscribers = set()
+		self.__history = collections.deque(maxlen = history) # (id, encoded event)
+		self.__last_id = 0
+		self.__boot = '{:x}'.format( int(time.time()) ) # ids from previous run are not resumed
+		self.__closed = False
+
+		self.__published = 0
+		self.__resets = 0
+		self.__rejected = 0
+
+	def Encode(self, n, event_type, data):
+		return 'id: {}-{}\nevent: {}\ndata: {}\n\n'.format(
+				self.__boot, n, event_type, json.dumps(data, default = str))
+
+	def Publish(self, event_type, data):
+		with self.__lock:
+			self.__last_id += 1
+			msg = self.Encode(self.__last_id, event_type, data)
+			self.__history.append( (self.__last_id, msg) )
+			self.__published += 1
+			for sub in self.__subscribers:
+				if sub.lagging:
+					continue
+				try:
+					sub.queue.put_nowait(msg)
+				except queue.Full:
+					self.__reset(sub)
+
+	def __reset(self, sub):
+		'''
+		drop pending events of subscriber, leave only reset
+		'''
+		sub.lagging = True
+		self.__resets += 1
+		while True:
+			try:
+				sub.queue.get_nowait()
+			except queue.Empty:
+				break
+		sub.queue.put_nowait( self.Encode(self.__last_id, 'reset', {}) )
+
+	def Subscribe(self, last_event_id = None):
+		'''
+		return Subscriber, or None when max_subscribers are connected
+		last_event_id - Last-Event-ID header of reconnecting client, resume after this event
+		'''
+		sub = Subscriber(self.__queue_size)
+		with self.__lock:
+			if self.__closed or len(self.__subscribers) >= self.__max_subscribers:
+				self.__rejected += 1
+				return None
+			if last_event_id:
+				after = self.__ParseId(last_event_id)
+				missed = self.__last_id - after if after is not None else -1
+				oldest = self.__history[0][0] if self.__history else self.__last_id + 1
+				if missed < 0 or missed > self.__queue_size or (missed and oldest > after + 1):
+					# id from previous server run, or events are not in history anymore
+					self.__reset(sub)
+				elif missed:
+					for i, msg in self.__history:
+						if i > after:
+							sub.queue.put_nowait(msg)
+			self.__subscribers.add(sub)
+		return sub
+
+	def __ParseId(self, event_id):
+		'''
+		'<boot>-<n>' -> n, None when not from this hub
+		'''
+		boot, _, n = str(event_id).rpartition('-')
+		if boot != self.__boot or not n.isdigit():
+			return None
+		return int(n)
+
+	def Unsubscribe(self, sub):
+		with self.__lock:
+			self.__subscribers.discard(sub)
+
+	def Stream(self, sub):
+		'''
+		yield encoded events for subscriber, comment line every keepalive seconds
+		(it also detects disconnected client), ends after reset or Close()
+		'''
+		try:
+			yield 'retry: 3000\n\n'
+			while True:
+				try:
+					msg = sub.queue.get(timeout = self.__keepalive)
+				except queue.Empty:
+					yield ': keepalive\n\n'
+					continue
+				if msg is None:
+					return
+				yield msg
+				if sub.lagging and sub.queue.empty():
+					# reset was sent, client reconnects and refetches
+					return
+		finally:
+			self.Unsubscribe(sub)
+
+	def Close(self):
+		'''
+		end all streams, ie. on server shutdown
+		'''
+		with self.__lock:
+			self.__closed = True
+			for sub in self.__subscribers:
+				try:
+					sub.queue.put_nowait(None)
+				except queue.Full:
+					sub.lagging = True # stream ends after pending reset
+			self.__subscribers.clear()
+
+	def Subscribers(self):
+		return len(self.__subscribers)
+
+	def Stats(self):
+		return {
+			'subscribers': len(self.__subscribers),
+			'max_subscribers': self.__max_subscribers,
+			'published': self.__published,
+			'resets': self.__resets,
+			'rejected': self.__rejected,
+			'last_id': self.__last_id
+		}
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+import collections
+
+from ConnectionsDB import JSONEncoder
+import Logger
+
+
+class EventSpool():
+	'''
+	Append-only journal of events (one JSON per line) waiting to be sent to DB.
+
+	<journal_file>      - events
+	<journal_file>.ack  - byte offset of first not acknowledged event
+
+	Events are appended before sending, acknowledged after DB accepted them.
+	On start not acknowledged events are loaded again (replay).
+	Journal is truncated when everything is acknowledged,
+	or rewritten when acknowledged part grows over compact_bytes.
+	'''
+	def __init__(self, journal_file, fsync = False, compact_bytes = 1024 * 1024, source = None):
+		'''
+		source - log source (spyserver instance), defaults to journal file name
+		'''
+		self.__file_name = journal_file
+		self.__source = source or os.path.basename(journal_file)
+		self.__logger = Logger.Get()
+		self.__ack_file_name = journal_file + '.ack'
+		self.__fsync = fsync
+		self.__compact_bytes = compact_bytes
+		self.__mutex = threading.Condition()
+		self.__pending = collections.deque() # (line length in bytes, event)
+		self.__acked_offset = 0
+		self.__enc = JSONEncoder()
+
+		d = os.path.dirname(self.__file_name)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+
+		self.__replay()
+		self.__file = open(self.__file_name, 'ab')
+
+	def __replay(self):
+		if os.path.isfile(self.__ack_file_name):
+			with open(self.__ack_file_name) as f:
+				try:
+					self.__acked_offset = int(f.read().strip() or 0)
+				except ValueError:
+					self.__acked_offset = 0
+
+		if not os.path.isfile(self.__file_name):
+			self.__acked_offset = 0
+			return
+
+		saved_offset = self.__acked_offset
+		if self.__acked_offset > os.path.getsize(self.__file_name):
+			# stale offset of journal before truncate / compact (crash in between),
+			# whole journal is not acknowledged, DB ignores events it already has
+			self.__acked_offset = 0
+
+		good_end = self.__acked_offset # end of last complete line
+		torn = False
+		with open(self.__file_name, 'rb') as f:
+			f.seek(self.__acked_offset)
+			for line in f:
+				if not line.endswith(b'\n'):
+					torn = True # torn write at the end
+					break
+				good_end += len(line)
+				try:
+					self.__pending.append( (len(line), json.loads(line.decode('utf-8'))) )
+				except ValueError:
+					self.__logger.Warning(self.__source, "Skipping bad journal line in ", self.__file_name)
+					if self.__pending:
+						# acked together with previous event, so offsets stay on line boundaries
+						n, event = self.__pending[-1]
+						self.__pending[-1] = (n + len(line), event)
+					else:
+						self.__acked_offset += len(line)
+
+		if torn:
+			# next Append() must start on a new line, not continue the torn one
+			self.__logger.Warning(self.__source, "Dropping torn line at the end of ", self.__file_name)
+			with open(self.__file_name, 'r+b') as f:
+				f.truncate(good_end)
+
+		if self.__acked_offset != saved_offset:
+			self.__saveAckOffset()
+
+		if self.__pending:
+			self.__logger.Warning(self.__source, "Replaying ", len(self.__pending), " events from ", self.__file_name)
+
+	def Append(self, event):
+		line = (self.__enc.encode(event) + '\n').encode('utf-8')
+		with self.__mutex:
+			self.__file.write(line)
+			self.__file.flush()
+			if self.__fsync:
+				os.fsync(self.__file.fileno())
+			self.__pending.append( (len(line), event) )
+			self.__mutex.notify_all()
+
+	def Wait(self, timeout):
+		'''
+		wait until there is something pending
+		'''
+		with self.__mutex:
+			if not self.__pending:
+				self.__mutex.wait(timeout)
+			return len(self.__pending)
+
+	def Pending(self, limit):
+		'''
+		oldest not acknowledged events, at most limit
+		'''
+		with self.__mutex:
+			return [ self.__pending[i][1] for i in range( min(limit, len(self.__pending)) ) ]
+
+	def __len__(self):
+		return len(self.__pending)
+
+	def Ack(self, count):
+		'''
+		first count pending events were accepted by DB
+		'''
+		with self.__mutex:
+			for i in range( min(count, len(self.__pending)) ):
+				self.__acked_offset += self.__pending.popleft()[0]
+
+			if not self.__pending:
+				# everything sent - start with empty journal
+				# offset first: crash in between only sends acknowledged events again
+				self.__acked_offset = 0
+				self.__saveAckOffset()
+				self.__file.truncate(0)
+				self.__file.seek(0)
+			elif self.__acked_offset > self.__compact_bytes:
+				self.__compact()
+			else:
+				self.__saveAckOffset()
+
+	def __compact(self):
+		'''
+		rewrite journal with pending events only
+		'''
+		tmp_file = self.__file_name + '.tmp'
+		with open(self.__file_name, 'rb') as src, open(tmp_file, 'wb') as dst:
+			src.seek(self.__acked_offset)
+			while True:
+				buf = src.read(1024 * 1024)
+				if not buf:
+					break
+				dst.write(buf)
+			dst.flush()
+			os.fsync(dst.fileno())
+		self.__acked_offset = 0
+		self.__saveAckOffset() # before replace, like in Ack()
+		self.__file.close()
+		os.replace(tmp_file, self.__file_name)
+		self.__file = open(self.__file_name, 'ab')
+
+	def __saveAckOffset(self):
+		tmp_file = self.__ack_file_name + '.tmp'
+		with open(tmp_file, 'w') as f:
+			f.write(str(self.__acked_offset))
+		os.replace(tmp_file, self.__ack_file_name)
+
+	def Close(self):
+		with self.__mutex:
+			self.__file.close()
+
+
+class EventQueue():
+	'''
+	bounded FIFO between line reader and spool writer
+
+	overflow policy when queue is full:
+		drop_oldest - remove oldest queued event, keep new one
+		drop_newest - drop new event
+		block - wait up to block_timeout for space, then drop new event
+	'''
+	POLICIES = ['drop_oldest', 'drop_newest', 'block']
+
+	def __init__(self, maxsize = 10000, overflow = 'block', block_timeout = 0.5):
+		if overflow not in self.POLICIES:
+			raise ValueError('Unknown overflow policy: ' + str(overflow))
+		self.__maxsize = maxsize
+		self.__overflow = overflow
+		self.__block_timeout = block_timeout
+		self.__queue = collections.deque()
+		self.__mutex = threading.Condition()
+
+		self.__enqueued = 0
+		self.__dropped = 0
+		self.__max_depth = 0
+
+	def Put(self, event):
+		'''
+		return False if an event was dropped
+		'''
+		with self.__mutex:
+			dropped = False
+			if len(self.__queue) >= self.__maxsize:
+				if self.__overflow == 'block':
+					deadline = time.time() + self.__block_timeout
+					while len(self.__queue) >= self.__maxsize and time.time() < deadline:
+						self.__mutex.wait( deadline - time.time() )
+				if len(self.__queue) >= self.__maxsize:
+					self.__dropped += 1
+					dropped = True
+					if self.__overflow == 'drop_oldest':
+						self.__queue.popleft()
+					else:
+						return False
+
+			self.__queue.append(event)
+			self.__enqueued += 1
+			self.__max_depth = max(self.__max_depth, len(self.__queue))
+			self.__mutex.notify_all()
+			return not dropped
+
+	def Get(self, timeout = None):
+		'''
+		oldest event or None on timeout
+		'''
+		with self.__mutex:
+			if not self.__queue:
+				self.__mutex.wait(timeout)
+			if not self.__queue:
+				return None
+			event = self.__queue.popleft()
+			self.__mutex.notify_all()
+			return event
+
+	def __len__(self):
+		return len(self.__queue)
+
+	def Stats(self):
+		return {
+			'depth': len(self.__queue),
+			'max_depth': self.__max_depth,
+			'enqueued': self.__enqueued,
+			'dropped': self.__dropped,
+			'overflow': self.__overflow
+		}
+
+
+class SpoolShipper():
+	'''
+	thread sending events from EventSpool to DB in batches
+	send(events) should raise on failure, events stay in spool and are retried
+	'''
+	def __init__(self, spool, send, batch_size = 100, retry_interval = 5.0, name = 'SpoolShipper', source = None):
+		'''
+		source - log source (spyserver instance), defaults to name
+		'''
+		self.__spool = spool
+		self.__source = source or name
+		self.__logger = Logger.Get()
+		self.__send = send
+		self.__batch_size = batch_size
+		self.__retry_interval = retry_interval
+		self.__stop = False
+		self.__sent = 0
+		self.__failures = 0
+		self.__thread = threading.Thread(target = self.__run__, name = name)
+		self.__thread.daemon = True
+
+	def Start(self):
+		self.__thread.start()
+
+	def Stop(self, timeout = None):
+		'''
+		try to send what is pending and stop
+		'''
+		self.__stop = True
+		self.__thread.join(timeout)
+
+	def Stats(self):
+		return {
+			'pending': len(self.__spool),
+			'sent': self.__sent,
+			'failures': self.__failures
+		}
+
+	def __run__(self):
+		while True:
+			if not self.__spool.Wait(1.0):
+				if self.__stop:
+					return
+				continue
+
+			events = self.__spool.Pending(self.__batch_size)
+			try:
+				self.__send(events)
+			except:
+				self.__failures += 1
+				self.__logger.Exception(self.__source, "Sending ", len(events), " events failed, ", len(self.__spool), " pending")
+				if self.__stop:
+					return
+				time.sleep(self.__retry_interval)
+				continue
+
+			self.__spool.Ack(len(events))
+			self.__sent += len(events)
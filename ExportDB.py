@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+'''
+	stream connections table as NDJSON or CSV, optionally gzipped
+	rows are read in chunks with fetchmany, so memory use does not depend on DB size
+
+	./ExportDB.py ./SpyserverConnections.db [ndjson|csv] [--gzip] [--hash-ip] > out
+'''
+
+import io
+import sys
+import csv
+import zlib
+import sqlite3
+import pathlib
+
+from ConnectionsDB import JSONEncoder
+
+
+FORMATS = ['ndjson', 'csv']
+
+
+def IterConnections(sqldb_file, chunk_size = 1000, hash_ip = False):
+	'''
+	yield (columns, rows) chunks of connections table
+	uses own read only connection, so it does not block ConnectionsDB
+	'''
+	# path as URI, so '?', '#' and '%' in file name are quoted
+	db = sqlite3.connect(pathlib.Path(sqldb_file).resolve().as_uri() + '?mode=ro', uri=True)
+	try:
+		cur = db.cursor()
+		cur.execute('SELECT * FROM connections ORDER BY rowid')
+		columns = [d[0] for d in cur.description]
+		ip_col = columns.index('ip')
+		rows = cur.fetchmany(chunk_size)
+		while rows:
+			if hash_ip:
+				rows = [ r[:ip_col] + (hash(r[ip_col]),) + r[ip_col+1:] for r in rows ]
+			yield columns, rows
+			rows = cur.fetchmany(chunk_size)
+	finally:
+		db.close()
+
+
+def IterNDJSON(chunks):
+	enc = JSONEncoder()
+	for columns, rows in chunks:
+		yield ''.join( enc.encode( dict(zip(columns, r)) ) + '\n' for r in rows ).encode('utf-8')
+
+
+def IterCSV(chunks):
+	header = True
+	for columns, rows in chunks:
+		buf = io.StringIO()
+		w = csv.writer(buf)
+		if header:
+			w.writerow(columns)
+			header = False
+		w.writerows(rows)
+		yield buf.getvalue().encode('utf-8')
+
+
+def IterGzip(blocks, level = 6):
+	'''
+	gzip stream of byte blocks
+	'''
+	z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for b in blocks:
+		out = z.compress(b)
+		if out:
+			yield out
+	yield z.flush()
+
+
+def Export(sqldb_file, fmt = 'ndjson', gzip = False, hash_ip = False, chunk_size = 1000):
+	'''
+	generator of byte blocks with exported connections
+	'''
+	if fmt not in FORMATS:
+		raise ValueError('Unknown export format: ' + str(fmt))
+	chunks = IterConnections(sqldb_file, chunk_size, hash_ip)
+	blocks = IterNDJSON(chunks) if fmt == 'ndjson' else IterCSV(chunks)
+	if gzip:
+		blocks = IterGzip(blocks)
+	return blocks
+
+
+if __name__ == "__main__":
+	args = [a for a in sys.argv[1:] if not a.startswith('--')]
+	if not args:
+		print(__doc__)
+		sys.exit(1)
+	fmt = args[1] if len(args) > 1 else 'ndjson'
+
+	out = sys.stdout.buffer
+	for block in Export(args[0], fmt, gzip = '--gzip' in sys.argv, hash_ip = '--hash-ip' in sys.argv):
+		out.write(block)
+	out.flush()
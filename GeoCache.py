@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import time
+import json
+import sqlite3
+import threading
+import traceback
+import inspect
+from collections import OrderedDict
+
+from sqlite3 import Error as sqerr
+
+
+class GeoCache():
+	'''
+	LRU cache of IP geolocation results with TTL.
+	Entries live in memory and are written through to sqlite file,
+	so cache survives restarts of HttpInterface.
+	'''
+
+	# only these fields of ipgeolocation.io response are used
+	FIELDS = ['latitude', 'longitude', 'country_name', 'city']
+
+	def __init__(self, cache_file, ttl = 7 * 24 * 3600, max_size = 10000):
+		self.__cache_file = cache_file
+		self.__ttl = ttl
+		self.__max_size = max_size
+		self.__mutex = threading.Lock() # memory LRU
+		self.__db_mutex = threading.Lock() # sqlite connection, shared by Put() callers
+		self.__mem = OrderedDict() # ip -> (timestamp, geoloc)
+
+		self.__hits = 0
+		self.__misses = 0
+		self.__miss_time = 0.0 # total seconds spent in resolver on misses
+
+		self.__sqldb = None
+		self.__initSQLDB()
+		self.__load()
+
+	def __initSQLDB(self):
+		try:
+			self.__sqldb = sqlite3.connect(self.__cache_file, check_same_thread=False)
+			cur = self.__sqldb.cursor()
+			cur.execute("CREATE TABLE IF NOT EXISTS geocache ("
+						"	ip text PRIMARY KEY,"
+						"	ts real,"
+						"	data text"
+						");")
+			self.__sqldb.commit()
+		except sqerr as e:
+			print(inspect.currentframe().f_lineno)
+			print(e)
+			self.__sqldb = None
+
+	def __load(self):
+		'''
+		warm up memory with most recent, not expired entries
+		'''
+		if not self.__sqldb:
+			return
+		try:
+			cur = self.__sqldb.cursor()
+			cur.execute("DELETE FROM geocache WHERE ts < ?", (time.time() - self.__ttl,))
+			self.__sqldb.commit()
+			cur.execute("SELECT ip, ts, data FROM geocache ORDER BY ts DESC LIMIT ?", (self.__max_size,))
+			rows = cur.fetchall()
+			# oldest first, so most recent end up at LRU tail
+			for ip, ts, data in reversed(rows):
+				self.__mem[ip] = (ts, json.loads(data))
+		except sqerr as e:
+			print(inspect.currentframe().f_lineno)
+			print(e)
+		except:
+			print(inspect.currentframe().f_lineno)
+			print(traceback.format_exc())
+
+	def Get(self, ip):
+		'''
+		return cached geolocation or None
+		'''
+		with self.__mutex:
+			entry = self.__mem.get(ip)
+			if entry and time.time() - entry[0] < self.__ttl:
+				self.__mem.move_to_end(ip)
+				self.__hits += 1
+				return dict(entry[1])
+			if entry:
+				del self.__mem[ip]
+			self.__misses += 1
+			return None
+
+	def Put(self, ip, geoloc, lookup_time = 0.0):
+		'''
+		store geolocation result
+		lookup_time - seconds the resolver took, used to estimate saved latency
+		'''
+		geoloc = { k: geoloc[k] for k in self.FIELDS if k in geoloc }
+		now = time.time()
+		evicted = []
+		with self.__mutex:
+			self.__miss_time += lookup_time
+			self.__mem[ip] = (now, geoloc)
+			self.__mem.move_to_end(ip)
+			while len(self.__mem) > self.__max_size:
+				evicted.append( self.__mem.popitem(last=False)[0] )
+
+		# persist outside of __mutex, so lookups never wait for disk
+		if not self.__sqldb:
+			return
+		with self.__db_mutex:
+			try:
+				cur = self.__sqldb.cursor()
+				cur.execute("INSERT OR REPLACE INTO geocache(ip, ts, data) VALUES(?,?,?)",
+							(ip, now, json.dumps(geoloc)))
+				if evicted:
+					cur.executemany("DELETE FROM geocache WHERE ip = ?", [(e,) for e in evicted])
+				self.__sqldb.commit()
+			except sqerr as e:
+				print(inspect.currentframe().f_lineno)
+				print(e)
+
+	def Stats(self):
+		with self.__mutex:
+			lookups = self.__hits + self.__misses
+			avg_miss = self.__miss_time / self.__misses if self.__misses else 0.0
+			return {
+				'size': len(self.__mem),
+				'max_size': self.__max_size,
+				'ttl': self.__ttl,
+				'hits': self.__hits,
+				'misses': self.__misses,
+				'hit_ratio': float(self.__hits) / lookups if lookups else 0.0,
+				'avg_miss_latency': avg_miss,
+				# every hit is one API call not made
+				'saved_api_calls': self.__hits,
+				'saved_latency': self.__hits * avg_miss
+			}
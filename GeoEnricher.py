@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+import traceback
+
+
+class GeoEnricher():
+	'''
+	Pool of worker threads resolving geolocation for opened connections
+	off the request path.
+
+	resolver(ip) -> geoloc dict (ipgeolocation.io format) or None
+	on_done(connection) is called from worker thread, after connection
+	was updated with lat/lon/country/city (or left without them when lookup failed)
+	'''
+	def __init__(self, resolver, on_done, workers = 2, queue_size = 1000):
+		self.__resolver = resolver
+		self.__on_done = on_done
+		self.__queue = queue.Queue(maxsize = queue_size)
+		self.__threads = []
+		self.__dropped = 0
+		self.__failed = 0
+
+		for i in range(workers):
+			t = threading.Thread(target = self.__run__, name = 'GeoEnricher-{}'.format(i))
+			t.daemon = True
+			t.start()
+			self.__threads.append(t)
+
+	def Submit(self, connection):
+		'''
+		queue connection for geolocation, never blocks
+		'''
+		try:
+			self.__queue.put_nowait(connection)
+			return True
+		except queue.Full:
+			self.__dropped += 1
+			print("GeoEnricher queue full, no geolocation for ", connection['ip'])
+			return False
+
+	def SetResolver(self, resolver):
+		'''
+		use another resolver for next lookups (ie. after config reload)
+		'''
+		self.__resolver = resolver
+
+	def Pending(self):
+		return self.__queue.qsize()
+
+	def Stats(self):
+		return {
+			'pending': self.__queue.qsize(),
+			'dropped': self.__dropped,
+			'failed': self.__failed
+		}
+
+	def Stop(self):
+		for t in self.__threads:
+			self.__queue.put(None)
+		for t in self.__threads:
+			t.join()
+
+	def __run__(self):
+		while True:
+			connection = self.__queue.get()
+			if connection is None:
+				return
+			try:
+				geoloc = self.__resolver(connection['ip'])
+				if geoloc:
+					connection['lat'] = geoloc['latitude']
+					connection['lon'] = geoloc['longitude']
+					connection['country'] = geoloc['country_name']
+					connection['city'] = geoloc['city']
+			except:
+				self.__failed += 1
+				print(traceback.format_exc())
+				print("Geo Location Failed")
+
+			try:
+				self.__on_done(connection)
+			except:
+				print(traceback.format_exc())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+'''
+Offline IPv4 geolocation from CSV range database.
+
+CSV columns: start_ip, end_ip, lat, lon, country, city
+IPs can be dotted (1.2.3.0) or integers. Header line and IPv6 rows are skipped.
+
+CSV is compiled once to binary index file, which is memory mapped.
+Lookup is a binary search over mmaped array of range starts,
+no python object is created per range.
+
+	python3 ./GeoIPRanges.py compile ranges.csv ranges.idx
+	python3 ./GeoIPRanges.py lookup ranges.idx 8.8.8.8
+'''
+
+import os
+import sys
+import csv
+import mmap
+import json
+import time
+import array
+import socket
+import struct
+import bisect
+
+
+MAGIC = b'SSGEOIDX'
+# magic, byteorder ('<' or '>'), ranges count, strings count
+HEADER = struct.Struct('=8sc3xII')
+HEADER_SIZE = 32 # padded, so arrays of doubles are aligned
+
+
+def IpToInt(ip):
+	'''
+	dotted IPv4 or integer string to int, None for anything else
+	'''
+	ip = ip.strip()
+	if ip.isdigit():
+		n = int(ip)
+		return n if n <= 0xFFFFFFFF else None # integer form of IPv6
+	try:
+		return struct.unpack('!I', socket.inet_aton(ip))[0]
+	except (OSError, struct.error):
+		return None
+
+
+def Compile(csv_file, index_file):
+	'''
+	compile CSV range database into index file
+	return number of ranges
+	'''
+	rows = []
+	strings = {} # string -> index in string table
+	def _str_id(s):
+		if s not in strings:
+			strings[s] = len(strings)
+		return strings[s]
+
+	with open(csv_file, newline='') as f:
+		for r in csv.reader(f):
+			if len(r) < 6:
+				continue
+			start = IpToInt(r[0])
+			end = IpToInt(r[1])
+			if start is None or end is None:
+				continue # header or IPv6
+			try:
+				lat = float(r[2])
+				lon = float(r[3])
+			except ValueError:
+				continue
+			rows.append( (start, end, lat, lon, _str_id(r[4].strip()), _str_id(r[5].strip())) )
+
+	rows.sort()
+
+	lats = array.array('d', [r[2] for r in rows])
+	lons = array.array('d', [r[3] for r in rows])
+	starts = array.array('I', [r[0] for r in rows])
+	ends = array.array('I', [r[1] for r in rows])
+	countries = array.array('I', [r[4] for r in rows])
+	cities = array.array('I', [r[5] for r in rows])
+
+	string_table = [None] * len(strings)
+	for s, i in strings.items():
+		string_table[i] = s
+
+	byteorder = b'<' if sys.byteorder == 'little' else b'>'
+	tmp_file = index_file + '.tmp'
+	with open(tmp_file, 'wb') as f:
+		f.write( HEADER.pack(MAGIC, byteorder, len(rows), len(string_table)).ljust(HEADER_SIZE, b'\0') )
+		for a in (lats, lons, starts, ends, countries, cities):
+			a.tofile(f)
+		f.write( json.dumps(string_table).encode('utf-8') )
+	os.replace(tmp_file, index_file)
+
+	return len(rows)
+
+
+class GeoIPRanges():
+	'''
+	lookups in compiled index file
+	'''
+	def __init__(self, index_file):
+		self.__file = open(index_file, 'rb')
+		self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, byteorder, n, n_strings = HEADER.unpack_from(self.__mm, 0)
+		if magic != MAGIC:
+			raise ValueError("Not a geolocation index file: " + index_file)
+		if byteorder != (b'<' if sys.byteorder == 'little' else b'>'):
+			raise ValueError("Geolocation index compiled on different byte order: " + index_file)
+
+		mv = memoryview(self.__mm)
+		off = HEADER_SIZE
+		self.__lat = mv[off : off + 8 * n].cast('d');		off += 8 * n
+		self.__lon = mv[off : off + 8 * n].cast('d');		off += 8 * n
+		self.__start = mv[off : off + 4 * n].cast('I');		off += 4 * n
+		self.__end = mv[off : off + 4 * n].cast('I');		off += 4 * n
+		self.__country = mv[off : off + 4 * n].cast('I');	off += 4 * n
+		self.__city = mv[off : off + 4 * n].cast('I');		off += 4 * n
+		self.__strings = json.loads( bytes(mv[off:]).decode('utf-8') )
+		self.__count = n
+
+	def __len__(self):
+		return self.__count
+
+	def Lookup(self, ip):
+		'''
+		return geolocation in the same format as ipgeolocation.io response
+		or None when IP is not in any range
+		'''
+		n = IpToInt(ip)
+		if n is None:
+			return None
+		i = bisect.bisect_right(self.__start, n) - 1
+		if i < 0 or n > self.__end[i]:
+			return None
+		return {
+			'latitude': self.__lat[i],
+			'longitude': self.__lon[i],
+			'country_name': self.__strings[ self.__country[i] ],
+			'city': self.__strings[ self.__city[i] ]
+		}
+
+
+def LoadOrCompile(csv_file, index_file):
+	'''
+	(re)compile index when it's missing or older than CSV
+	'''
+	if not os.path.isfile(index_file) or \
+			( os.path.isfile(csv_file) and os.path.getmtime(csv_file) > os.path.getmtime(index_file) ):
+		print("Compiling geolocation index ", csv_file, ' -> ', index_file, ' ... ', end = '')
+		print(Compile(csv_file, index_file), 'ranges')
+	return GeoIPRanges(index_file)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 4 and sys.argv[1] == 'compile':
+		_t = time.time()
+		n = Compile(sys.argv[2], sys.argv[3])
+		print(n, 'ranges compiled in', time.time() - _t, 's')
+	elif len(sys.argv) >= 4 and sys.argv[1] == 'lookup':
+		ranges = GeoIPRanges(sys.argv[2])
+		for ip in sys.argv[3:]:
+			_t = time.time()
+			res = ranges.Lookup(ip)
+			print(ip, res, '{:.2f}us'.format( (time.time() - _t) * 1e6 ))
+	else:
+		print(__doc__)
@@ -9,45 +9,56 @@ import datetime
 import traceback
 import subprocess
 import getpass
-import re
+import time
+import zlib
+import signal
 from pprint import pprint
 import bottle
 
+import cfg as cfg_module
 from cfg import cfg
 from ConnectionsDB import ConnectionsDB, Connection
+from GeoCache import GeoCache
+from GeoEnricher import GeoEnricher
+import GeoIPRanges
+import ExportDB
 from NotifySlack import NotifySlack
+from Notifier import Notifier
+from IpFilter import IpFilter
+from EventHub import EventHub
+import Metrics
 
 import urllib3
 urllib3.disable_warnings()
 http = urllib3.PoolManager()
 
 
-def IpMatch(i_ip, i_regexp):
-	i_regexp = i_regexp.replace('*', '\d+')
-
-	ip_tokens = i_ip.split('.')
-	if len(ip_tokens) != 4:
-		print('ipfilter - Bad IP: ', i_ip)
-		return False
-
-	re_tokens = i_regexp.split('.')
-	if len(re_tokens) != 4:
-		print('ipfilter - Bad regexp: ', i_regexp)
-		return False
-
-	for i in range(4):
-		if not re.match(re_tokens[i], ip_tokens[i]):
-			return False
-	return True
-
-
-def IP2GeoLoc(ip, key):
+def IP2GeoLocAPI(ip, key):
 	_url = 'https://api.ipgeolocation.io/ipgeo?apiKey={}&ip={}'.format(key, ip)
 	resp = http.request("GET", _url)
 	resp = json.loads(resp.data.decode("utf-8"))
 	return resp
 
 
+def IP2GeoLoc(ip, key):
+	'''
+	geolocation with GEO_CACHE in front of ipgeolocation.io API
+	'''
+	if GEO_CACHE:
+		with GEO_LATENCY.Labels('cache').Time():
+			resp = GEO_CACHE.Get(ip)
+		if resp:
+			return resp
+
+	_t = time.time()
+	with GEO_LATENCY.Labels('api').Time():
+		resp = IP2GeoLocAPI(ip, key)
+	# do not cache API errors, ie. {'message': 'quota exceeded'}
+	if GEO_CACHE and resp and 'latitude' in resp:
+		GEO_CACHE.Put(ip, resp, time.time() - _t)
+	return resp
+
+
 class JSONEncoder(json.JSONEncoder):
 	def default(self, o):
 		if isinstance(o, datetime.datetime):
@@ -76,7 +87,7 @@ class EnableCors(object):
 			] = "GET, POST, PUT, OPTIONS"
 			bottle.response.headers[
 				"Access-Control-Allow-Headers"
-			] = "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token"
+			] = "Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token, If-None-Match"
 
 			if bottle.request.method != "OPTIONS":
 				# actual request; reply with the actual response
@@ -85,16 +96,89 @@ class EnableCors(object):
 		return _enable_cors
 
 
+class RequestMetrics(object):
+	'''
+	request handling time per route
+	'''
+	name = "request_metrics"
+	api = 2
+
+	def apply(self, fn, context):
+		timer = HTTP_LATENCY.Labels(context.rule)
+		def _timed(*args, **kwargs):
+			with timer.Time():
+				return fn(*args, **kwargs)
+		return _timed
+
+
+OPENS = Metrics.Counter('ssmon_opens_total', 'opened connections stored')
+CLOSES = Metrics.Counter('ssmon_closes_total', 'closed connections stored')
+FILTERED = Metrics.Counter('ssmon_filtered_total', 'events dropped by ip_filters', ['type'])
+GEO_FAILURES = Metrics.Counter('ssmon_geo_failures_total', 'opened connections left without geolocation')
+OPEN_LATENCY = Metrics.Histogram('ssmon_open_seconds', 'HandleOpen time, without geolocation')
+CLOSE_LATENCY = Metrics.Histogram('ssmon_close_seconds', 'HandleClose time')
+GEO_LATENCY = Metrics.Histogram('ssmon_geo_lookup_seconds', 'geolocation lookup time', ['source'])
+HTTP_LATENCY = Metrics.Histogram('ssmon_http_request_seconds', 'HTTP request handling time', ['route'])
+Metrics.Gauge(	'ssmon_active_sessions', 'active sessions', ['server_instance'],
+				function = lambda: { (k,): v for k, v in DB.GetActiveCounts()['COUNT'].items() } if DB else {} )
+Metrics.Gauge(	'ssmon_writer_queue', 'statements waiting for SQLite writer',
+				function = lambda: DB.WriterStats()['queued'] if DB else 0 )
+Metrics.Gauge(	'ssmon_geo_pending', 'connections waiting for geolocation',
+				function = lambda: GEO_ENRICHER.Pending() if GEO_ENRICHER else 0 )
+Metrics.Gauge(	'ssmon_event_subscribers', 'connected live event (SSE) clients',
+				function = lambda: EVENT_HUB.Subscribers() if EVENT_HUB else 0 )
+
+
 application = bottle.app()
 application.install(EnableCors())
+application.install(RequestMetrics())
 DB = None
-IP_FILTERS = []  # filters to exclude IPs, ie 192.168.*.*
+GEO_CACHE = None
+GEO_ENRICHER = None
+EVENT_HUB = None # live events, only with multi threaded server
+BATCH_COMMIT_TIMEOUT = 30.0 # seconds /batch waits for commit, monitor sends batch again after failure
+IP_FILTERS = IpFilter([])  # compiled filters to exclude IPs, ie 192.168.*.*, 10.0.0.0/8
 
 G_NOTIFY_RECIPENTS = []
 
 ######################################################################
 
 
+RESPONSE_CACHE = {} # path -> (data version, etag, body)
+_BOOT_ID = '{:x}'.format( int(time.time()) ) # makes ETags from previous runs invalid
+
+def VersionedCache(fn):
+	'''
+	reuse serialized JSON response until DB.DataVersion() changes
+	respond 304 when client already has current version (If-None-Match)
+	X-Write-Seq header set by fn is cached with response
+	'''
+	def _cached(*args, **kwargs):
+		key = bottle.request.path
+		# read version before computing, so concurrent write invalidates the result
+		version = DB.DataVersion()
+		entry = RESPONSE_CACHE.get(key)
+		if not entry or entry[0] != version:
+			body = fn(*args, **kwargs)
+			etag = '"{}-{}-{:x}"'.format( _BOOT_ID, version, zlib.crc32(body.encode('utf-8')) )
+			entry = (version, etag, body, bottle.response.get_header('X-Write-Seq'))
+			RESPONSE_CACHE[key] = entry
+
+		bottle.response.content_type = "application/json"
+		bottle.response.set_header('ETag', entry[1])
+		if entry[3] is not None:
+			bottle.response.set_header('X-Write-Seq', entry[3])
+		bottle.response.set_header('Cache-Control', 'no-cache')
+		if bottle.request.get_header('If-None-Match') == entry[1]:
+			bottle.response.status = 304
+			return ''
+		return entry[2]
+
+	_cached.__name__ = fn.__name__
+	return _cached
+
+
+
 # i_reg = bottle.request.query
 def GetRequestValueWithDefault(i_req, i_token, i_type, defaultValue):
 	"""
@@ -132,36 +216,96 @@ def GetRequestValueWithDefault(i_req, i_token, i_type, defaultValue):
 ######################################################################
 
 
-@application.route("/ssmon/api/v1/open", method=['POST'])
-def OpenConnection():
-	connection = Connection()
-	connection.C = bottle.request.json
+def IsFiltered(connection):
+	ipf = IP_FILTERS.Match(connection['ip'])
+	if ipf is not None:
+		print("Filter out IP ", connection['ip'], ipf)
+		return True
+	return False
 
-	for ipf in IP_FILTERS:
-		if IpMatch(i_ip=connection['ip'], i_regexp=ipf):
-			print("Filter out IP ", connection['ip'], ipf)
-			return
 
-	try:
-		geoloc = IP2GeoLoc(connection['ip'], cfg()['GEOIP']['key'])
-		if geoloc:
-			connection['lat'] = geoloc['latitude']
-			connection['lon'] = geoloc['longitude']
-			connection['lon'] = geoloc['longitude']
-			connection['country'] = geoloc['country_name']
-			connection['city'] = geoloc['city']
-	except:
-		print(traceback.format_exc())
-		print("Geo Location Failed")
+def PublishEvent(event_type, data):
+	if EVENT_HUB:
+		EVENT_HUB.Publish(event_type, data)
+
+
+def HandleOpen(connection):
+	'''
+	return False if connection was filtered out
+	'''
+	if IsFiltered(connection):
+		FILTERED.Labels('open').Inc()
+		return False
+
+	with OPEN_LATENCY.Time():
+		# store connection without location right away,
+		# lat/lon/country/city are filled later by GEO_ENRICHER
+		seq = DB.OpenConnection(connection)
+		GEO_ENRICHER.Submit(connection)
+	OPENS.Inc()
+	PublishEvent('session_open', {	'server_instance': connection['server_instance'],
+							'ACTIVE': DB.GetActiveCounts(), 'seq': seq })
+	return True
+
+
+def HandleClose(connection):
+	'''
+	return False if connection was filtered out
+	'''
+	if IsFiltered(connection):
+		FILTERED.Labels('close').Inc()
+		return False
+
+	with CLOSE_LATENCY.Time():
+		# monitor does not know location of connection, take it from DB
+		if not connection['city'] and not connection['country']:
+			geoloc = DB.GetGeoLocation(connection)
+			if geoloc:
+				connection['lat'], connection['lon'], connection['country'], connection['city'] = geoloc
+
+		notify_msg = 'Close {}#{} {}/{} @{}'.format(
+			connection['ip'], connection['server_instance'],
+			connection['city'], connection['country'],
+			datetime.datetime.utcfromtimestamp(connection['duration']).strftime('%H:%M:%S'))
+
+		seq = DB.CloseConnection(connection)
+
+		for nr in G_NOTIFY_RECIPENTS:
+			nr(notify_msg)
+	CLOSES.Inc()
+	PublishEvent('session_close', {	'server_instance': connection['server_instance'],
+							'duration': connection['duration'],
+							'ACTIVE': DB.GetActiveCounts(), 'seq': seq })
+	return True
 
-	DB.OpenConnection(connection)
+
+def OnGeoLocated(connection):
+	'''
+	called by GEO_ENRICHER worker when geolocation of opened connection is done
+	'''
+	if 'lat' in connection:
+		seq = DB.UpdateGeoLocation(connection)
+		# new map point, or +1 for existing one (and its country / city)
+		PublishEvent('geo', {	'lat': connection['lat'], 'lon': connection['lon'],
+								'country': connection['country'], 'city': connection['city'], 'seq': seq })
+	else:
+		GEO_FAILURES.Inc()
 
 	notify_msg = 'Open {}#{} {}/{}'.format(
 		connection['ip'], connection['server_instance'], connection['city'], connection['country'])
 	for nr in G_NOTIFY_RECIPENTS:
 		nr(notify_msg)
 
-	# return connection updated with geolocation info
+
+@application.route("/ssmon/api/v1/open", method=['POST'])
+def OpenConnection():
+	connection = Connection()
+	connection.C = bottle.request.json
+
+	if not HandleOpen(connection):
+		return
+
+	# acknowledge with stored connection
 	bottle.response.content_type = "application/javascript"
 	return connection.json()
 
@@ -170,21 +314,45 @@ def OpenConnection():
 def CloseConnection():
 	connection = Connection()
 	connection.C = (bottle.request.json)
+	HandleClose(connection)
+
+
+@application.route("/ssmon/api/v1/batch", method=['POST'])
+def Batch():
+	'''
+	array of events, applied in order:
+	[ {"type": "open"|"close", "connection": {...}}, ... ]
+	'''
+	events = bottle.request.json
+	if not isinstance(events, list):
+		bottle.response.status = 400
+		return 'expected JSON array of events'
+
+	res = {'accepted': 0, 'filtered': 0, 'bad': 0}
+	for ev in events:
+		try:
+			connection = Connection()
+			connection.C = ev['connection']
+			if ev['type'] == 'open':
+				handled = HandleOpen(connection)
+			elif ev['type'] == 'close':
+				handled = HandleClose(connection)
+			else:
+				res['bad'] += 1
+				continue
+		except:
+			print(traceback.format_exc())
+			res['bad'] += 1
+			continue
+		res['accepted' if handled else 'filtered'] += 1
 
-	for ipf in IP_FILTERS:
-		if IpMatch(i_ip=connection['ip'], i_regexp=ipf):
-			print("Filter out IP ", connection['ip'], ipf)
-			return
-
-	notify_msg = 'Close {}#{} {}/{} @{}'.format(
-		connection['ip'], connection['server_instance'],
-		connection['city'], connection['country'],
-		datetime.datetime.utcfromtimestamp(connection['duration']).strftime('%H:%M:%S'))
-
-	DB.CloseConnection(connection)
+	# monitor drops acknowledged events from its journal, so accepted has to mean committed
+	if not DB.Flush(timeout = BATCH_COMMIT_TIMEOUT):
+		bottle.response.status = 503
+		return 'DB commit failed or timed out'
 
-	for nr in G_NOTIFY_RECIPENTS:
-		nr(notify_msg)
+	bottle.response.content_type = "application/json"
+	return JSONEncoder().encode(res)
 
 
 ######################################################################
@@ -197,9 +365,11 @@ def CloseConnection():
 
 
 @application.route("/ssmon/api/v1/GetConnectionCounts", method=['GET'])
+@VersionedCache
 def GetConnectionCounts():
 	bottle.response.content_type = "application/json"
 	res = DB.GetConnectionCounts()
+	bottle.response.set_header('X-Write-Seq', str(res.pop('SEQ')))
 	res['country'].sort(key=lambda x: x[1], reverse=True)
 	res['city'].sort(key=lambda x: x[1], reverse=True)
 	return JSONEncoder().encode(res)
@@ -207,10 +377,54 @@ def GetConnectionCounts():
 @application.route("/ssmon/api/v1/active", method=['GET'])
 def GetActive():
 	bottle.response.content_type = "application/json"
-	res = DB.GetConnectionCounts()['ACTIVE']
+	res = DB.GetActive()
 	return JSONEncoder().encode(res)
 
+@application.route("/ssmon/api/v1/geocache", method=['GET'])
+def GetGeoCacheStats():
+	bottle.response.content_type = "application/json"
+	res = GEO_CACHE.Stats() if GEO_CACHE else {}
+	return JSONEncoder().encode(res)
+
+@application.route("/ssmon/api/v1/writer", method=['GET'])
+def GetWriterStats():
+	bottle.response.content_type = "application/json"
+	res = DB.WriterStats()
+	return JSONEncoder().encode(res)
+
+@application.route("/ssmon/api/v1/metrics", method=['GET'])
+def GetMetrics():
+	bottle.response.content_type = Metrics.CONTENT_TYPE
+	return Metrics.REGISTRY.Expose()
+
+@application.route("/ssmon/api/v1/events", method=['GET'])
+def Events():
+	'''
+	Server-Sent Events stream of deltas:
+		session_open  - {server_instance, ACTIVE: {TOTAL, COUNT: {server_instance: count}}, seq}
+		geo           - {lat, lon, country, city, seq} of geolocated connection
+		session_close - {server_instance, duration, ACTIVE, seq}
+		reset         - client missed events and should fetch full state again
+	seq is sequence number of DB write of event, /GetConnectionCounts and /location
+	return X-Write-Seq header - events with seq up to it are already counted in response
+	'''
+	if EVENT_HUB is None:
+		bottle.response.status = 503
+		return 'live events need threaded or asyncio server'
+
+	sub = EVENT_HUB.Subscribe( bottle.request.get_header('Last-Event-ID') )
+	if sub is None:
+		bottle.response.status = 503
+		bottle.response.set_header('Retry-After', '30')
+		return 'too many live event clients'
+
+	bottle.response.content_type = 'text/event-stream'
+	bottle.response.set_header('Cache-Control', 'no-cache')
+	bottle.response.set_header('X-Accel-Buffering', 'no') # do not buffer in nginx
+	return EVENT_HUB.Stream(sub)
+
 @application.route("/ssmon/api/v1/GetConnectionStats", method=['GET'])
+@VersionedCache
 def GetConnectionStats():
 	bottle.response.content_type = "application/json"
 	res = DB.GetConnectionStats()
@@ -218,6 +432,7 @@ def GetConnectionStats():
 
 
 @application.route("/ssmon/api/v1/country", method=['GET'])
+@VersionedCache
 def GetCountries():
 	bottle.response.content_type = "application/json"
 	res = DB.GetConnectionCounts()['country']
@@ -226,6 +441,7 @@ def GetCountries():
 
 
 @application.route("/ssmon/api/v1/city", method=['GET'])
+@VersionedCache
 def GetCities():
 	bottle.response.content_type = "application/json"
 	res = DB.GetConnectionCounts()['city']
@@ -233,40 +449,65 @@ def GetCities():
 	return JSONEncoder().encode(res)
 
 
+@application.route("/ssmon/api/v1/history", method=['GET'])
+def GetHistory():
+	'''
+	connections started in time range, paged
+	?from=2020-01-01&to=2020-02-01&server_instance=hf.config&country=Poland&ip=<ip hash>&limit=100
+	next page: same query with &after=<next from previous page>
+	'''
+	q = bottle.request.query
+	_str_or_none = lambda token: GetRequestValueWithDefault(q, token, str, '') or None
+	ip_hash = GetRequestValueWithDefault(q, 'ip', int, 0) or None
+	after = GetRequestValueWithDefault(q, 'after', int, -1)
+	limit = GetRequestValueWithDefault(q, 'limit', int, 100)
+	limit = max(1, min(limit, 1000))
+
+	try:
+		res = DB.GetHistory(time_from = _str_or_none('from'),
+							time_to = _str_or_none('to'),
+							server_instance = _str_or_none('server_instance'),
+							country = _str_or_none('country'),
+							ip_hash = ip_hash,
+							after = after if after >= 0 else None,
+							limit = limit)
+	except ValueError as e:
+		bottle.response.status = 400
+		res = {'error': str(e)}
+
+	bottle.response.content_type = "application/json"
+	return JSONEncoder().encode(res)
+
+
+@application.route("/ssmon/api/v1/export", method=['GET'])
+def Export():
+	'''
+	stream whole connections table, IPs hashed
+	?format=ndjson|csv&gzip=1
+	'''
+	fmt = GetRequestValueWithDefault(bottle.request.query, 'format', str, 'ndjson')
+	gzip = GetRequestValueWithDefault(bottle.request.query, 'gzip', bool, False)
+	if fmt not in ExportDB.FORMATS:
+		bottle.response.status = 400
+		return 'format should be one of: ' + ', '.join(ExportDB.FORMATS)
+
+	bottle.response.content_type = "application/x-ndjson" if fmt == 'ndjson' else "text/csv"
+	bottle.response.set_header('Content-Disposition', 'attachment; filename="connections.{}"'.format(fmt))
+	if gzip:
+		bottle.response.set_header('Content-Encoding', 'gzip')
+	return ExportDB.Export(DB.File(), fmt, gzip = gzip, hash_ip = True)
+
+
 @application.route("/ssmon/api/v1/location", method=['GET'])
+@VersionedCache
 def GetLocations():
 	bottle.response.content_type = "application/json"
 
-	data = DB.GetConnectionCountsFull()
-	data = data['ip']
-	# data = [
-	#     {'lat': x[8], 'lon': x[9], 'count': x[12], 'country': x[10], 'city': x[11]} for x in res
-	# ]
-
-	# multiple IPs will have the same lat/lon position from geolocation API
-	# and will overlap on the map
-	# therefore, accumulate connections count for each lat/lon point
-	res = {}
-	for d in data:
-		try:
-			lat_lon = (d[8], d[9])
-			if lat_lon not in res:
-				res[lat_lon] = {
-					'count':    d[12],
-					'city':     d[11],
-					'country':  d[10],
-					'lat': lat_lon[0],
-					'lon': lat_lon[1]
-				}
-			else:
-				res[lat_lon]['count'] += d[12]
-		except:
-			# print(d)
-			pass
-
-	res = list( res.values() )
+	# points are aggregated by lat/lon in DB (agg_locations)
+	res = DB.GetLocations()
+	bottle.response.set_header('X-Write-Seq', str(res['SEQ']))
 
-	return JSONEncoder().encode(res)
+	return JSONEncoder().encode(res['POINTS'])
 
 
 @application.route('/static/<path:path>')
@@ -281,12 +522,67 @@ def Root():
 
 ######################################################################
 
+class ThreadedServer(bottle.ServerAdapter):
+	'''
+	wsgiref server handling each request in a pool of threads
+	options: threads - pool size
+	'''
+	def run(self, handler):
+		from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+		from concurrent.futures import ThreadPoolExecutor
+
+		pool = ThreadPoolExecutor( max_workers = self.options.get('threads', 16) )
+
+		class PoolWSGIServer(WSGIServer):
+			request_queue_size = 128
+
+			def process_request(self, request, client_address):
+				pool.submit(self.process_request_thread, request, client_address)
+
+			def process_request_thread(self, request, client_address):
+				try:
+					self.finish_request(request, client_address)
+				except Exception:
+					self.handle_error(request, client_address)
+				finally:
+					self.shutdown_request(request)
+
+		class QuietHandler(WSGIRequestHandler):
+			def log_request(*args, **kw):
+				pass
+
+		handler_class = QuietHandler if self.quiet else WSGIRequestHandler
+		srv = make_server(self.host, self.port, handler, PoolWSGIServer, handler_class)
+		try:
+			srv.serve_forever()
+		finally:
+			srv.server_close()
+			pool.shutdown(wait = False)
+
+
+# [DB] server values -> bottle server adapters
+# any other value is passed to bottle as is (ie. waitress, paste)
+SERVERS = {
+	'wsgiref': 'wsgiref', # single threaded
+	'threaded': ThreadedServer,
+	'asyncio': 'aiohttp', # needs aiohttp and aiohttp_wsgi packages
+}
+
+
 def RUN(hostname="0.0.0.0",
 		port=8080,
 		debug=False,
-		reloader=False):
+		reloader=False,
+		server='threaded',
+		threads=16,
+		quiet=False):
 
-	bottle.run(host=hostname, port=port, debug=debug, reloader=reloader)
+	_kw = {}
+	if server == 'threaded':
+		_kw['threads'] = threads
+	bottle.run(	server=SERVERS.get(server, server),
+				host=hostname, port=port, debug=debug, reloader=reloader, quiet=quiet,
+				**_kw)
 
 
 def CurDir():
@@ -299,37 +595,101 @@ def CurDir():
 	return d
 
 
+def MakeNotifiers(conf):
+	'''
+	notification recipients for config snapshot
+
+	notifications are queued and sent by one Notifier worker,
+	bursts of events are coalesced into one digest message
+	NotifySlack.NotifySlack() will not work with python < 3.6 - and armbian 5.7
+	in that case each digest is sent by executing NotifySlack.py with python 2
+	'''
+	recipients = []
+	if 'SLACK' in conf and conf.SLACK.use:
+		_key = conf.SLACK.key
+		_chan = conf.SLACK.channel
+		if NotifySlack.Available():
+			_send = NotifySlack(_key, _chan).Notify
+		else:
+			_send = lambda msg: subprocess.call(['./NotifySlack.py', _key, _chan, msg])
+		recipients.append( Notifier(	_send,
+										window = conf.SLACK.window,
+										max_per_minute = conf.SLACK.max_per_minute,
+										queue_size = conf.SLACK.queue_size ) )
+		print("Adding slack notifications on channel ", _chan)
+	return recipients
+
+
+def MakeGeoResolver(conf):
+	if conf.GEOIP.backend == 'offline':
+		# local lookups are cheaper than cache, no GEO_CACHE here
+		_ranges = GeoIPRanges.LoadOrCompile( conf.GEOIP.ranges_csv, conf.GEOIP.ranges_index )
+		print("Offline geolocation: ", len(_ranges), 'IP ranges')
+		_timer = GEO_LATENCY.Labels('offline')
+		def _lookup(ip):
+			with _timer.Time():
+				return _ranges.Lookup(ip)
+		return _lookup
+	_key = conf.GEOIP.key
+	return lambda ip: IP2GeoLoc(ip, _key)
+
+
+def OnConfigReload(new, old):
+	'''
+	apply reloaded config - ip filters, notifications and geolocation backend
+	other settings need restart
+	'''
+	global IP_FILTERS
+	IP_FILTERS = new.DB.ip_filter
+	print("Config reloaded, IP Filters: ", IP_FILTERS)
+
+	global G_NOTIFY_RECIPENTS
+	if new.get('SLACK') != old.get('SLACK'):
+		prev = G_NOTIFY_RECIPENTS
+		G_NOTIFY_RECIPENTS = MakeNotifiers(new)
+		for nr in prev:
+			if isinstance(nr, Notifier):
+				nr.Stop()
+
+	_geo_keys = ['backend', 'key', 'ranges_csv', 'ranges_index']
+	if [new.GEOIP.get(k) for k in _geo_keys] != [old.GEOIP.get(k) for k in _geo_keys]:
+		GEO_ENRICHER.SetResolver( MakeGeoResolver(new) )
+		print("Geolocation backend: ", new.GEOIP.backend)
+
+	_static = [	('DB', 'file'), ('DB', 'ip'), ('DB', 'port'), ('DB', 'server'), ('DB', 'threads'),
+				('DB', 'batch_size'), ('DB', 'flush_interval'), ('DB', 'synchronous'),
+				('DB', 'events_max_clients'), ('DB', 'events_queue'), ('DB', 'events_keepalive'),
+				('GEOIP', 'cache_file'), ('GEOIP', 'cache_ttl'), ('GEOIP', 'cache_size'), ('GEOIP', 'workers') ]
+	for section, key in _static:
+		if new[section].get(key) != old[section].get(key):
+			print("Config reload: {}/{} changed, restart to apply".format(section, key))
+
+
+def OnTerminate(signum, frame):
+	raise KeyboardInterrupt()
+
+
 def main():
 
 	# load config
 	config_file = './user.ini'
 	if len(sys.argv) > 1:
 		config_file = sys.argv[1]
-	cfg(config_file)
-	pprint(cfg())
+	conf = cfg(config_file)
+	pprint(conf)
 	print("\n")
 
-	dbfile = cfg()['DB']['file']
-	host = cfg()['DB']['ip']
-	port = int( cfg()['DB']['port'] )
+	dbfile = conf.DB.file
+	host = conf.DB.ip
+	port = int( conf.DB.port )
 
 	global IP_FILTERS
-	IP_FILTERS = cfg()['DB']['ip_filters']
+	IP_FILTERS = conf.DB.ip_filter
 
 	# notifiers
 	global G_NOTIFY_RECIPENTS
-
-	# G_NOTIFY_RECIPENTS = [ NotifySlack() ]
-	# NotifySlack.NotifySlack() will not work with python < 3.6 - and armbian 5.7
-	# therefore use system call to execute with python 2
-	if 'SLACK' in cfg() and cfg()['SLACK']['use']:
-		_key = cfg()['SLACK']['key']
-		_chan = cfg()['SLACK']['channel']
-		_cmd = './NotifySlack.py {} {} '.format(_key, _chan)
-		G_NOTIFY_RECIPENTS.append( lambda msg: os.system(_cmd + msg) )
-		print("Adding slack notifications on channel ", _chan)
-		print("\n")
-
+	G_NOTIFY_RECIPENTS = MakeNotifiers(conf)
+	print("\n")
 
 	print('{}:{} {}'.format(host, port, dbfile))
 	print('@{}'.format(getpass.getuser()))
@@ -340,8 +700,54 @@ def main():
 	os.chdir(CurDir())
 
 	global DB
-	DB = ConnectionsDB(dbfile)
-	RUN(host, port)
+	DB = ConnectionsDB(	dbfile,
+						batch_size = conf.DB.batch_size,
+						flush_interval = conf.DB.flush_interval,
+						synchronous = conf.DB.synchronous )
+
+	global GEO_CACHE
+	GEO_CACHE = GeoCache(	conf.GEOIP.cache_file,
+							ttl = conf.GEOIP.cache_ttl,
+							max_size = conf.GEOIP.cache_size )
+	print("GeoCache: ", GEO_CACHE.Stats())
+
+	global GEO_ENRICHER
+	GEO_ENRICHER = GeoEnricher(	MakeGeoResolver(conf), OnGeoLocated,
+								workers = conf.GEOIP.workers )
+
+	# every live event client holds one server thread for as long as it is connected,
+	# single threaded wsgiref would serve nothing else
+	global EVENT_HUB
+	if conf.DB.server != 'wsgiref':
+		max_subscribers = conf.DB.events_max_clients
+		if conf.DB.server == 'threaded':
+			# keep at least half of the pool for other requests
+			max_subscribers = min(max_subscribers, conf.DB.threads // 2)
+		EVENT_HUB = EventHub(	queue_size = conf.DB.events_queue,
+								keepalive = conf.DB.events_keepalive,
+								max_subscribers = max_subscribers )
+		print("Live events: max ", max_subscribers, " clients")
+
+	# kill -HUP <pid> - reload config without restart, active sessions stay in DB
+	cfg_module.OnReload(OnConfigReload)
+	cfg_module.ReloadOnSIGHUP()
+
+	# systemctl stop / kill / Ctrl+C - stop serving (bottle.run returns),
+	# so queued writes are committed below
+	signal.signal(signal.SIGTERM, OnTerminate)
+	signal.signal(signal.SIGINT, OnTerminate)
+
+	try:
+		RUN(host, port, server = conf.DB.server, threads = conf.DB.threads)
+	finally:
+		# end live event streams, so their threads can exit
+		if EVENT_HUB:
+			EVENT_HUB.Close()
+		# send pending notifications, commit queued writes
+		for nr in G_NOTIFY_RECIPENTS:
+			if isinstance(nr, Notifier):
+				nr.Stop()
+		DB.Close()
 
 
 if __name__ == "__main__":
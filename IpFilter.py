@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+'''
+	IP filter compiled once from list of patterns
+
+		192.168.1.10        - single address
+		192.168.*.*         - wildcard octets (IPv6: wildcard groups, all 8 groups written)
+		10.0.0.0/8          - CIDR
+		2001:db8::/32       - IPv6 CIDR, IPv4 mapped IPv6 addresses are matched as IPv4
+
+	Patterns with trailing wildcards and CIDR become integer ranges,
+	merged into one sorted table of disjoint ranges per family - lookup is bisect.
+	Wildcards followed by fixed octets (ie. *.*.*.1) can not be a range,
+	they are kept as (mask, value) pairs and checked one by one.
+
+	./IpFilter.py 192.168.*.*,10.0.0.0/8 10.1.2.3
+'''
+
+import sys
+import bisect
+import socket
+import ipaddress
+
+
+# same as IPy PRIVATE ranges, plus IPv6 unique local and link local
+PRIVATE_RANGES = [	'0.0.0.0/8', '10.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12', '192.168.0.0/16',
+					'fc00::/7', 'fe80::/10' ]
+
+
+def _ParseWildcard(pattern):
+	'''
+	return (bits, mask, value) of wildcard pattern
+	'''
+	if ':' in pattern:
+		bits, token_bits, sep, base = 128, 16, ':', 16
+	else:
+		bits, token_bits, sep, base = 32, 8, '.', 10
+	tokens = pattern.split(sep)
+	if len(tokens) != bits // token_bits:
+		raise ValueError('Bad IP filter: ' + pattern)
+
+	mask = 0
+	value = 0
+	for t in tokens:
+		mask <<= token_bits
+		value <<= token_bits
+		if t == '*':
+			continue
+		v = int(t, base)
+		if v < 0 or v >= (1 << token_bits):
+			raise ValueError('Bad IP filter: ' + pattern)
+		mask |= (1 << token_bits) - 1
+		value |= v
+	return bits, mask, value
+
+
+def _IsPrefixMask(mask, bits):
+	'''
+	ones followed by zeros only
+	'''
+	inv = ~mask & ((1 << bits) - 1)
+	return inv & (inv + 1) == 0
+
+
+class IpFilter():
+	'''
+	immutable - safe to share between threads
+	'''
+	def __init__(self, patterns):
+		self.__patterns = [ p.strip() for p in patterns if p and p.strip() ]
+		ranges = { 32: [], 128: [] } # bits -> [(start, end, pattern)]
+		self.__masks = { 32: [], 128: [] } # bits -> [(mask, value, pattern)]
+
+		for p in self.__patterns:
+			if '*' in p:
+				bits, mask, value = _ParseWildcard(p)
+				if _IsPrefixMask(mask, bits):
+					ranges[bits].append( (value, value | (~mask & ((1 << bits) - 1)), p) )
+				else:
+					self.__masks[bits].append( (mask, value, p) )
+			else:
+				try:
+					net = ipaddress.ip_network(p, strict = False)
+				except ValueError:
+					raise ValueError('Bad IP filter: ' + p)
+				ranges[net.max_prefixlen].append( (int(net.network_address), int(net.broadcast_address), p) )
+
+		self.__starts = {}
+		self.__ends = {}
+		self.__labels = {}
+		for bits, rr in ranges.items():
+			starts, ends, labels = [], [], []
+			for start, end, p in sorted(rr):
+				if ends and start <= ends[-1] + 1:
+					# overlapping or adjacent - extend previous range
+					if end > ends[-1]:
+						ends[-1] = end
+					labels[-1] += ',' + p
+					continue
+				starts.append(start)
+				ends.append(end)
+				labels.append(p)
+			self.__starts[bits] = starts
+			self.__ends[bits] = ends
+			self.__labels[bits] = labels
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __len__(self):
+		return len(self.__patterns)
+
+	def __repr__(self):
+		return 'IpFilter({})'.format(self.__patterns)
+
+	def Patterns(self):
+		return list(self.__patterns)
+
+	def Match(self, ip):
+		'''
+		return matching pattern(s) or None, None also for not valid IP
+		'''
+		try:
+			if ':' in ip:
+				n = int.from_bytes( socket.inet_pton(socket.AF_INET6, ip), 'big' )
+				if n >> 32 == 0xffff:
+					n &= 0xffffffff # IPv4 mapped
+					bits = 32
+				else:
+					bits = 128
+			else:
+				n = int.from_bytes( socket.inet_pton(socket.AF_INET, ip), 'big' )
+				bits = 32
+		except (OSError, TypeError):
+			return None
+
+		starts = self.__starts[bits]
+		i = bisect.bisect_right(starts, n) - 1
+		if i >= 0 and n <= self.__ends[bits][i]:
+			return self.__labels[bits][i]
+
+		for mask, value, p in self.__masks[bits]:
+			if n & mask == value:
+				return p
+		return None
+
+	def __contains__(self, ip):
+		return self.Match(ip) is not None
+
+
+PRIVATE = IpFilter(PRIVATE_RANGES)
+
+def IsPrivate(ip):
+	return PRIVATE.Match(ip) is not None
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		print(__doc__)
+		sys.exit(1)
+	f = IpFilter( sys.argv[1].split(',') )
+	for ip in sys.argv[2:]:
+		print(ip, f.Match(ip))
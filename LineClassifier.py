@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import re
+import collections
+
+
+# event types
+CONNECT = 'connect'
+DISCONNECT = 'disconnect'
+RTL_GARBAGE = 'rtl_garbage'
+OTHER = 'other'
+
+LineEvent = collections.namedtuple('LineEvent', ['type', 'groups', 'line'])
+
+
+class LineClassifier():
+	'''
+	classify spyserver output lines in one pass
+
+	Whole line rules (exact = True) are one dict lookup returning prebuilt event.
+	Other rules are dispatched on first character of the line,
+	then checked with str.startswith(prefix) and precompiled pattern (if any).
+	First matching rule wins, lines matching no rule are OTHER.
+	'''
+	def __init__(self):
+		self.__exact = {} # whole line -> LineEvent
+		self.__rules = {} # first char -> [(prefix, compiled pattern or None, type)]
+
+	def Register(self, event_type, prefix, pattern = None, exact = False):
+		'''
+		event_type - returned as LineEvent.type
+		prefix - literal start of the line, not empty
+		pattern - optional regexp matched from line start, its groups are LineEvent.groups
+		exact - prefix is the whole line (ie. repeated noise), pattern is not used
+		'''
+		if not prefix:
+			raise ValueError('Rule prefix can not be empty')
+		if exact:
+			self.__exact.setdefault( prefix, LineEvent(event_type, (), prefix) )
+		if pattern is not None and not hasattr(pattern, 'match'):
+			pattern = re.compile(pattern)
+		self.__rules.setdefault(prefix[0], []).append( (prefix, pattern, event_type) )
+
+	def Classify(self, line):
+		ev = self.__exact.get(line)
+		if ev is not None:
+			return ev
+		for prefix, pattern, event_type in self.__rules.get(line[:1], ()):
+			if not line.startswith(prefix):
+				continue
+			if pattern is None:
+				return LineEvent(event_type, (), line)
+			m = pattern.match(line)
+			if m:
+				return LineEvent(event_type, m.groups(), line)
+		return LineEvent(OTHER, (), line)
+
+
+def SpyServerClassifier():
+	'''
+	classifier for spyserver output
+	'''
+	lc = LineClassifier()
+	lc.Register(RTL_GARBAGE, '[R82XX] PLL not locked!', exact = True)
+	lc.Register(RTL_GARBAGE, 'Found Rafael Micro R820T tuner', exact = True)
+	lc.Register(CONNECT, 'Accepted client ',
+				r'Accepted client (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\:(\d+) running SDR# (.+) on (.+)')
+	lc.Register(DISCONNECT, 'Client disconnected: ',
+				r'Client disconnected: (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\:(\d+).*')
+	return lc
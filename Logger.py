@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+'''
+	structured log with background writer
+
+	Log() only checks level and puts (time, level, source, args, fields) on a bounded queue,
+	formatting and writing is done by one writer thread in batches:
+		- JSON lines file, rotated by size: <file>, <file>.1 ... <file>.<backup_count>
+		- optional colored console, one color per source
+
+	JSON record: {"ts": "2020-01-01T12:00:00.123Z", "level": "info", "source": "...", "msg": "...", <fields>}
+
+	./Logger.py ./monitor.log.jsonl [level] [source]   - print records from log file
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import datetime
+import threading
+import traceback
+
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+C_OFF = "\033[0m"
+COLORS = ["\033[1;31m", "\033[1;35m", "\033[1;32m", "\033[1;36m", "\033[1;34m"]
+LEVEL_COLORS = {'warning': "\033[1;33m", 'error': "\033[1;31m"}
+
+
+def _LevelNo(level):
+	try:
+		return LEVELS[level.lower()]
+	except KeyError:
+		raise ValueError('Unknown log level: ' + str(level))
+
+
+class Logger():
+	'''
+	file - JSON lines log file, None for no file
+	level - records below this level are dropped in Log()
+	console - also print records to stdout, console_level can be higher than level
+	'''
+	BATCH = 500
+
+	def __init__(self, file = None, level = 'info', console = True, console_level = None,
+					max_bytes = 10 * 1024 * 1024, backup_count = 5, queue_size = 10000):
+		self.__file_name = file
+		self.__level = _LevelNo(level)
+		self.__console = console
+		self.__console_level = _LevelNo(console_level) if console_level else self.__level
+		self.__max_bytes = max_bytes
+		self.__backup_count = backup_count
+		self.__queue = queue.Queue(maxsize = queue_size)
+		self.__colors = {} # source -> console color
+		self.__file = None
+
+		self.__written = 0
+		self.__dropped = 0
+		self.__rotations = 0
+
+		if self.__file_name:
+			d = os.path.dirname(self.__file_name)
+			if d and not os.path.isdir(d):
+				os.makedirs(d)
+			self.__file = open(self.__file_name, 'a', encoding = 'utf-8')
+
+		self.__thread = threading.Thread(target = self.__run__, name = 'Logger')
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	def Enabled(self, level):
+		return LEVELS[level] >= self.__level
+
+	def Log(self, level, source, *args, **fields):
+		'''
+		args are converted with str() and joined by the writer thread
+		fields are added to JSON record as they are
+		'''
+		if LEVELS[level] < self.__level:
+			return
+		try:
+			self.__queue.put_nowait( (time.time(), level, source, args, fields) )
+		except queue.Full:
+			self.__dropped += 1
+
+	def Debug(self, source, *args, **fields):
+		self.Log('debug', source, *args, **fields)
+
+	def Info(self, source, *args, **fields):
+		self.Log('info', source, *args, **fields)
+
+	def Warning(self, source, *args, **fields):
+		self.Log('warning', source, *args, **fields)
+
+	def Error(self, source, *args, **fields):
+		self.Log('error', source, *args, **fields)
+
+	def Exception(self, source, *args, **fields):
+		'''
+		error with current exception traceback, call from except block
+		'''
+		self.Log('error', source, *args, traceback = traceback.format_exc(), **fields)
+
+	def Stop(self):
+		'''
+		write what is queued and stop writer
+		'''
+		self.__queue.put(None)
+		self.__thread.join()
+
+	def Stats(self):
+		return {
+			'pending': self.__queue.qsize(),
+			'written': self.__written,
+			'dropped': self.__dropped,
+			'rotations': self.__rotations
+		}
+
+	def __run__(self):
+		while True:
+			rec = self.__queue.get()
+			batch = [rec]
+			while rec is not None and len(batch) < self.BATCH:
+				try:
+					rec = self.__queue.get_nowait()
+				except queue.Empty:
+					break
+				batch.append(rec)
+
+			stop = batch[-1] is None
+			if stop:
+				batch.pop()
+			try:
+				self.__write(batch)
+			except:
+				print(traceback.format_exc())
+			if stop:
+				if self.__file:
+					self.__file.close()
+				return
+
+	def __write(self, batch):
+		lines = []
+		console = []
+		for t, level, source, args, fields in batch:
+			msg = ''.join( map(str, args) )
+			if self.__file:
+				ts = datetime.datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+				record = {'ts': ts, 'level': level, 'source': source, 'msg': msg}
+				record.update(fields)
+				lines.append( json.dumps(record, default = str) )
+			if self.__console and LEVELS[level] >= self.__console_level:
+				console.append( self.__consoleLine(t, level, source, msg, fields) )
+
+		if lines:
+			self.__file.write( '\n'.join(lines) + '\n' )
+			self.__file.flush()
+			if self.__file.tell() >= self.__max_bytes:
+				self.__rotate()
+		if console:
+			sys.stdout.write( '\n'.join(console) + '\n' )
+			sys.stdout.flush()
+		self.__written += len(batch)
+
+	def __consoleLine(self, t, level, source, msg, fields):
+		color = self.__colors.get(source)
+		if color is None:
+			color = self.__colors[source] = COLORS[ len(self.__colors) % len(COLORS) ]
+		color = LEVEL_COLORS.get(level, color)
+		now = datetime.datetime.utcfromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+		line = '{}{} {} ==> {}{}'.format(color, now, source, msg, C_OFF)
+		if 'traceback' in fields:
+			line += '\n' + fields['traceback']
+		return line
+
+	def __rotate(self):
+		self.__file.close()
+		if self.__backup_count > 0:
+			for i in range(self.__backup_count - 1, 0, -1):
+				src = '{}.{}'.format(self.__file_name, i)
+				if os.path.isfile(src):
+					os.replace( src, '{}.{}'.format(self.__file_name, i + 1) )
+			os.replace( self.__file_name, self.__file_name + '.1' )
+		else:
+			os.remove(self.__file_name)
+		self.__file = open(self.__file_name, 'a', encoding = 'utf-8')
+		self.__rotations += 1
+
+
+_LOGGER = None
+
+def Setup(**kwargs):
+	'''
+	(re)create process wide logger, see Logger arguments
+	'''
+	global _LOGGER
+	if _LOGGER is not None:
+		_LOGGER.Stop()
+	_LOGGER = Logger(**kwargs)
+	return _LOGGER
+
+def Get():
+	'''
+	process wide logger, console only until Setup() is called
+	'''
+	global _LOGGER
+	if _LOGGER is None:
+		_LOGGER = Logger()
+	return _LOGGER
+
+
+def Query(file, level = 'debug', source = None):
+	'''
+	yield records from JSON lines log file with at least level, optionally of one source
+	'''
+	min_level = _LevelNo(level)
+	with open(file, encoding = 'utf-8') as f:
+		for line in f:
+			try:
+				rec = json.loads(line)
+			except ValueError:
+				continue
+			if LEVELS.get(rec.get('level'), 0) < min_level:
+				continue
+			if source is not None and rec.get('source') != source:
+				continue
+			yield rec
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	level = sys.argv[2] if len(sys.argv) > 2 else 'debug'
+	source = sys.argv[3] if len(sys.argv) > 3 else None
+	for rec in Query(sys.argv[1], level, source):
+		print( json.dumps(rec) )
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+'''
+	counters, gauges and histograms in Prometheus text format
+
+		OPENS = Metrics.Counter('ssmon_opens_total', 'opened connections')
+		OPENS.Inc()
+		LATENCY = Metrics.Histogram('ssmon_open_seconds', 'HandleOpen latency', ['route'])
+		with LATENCY.Labels('/open').Time():
+			...
+		Metrics.Gauge('ssmon_active_sessions', 'active sessions', ['server_instance'],
+						function = lambda: {('hf.config',): 3})
+
+	Metrics register in REGISTRY, REGISTRY.Expose() returns text for /metrics.
+	Gauge functions are called on every scrape.
+'''
+
+import time
+import bisect
+import threading
+import collections
+import contextlib
+import http.server
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from 0.1ms (dict lookups, queue puts) up to 10s (HTTP calls)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _Escape(v):
+	return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _LabelText(names, values, extra = ''):
+	pairs = [ '{}="{}"'.format(n, _Escape(v)) for n, v in zip(names, values) ]
+	if extra:
+		pairs.append(extra)
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _Number(v):
+	if v == float('inf'):
+		return '+Inf'
+	if isinstance(v, float) and v.is_integer() and abs(v) < 1e15:
+		return str(int(v))
+	return repr(v) if isinstance(v, float) else str(v)
+
+
+class Registry():
+	def __init__(self):
+		self.__metrics = collections.OrderedDict()
+		self.__lock = threading.Lock()
+
+	def Register(self, metric):
+		'''
+		return registered metric - existing one when metric of same name and type is registered
+		(ie. module loaded twice, as __main__ and by import)
+		'''
+		with self.__lock:
+			existing = self.__metrics.get(metric.name)
+			if existing is not None:
+				if existing.TYPE != metric.TYPE or existing.labels != metric.labels:
+					raise ValueError('Metric already registered: ' + metric.name)
+				return existing
+			self.__metrics[metric.name] = metric
+		return metric
+
+	def Get(self, name):
+		return self.__metrics.get(name)
+
+	def Expose(self):
+		lines = []
+		for metric in list(self.__metrics.values()):
+			lines.append( '# HELP {} {}'.format(metric.name, metric.help) )
+			lines.append( '# TYPE {} {}'.format(metric.name, metric.TYPE) )
+			lines.extend( metric.Samples() )
+		return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Child():
+	'''
+	metric bound to label values
+	'''
+	def __init__(self, metric, labels):
+		self.__metric = metric
+		self.__labels = labels
+
+	def Inc(self, amount = 1):
+		self.__metric._Inc(self.__labels, amount)
+
+	def Dec(self, amount = 1):
+		self.__metric._Inc(self.__labels, -amount)
+
+	def Set(self, value):
+		self.__metric._Set(self.__labels, value)
+
+	def Observe(self, value):
+		self.__metric._Observe(self.__labels, value)
+
+	def Time(self):
+		return self.__metric._Time(self.__labels)
+
+
+class _Metric():
+	TYPE = 'untyped'
+
+	def __init__(self, name, help, labels = (), registry = REGISTRY):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self._lock = threading.Lock()
+		self._values = {} # label values tuple -> value
+		self.__children = {}
+		self._registered = self
+		if registry is not None:
+			self._registered = registry.Register(self)
+			# duplicate definition shares values of registered metric
+			self._lock = self._registered._lock
+			self._values = self._registered._values
+
+	def Labels(self, *values):
+		if len(values) != len(self.labels):
+			raise ValueError('{} expects labels {}'.format(self.name, self.labels))
+		child = self.__children.get(values)
+		if child is None:
+			child = self.__children.setdefault( values, _Child(self, tuple(str(v) for v in values)) )
+		return child
+
+	def Value(self, *labels):
+		return self._values.get(tuple(str(v) for v in labels))
+
+
+class Counter(_Metric):
+	TYPE = 'counter'
+
+	def Inc(self, amount = 1):
+		self._Inc((), amount)
+
+	def _Inc(self, labels, amount):
+		with self._lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+
+	def Samples(self):
+		with self._lock:
+			items = sorted(self._values.items())
+		return [ '{}{} {}'.format(self.name, _LabelText(self.labels, k), _Number(v)) for k, v in items ]
+
+
+class Gauge(_Metric):
+	'''
+	set explicitly, or computed on scrape by function
+	function returns number (no labels) or {label values tuple: number}
+	'''
+	TYPE = 'gauge'
+
+	def __init__(self, name, help, labels = (), registry = REGISTRY, function = None):
+		_Metric.__init__(self, name, help, labels, registry)
+		self.__function = None
+		if function is not None:
+			self.SetFunction(function)
+
+	def SetFunction(self, function):
+		self.__function = function
+		if self._registered is not self:
+			self._registered.SetFunction(function) # latest definition computes exposed value
+
+	def Set(self, value):
+		self._Set((), value)
+
+	def Inc(self, amount = 1):
+		self._Inc((), amount)
+
+	def Dec(self, amount = 1):
+		self._Inc((), -amount)
+
+	def _Set(self, labels, value):
+		with self._lock:
+			self._values[labels] = value
+
+	def _Inc(self, labels, amount):
+		with self._lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+
+	def Samples(self):
+		with self._lock:
+			values = dict(self._values)
+		if self.__function is not None:
+			try:
+				res = self.__function()
+			except Exception:
+				res = {}
+			if isinstance(res, dict):
+				values.update( (tuple(str(v) for v in k), n) for k, n in res.items() )
+			elif res is not None:
+				values[()] = res
+		return [ '{}{} {}'.format(self.name, _LabelText(self.labels, k), _Number(v)) for k, v in sorted(values.items()) ]
+
+
+class Histogram(_Metric):
+	TYPE = 'histogram'
+
+	def __init__(self, name, help, labels = (), registry = REGISTRY, buckets = DEFAULT_BUCKETS):
+		_Metric.__init__(self, name, help, labels, registry)
+		self.buckets = tuple(sorted(buckets))
+		if self._registered is not self:
+			self.buckets = self._registered.buckets # shared values are counts of these buckets
+
+	def Observe(self, value):
+		self._Observe((), value)
+
+	def Time(self):
+		'''
+		with h.Time(): ... - observe duration of block in seconds
+		'''
+		return self._Time(())
+
+	@contextlib.contextmanager
+	def _Time(self, labels):
+		t = time.perf_counter()
+		try:
+			yield
+		finally:
+			self._Observe(labels, time.perf_counter() - t)
+
+	def _Observe(self, labels, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			v = self._values.get(labels)
+			if v is None:
+				v = self._values[labels] = [ [0] * (len(self.buckets) + 1), 0.0, 0 ] # counts (last +Inf), sum, count
+			v[0][i] += 1
+			v[1] += value
+			v[2] += 1
+
+	def Snapshot(self, *labels):
+		'''
+		(cumulative counts per bucket incl. +Inf, sum, count) or None
+		'''
+		with self._lock:
+			v = self._values.get(tuple(str(x) for x in labels))
+			if v is None:
+				return None
+			counts, total, count = list(v[0]), v[1], v[2]
+		cumulative = []
+		acc = 0
+		for c in counts:
+			acc += c
+			cumulative.append(acc)
+		return cumulative, total, count
+
+	def Samples(self):
+		with self._lock:
+			keys = sorted(self._values.keys())
+		lines = []
+		for k in keys:
+			cumulative, total, count = self.Snapshot(*k)
+			for le, c in zip( self.buckets + (float('inf'),), cumulative ):
+				lines.append( '{}_bucket{} {}'.format(self.name, _LabelText(self.labels, k, 'le="{}"'.format(_Number(le))), c) )
+			lines.append( '{}_sum{} {}'.format(self.name, _LabelText(self.labels, k), repr(total)) )
+			lines.append( '{}_count{} {}'.format(self.name, _LabelText(self.labels, k), count) )
+		return lines
+
+
+class RateMeter():
+	'''
+	events per second over last `window` seconds, per key
+	counts are kept in one second slots, Mark() is O(1)
+	'''
+	def __init__(self, window = 60):
+		self.__window = window
+		self.__lock = threading.Lock()
+		self.__slots = {} # key -> deque of [second, count]
+
+	def Mark(self, key, n = 1):
+		now = int(time.time())
+		with self.__lock:
+			slots = self.__slots.get(key)
+			if slots is None:
+				slots = self.__slots[key] = collections.deque()
+			if slots and slots[-1][0] == now:
+				slots[-1][1] += n
+			else:
+				slots.append([now, n])
+				while slots[0][0] <= now - self.__window:
+					slots.popleft()
+
+	def Rates(self):
+		'''
+		{(key,): events per second}, usable as Gauge function
+		'''
+		now = int(time.time())
+		res = {}
+		with self.__lock:
+			for key, slots in self.__slots.items():
+				n = sum( c for s, c in slots if s > now - self.__window )
+				res[(key,)] = n / float(self.__window)
+		return res
+
+
+def Serve(host, port, registry = REGISTRY):
+	'''
+	serve GET /metrics from daemon thread, for processes without bottle (SpyServerMonitor)
+	return server, server.server_port is the bound port
+	'''
+	class Handler(http.server.BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split('?')[0] not in ['/metrics', '/ssmon/api/v1/metrics']:
+				self.send_error(404)
+				return
+			body = registry.Expose().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', CONTENT_TYPE)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+
+	srv = http.server.ThreadingHTTPServer( (host, port), Handler )
+	srv.daemon_threads = True
+	t = threading.Thread(target = srv.serve_forever, name = 'MetricsServer')
+	t.daemon = True
+	t.start()
+	return srv
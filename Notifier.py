@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import time
+import queue
+import threading
+import traceback
+
+
+class Notifier():
+	'''
+	Delivers notifications from one long lived worker thread.
+
+	Notify() only enqueues (bounded queue, drops when full).
+	Messages arriving within `window` seconds are coalesced into one digest,
+	and at most `max_per_minute` digests are sent - when over the limit
+	messages keep accumulating into the next digest.
+
+	send(text) - sink, ie. NotifySlack.Notify
+	'''
+	MAX_DIGEST_LINES = 30
+
+	def __init__(self, send, window = 10.0, max_per_minute = 20, queue_size = 1000):
+		self.__send = send
+		self.__window = window
+		self.__min_interval = 60.0 / max_per_minute if max_per_minute else 0.0
+		self.__queue = queue.Queue(maxsize = queue_size)
+		self.__last_send = 0.0
+
+		self.__enqueued = 0
+		self.__dropped = 0
+		self.__sent_digests = 0
+		self.__send_errors = 0
+
+		self.__thread = threading.Thread(target = self.__run__, name = 'Notifier')
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	def Notify(self, msg):
+		try:
+			self.__queue.put_nowait(msg)
+			self.__enqueued += 1
+		except queue.Full:
+			self.__dropped += 1
+
+	# allow Notifier instance to be used as notify recipient callable
+	__call__ = Notify
+
+	def Stop(self):
+		'''
+		send what is pending and stop worker
+		'''
+		self.__queue.put(None)
+		self.__thread.join()
+
+	def Stats(self):
+		return {
+			'pending': self.__queue.qsize(),
+			'enqueued': self.__enqueued,
+			'dropped': self.__dropped,
+			'digests': self.__sent_digests,
+			'errors': self.__send_errors
+		}
+
+	def __run__(self):
+		pending = []
+		stop = False
+		while not stop:
+			msg = self.__queue.get()
+			if msg is None:
+				stop = True
+			else:
+				pending.append(msg)
+
+			# collect until window passes and rate limit allows sending
+			deadline = max( time.time() + self.__window, self.__last_send + self.__min_interval )
+			while not stop:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					msg = self.__queue.get(timeout = timeout)
+				except queue.Empty:
+					break
+				if msg is None:
+					stop = True
+				else:
+					pending.append(msg)
+
+			if pending:
+				self.__deliver(pending)
+				pending = []
+
+	def __deliver(self, messages):
+		if len(messages) == 1:
+			text = messages[0]
+		else:
+			lines = messages[:self.MAX_DIGEST_LINES]
+			text = '{} events:\n'.format(len(messages)) + '\n'.join(lines)
+			if len(messages) > len(lines):
+				text += '\n... and {} more'.format(len(messages) - len(lines))
+
+		self.__last_send = time.time()
+		try:
+			self.__send(text)
+			self.__sent_digests += 1
+		except:
+			self.__send_errors += 1
+			print("Notification failed")
+			print(traceback.format_exc())
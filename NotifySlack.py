@@ -21,29 +21,48 @@ class NotifySlack:
 		if _v.major >= 3 and _v.minor >= 6:
 			self.__py_version = 3
 
+		self.__client = None # created on first Notify and reused
 
-	def Notify(self, msg):
-		if self.__py_version == 3:
-			try:
+
+	@staticmethod
+	def Available():
+		'''
+		True if slack client can be used in this interpreter
+		'''
+		_v = sys.version_info
+		try:
+			if _v.major >= 3 and _v.minor >= 6:
 				from slack import WebClient
-				self.__slack_version = 1
-			except ImportError:
-				print("SLACK API py3 unavailable.")
-				return
-		elif self.__py_version == 2:
-			try:
+			else:
 				from slackclient import SlackClient
-			except ImportError:
-				print("SLACK API py2 unavailable.")
-				return
+			return True
+		except ImportError:
+			return False
+
+
+	def Notify(self, msg):
+		if not self.__client:
+			if self.__py_version == 3:
+				try:
+					from slack import WebClient
+					self.__slack_version = 1
+				except ImportError:
+					print("SLACK API py3 unavailable.")
+					return
+				self.__client = WebClient(self.__key)
+			elif self.__py_version == 2:
+				try:
+					from slackclient import SlackClient
+				except ImportError:
+					print("SLACK API py2 unavailable.")
+					return
+				self.__client = SlackClient(self.__key)
 
 		try:
 			if self.__py_version == 3:
-				sc = WebClient(self.__key)
-				sc.chat_postMessage(channel=self.__channel, text=msg, username='wintermute')
+				self.__client.chat_postMessage(channel=self.__channel, text=msg, username='wintermute')
 			elif self.__py_version == 2:
-				sc = SlackClient(self.__key)
-				sc.api_call("chat.postMessage", channel=self.__channel, text=msg, username='wintermute')
+				self.__client.api_call("chat.postMessage", channel=self.__channel, text=msg, username='wintermute')
 		except:
 			print("Unable to send slack notification!")
 			import traceback
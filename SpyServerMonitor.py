@@ -3,7 +3,6 @@
 import string
 import os
 import sys
-import re
 import datetime
 import pexpect
 import threading
@@ -12,7 +11,6 @@ import inspect
 import json
 import time
 from pprint import pprint, pformat
-from IPy import IP
 
 import urllib
 import urllib3
@@ -21,25 +19,50 @@ http = urllib3.PoolManager()
 
 from cfg import cfg
 
-from ConnectionsDB import Connection
+from ConnectionsDB import Connection, JSONEncoder
 from NotifySlack import NotifySlack
-
-
-C_RED = "\033[1;31m"
-C_GREEN = "\033[1;32m"
-C_BROWN = "\033[1;33m"
-C_BLUE = "\033[1;34m"
-C_MAGENTA = "\033[1;35m"
-C_CYAN = "\033[1;36m"
-C_LIGHTGREY = "\033[1;37m"
-C_OFF = "\033[0m"
-C_CLEAR = "\033[2K"
-
-G_COLORS = [C_RED, C_MAGENTA, C_GREEN, C_CYAN, C_BLUE]
-def next_color():
-	next_color.i = next_color.i+1
-	return G_COLORS[ next_color.i%len(G_COLORS) ]
-next_color.i = -1
+from EventSpool import EventSpool, EventQueue, SpoolShipper
+import LineClassifier
+import Logger
+import IpFilter
+import Metrics
+from Supervisor import RestartBackoff
+
+
+LINES = Metrics.Counter('ssmon_monitor_lines_total', 'spyserver output lines parsed', ['instance'])
+LINE_RATE = Metrics.RateMeter(window = 60)
+Metrics.Gauge(	'ssmon_monitor_lines_per_second', 'spyserver output lines parsed per second, last minute', ['instance'],
+				function = LINE_RATE.Rates )
+EVENTS = Metrics.Counter('ssmon_monitor_events_total', 'open / close events queued for DB', ['instance', 'type'])
+RESTARTS = Metrics.Counter('ssmon_monitor_restarts_total', 'spyserver restarts', ['instance'])
+SEND_LATENCY = Metrics.Histogram('ssmon_monitor_send_seconds', 'POST of event batch to DB')
+DROPPED = Metrics.Counter('ssmon_monitor_events_dropped_total', 'events dropped by full event queue', ['instance'])
+SENT = Metrics.Counter('ssmon_monitor_events_sent_total', 'events accepted by DB', ['instance'])
+SEND_FAILURES = Metrics.Counter('ssmon_monitor_send_failures_total', 'failed POSTs of event batch to DB', ['instance'])
+
+INSTANCES = {} # instance id -> SpyServerMonitor, for gauges
+JOURNALS = {} # instance id -> EventSpool, for gauges (filled by AsyncMonitor in asyncio mode)
+
+def _InstanceGauge(fn):
+	return lambda: { (iid,): fn(m) for iid, m in list(INSTANCES.items()) }
+
+Metrics.Gauge(	'ssmon_monitor_active_sessions', 'sessions open on spyserver', ['instance'],
+				function = _InstanceGauge( lambda m: len(m.connections) ) )
+Metrics.Gauge(	'ssmon_monitor_uptime_seconds', 'current spyserver run time', ['instance'],
+				function = _InstanceGauge( lambda m: m.restarts.Stats()['uptime'] ) )
+Metrics.Gauge(	'ssmon_monitor_last_recovery_seconds', 'spyserver exit to first output of restarted one', ['instance'],
+				function = _InstanceGauge( lambda m: m.restarts.Stats()['last_recovery'] or 0.0 ) )
+
+def _QueueGauge(key):
+	# event queue exists in threads mode only
+	return lambda: { (iid,): s['queue'][key] for iid, s in [ (iid, m.Stats()) for iid, m in list(INSTANCES.items()) ] if 'queue' in s }
+
+Metrics.Gauge(	'ssmon_monitor_queue_depth', 'events waiting in queue for journal writer', ['instance'],
+				function = _QueueGauge('depth') )
+Metrics.Gauge(	'ssmon_monitor_queue_max_depth', 'highest depth of event queue', ['instance'],
+				function = _QueueGauge('max_depth') )
+Metrics.Gauge(	'ssmon_monitor_journal_pending', 'journaled events not accepted by DB yet', ['instance'],
+				function = lambda: { (iid,): len(j) for iid, j in list(JOURNALS.items()) } )
 
 
 class SpyServerMonitor():
@@ -49,7 +72,15 @@ class SpyServerMonitor():
 		Accepted client ...
 		Client disconnected ...
 	'''
-	def __init__(self, spyserver_path, config_file, http_addr_pair, no_lan_skip = False):
+	def __init__(self, spyserver_path, config_file, http_addr_pair, no_lan_skip = False,
+					spool_dir = './spool', spool_batch = 100, spool_fsync = False, retry_interval = 5.0,
+					queue_size = 10000, overflow = 'block', http_timeout = 10.0, event_sink = None,
+					restart_options = None):
+		'''
+		event_sink - callable(event), when given parsed events are passed to it
+			and no queue, spool and shipper thread are created (ie. AsyncMonitor)
+		restart_options - dict of Supervisor.RestartBackoff arguments
+		'''
 		if not os.path.isfile(spyserver_path):
 			raise ValueError('Bad path to spyserver: ', spyserver_path)
 		# if not os.path.isfile(config_file):
@@ -69,7 +100,33 @@ class SpyServerMonitor():
 
 		self.connections = {} # keep active connections (keys) and it's start time (values)
 
-		self.__color = next_color()
+		self.__logger = Logger.Get()
+		self.__lines = LINES.Labels(self.__id)
+		INSTANCES[self.__id] = self
+
+		self.__classifier = LineClassifier.SpyServerClassifier()
+
+		# spyserver is restarted when it exits, until Stop()
+		self.P = None
+		self.restarts = RestartBackoff( **(restart_options or {}) )
+		self.__stop_requested = threading.Event()
+
+		self.__http_timeout = http_timeout
+		self.__event_sink = event_sink
+		self.__stopping = False
+		self.__spool_writer = None
+		if event_sink is not None:
+			return
+
+		# thread reading spyserver output only parses lines and queues events
+		# spool writer thread appends them to journal
+		# shipper thread sends journaled events to DB in batches
+		self.__events = EventQueue(queue_size, overflow)
+		self.__spool = EventSpool( os.path.join(spool_dir, self.__id + '.journal'), fsync = spool_fsync, source = self.__id )
+		JOURNALS[self.__id] = self.__spool
+		self.__shipper = SpoolShipper(	self.__spool, self.SendEvents,
+										batch_size = spool_batch, retry_interval = retry_interval,
+										name = 'SpoolShipper-' + self.__id, source = self.__id )
 
 
 	def __str__(self):
@@ -79,16 +136,18 @@ class SpyServerMonitor():
 		return self.__str__()
 
 
-	def log(self, *args):
-		now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-		print(self.__color, now, self.__id, '==>', args, C_OFF)
+	def log(self, *args, level = 'info', **fields):
+		'''
+		args are joined into message, fields go to JSON log record
+		'''
+		self.__logger.Log(level, self.__id, *args, **fields)
 
 
-	def HandleConnect(self, i_line):
-		m = re.match('Accepted client (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\:(\d+) running SDR# (.+) on (.+)', i_line)
-		if not m:
-			return False
-		grps = m.groups()
+	def HandleConnect(self, i_event):
+		'''
+		i_event - LineClassifier.LineEvent of CONNECT type
+		'''
+		grps = i_event.groups
 
 		connection = Connection()
 		connection['server_instance'] = self.__id
@@ -98,50 +157,37 @@ class SpyServerMonitor():
 			connection['sdr_version'] = grps[2]
 			connection['os'] = grps[3]
 		except:
-			print(self.__color, traceback.format_exc(), C_OFF)
+			self.__logger.Exception(self.__id, "Bad connect line: ", i_event.line)
 
-		if not self.__no_lan_skip and IP(connection['ip']).iptype() == 'PRIVATE':
-			self.log("Not logging connection from this LAN: ", connection['ip'])
+		if not self.__no_lan_skip and IpFilter.IsPrivate(connection['ip']):
+			self.log("Not logging connection from this LAN: ", connection['ip'], level = 'debug')
 			return
 
 		if connection in self.connections:
-			self.log("Already Connected ??")
-
-		try:
-			_url = ':'.join( self.__http_url ) + '/ssmon/api/v1/open'
-			postreq = http.request(	'POST', _url,
-									headers = {'Content-Type': 'application/json'},
-									body = connection.json() )
-		except:
-			print(self.__color, traceback.format_exc(), C_OFF)
-			print(self.__color, self.__id, "HandleConnect -- Error HTTP POST ", _url, C_OFF)
-			return False
-
+			self.log("Already Connected ??", level = 'warning')
 
-		# server returned connection updated with geolocation info
-		connection.json( postreq.data.decode('utf-8') )
+		# copy - close fills end / duration of connection while open event may still wait for journal
+		self.QueueEvent( {'type': 'open', 'connection': dict(connection.C)} )
 		self.connections[connection] = connection
 
 		return True # handled successfully
 
 
-	def HandleDisconnect(self, i_line):
-		m = re.match('Client disconnected: (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\:(\d+).*', i_line)
-		if not m:
-			return False
-
+	def HandleDisconnect(self, i_event):
+		'''
+		i_event - LineClassifier.LineEvent of DISCONNECT type
+		'''
 		connection = Connection()
 		connection['server_instance'] = self.__id
-		grps = m.groups()
+		grps = i_event.groups
 		try:
 			connection['ip'] = grps[0]
 			connection['port'] = grps[1]
 		except:
-			print(self.__color, self.__id, C_OFF)
-			print(self.__color, traceback.format_exc(), C_OFF)
+			self.__logger.Exception(self.__id, "Bad disconnect line: ", i_event.line)
 
-		if not self.__no_lan_skip and IP(connection['ip']).iptype() == 'PRIVATE':
-			print(self.__color, self.__id, "Not logging connection from this LAN: ", connection['ip'], C_OFF)
+		if not self.__no_lan_skip and IpFilter.IsPrivate(connection['ip']):
+			self.log("Not logging connection from this LAN: ", connection['ip'], level = 'debug')
 			return
 
 		if connection in self.connections:
@@ -149,81 +195,186 @@ class SpyServerMonitor():
 			connection = self.connections[connection]
 			del self.connections[connection]
 		else:
-			self.log("Unknown connection")
+			self.log("Unknown connection", level = 'warning')
 			return False
 
 		connection['end'] = datetime.datetime.utcnow()
 		dur = connection['end'] - connection['start']
 		connection['duration'] = dur.total_seconds()
-		self.log(': Duration ', str(dur))
-
-		try:
-			_url = ':'.join( self.__http_url ) + '/ssmon/api/v1/close'
-			postreq = http.request(	'POST', _url,
-									headers = {'Content-Type': 'application/json'},
-									body = connection.json())
-		except:
-			print(self.__color, traceback.format_exc(), C_OFF)
-			print(self.__color, self.__id, "HandleDisconnect -- Error HTTP POST ", _url, C_OFF)
+		self.log('Duration ', dur, ip = connection['ip'], duration = connection['duration'])
 
+		self.QueueEvent( {'type': 'close', 'connection': connection.C} )
 
 		return True # handled successfully
 
 
-	def HandleRtlGarbage(self, i_line):
-		m = re.match('\[R82XX\] PLL not locked!', i_line)
-		if m:
-			return True
-		m = re.match('Found Rafael Micro R820T tuner', i_line)
-		if m:
-			return True
-		return False
+	def Id(self):
+		return self.__id
+
+
+	def CloseOpenConnections(self):
+		'''
+		spyserver is gone - close sessions it left open
+		'''
+		now = datetime.datetime.utcnow()
+		for connection in list(self.connections.values()):
+			connection['end'] = now
+			connection['duration'] = (now - connection['start']).total_seconds()
+			self.QueueEvent( {'type': 'close', 'connection': connection.C} )
+		if self.connections:
+			self.log("Closed ", len(self.connections), " sessions left open by spyserver", level = 'warning')
+		self.connections = {}
+
+
+	def QueueEvent(self, event):
+		EVENTS.Labels(self.__id, event['type']).Inc()
+		if self.__event_sink is not None:
+			self.__event_sink(event)
+			return
+		if not self.__events.Put(event):
+			DROPPED.Labels(self.__id).Inc()
+			dropped = self.__events.Stats()['dropped']
+			if dropped == 1 or dropped % 100 == 0:
+				self.log("Event queue full, dropped events: ", dropped, level = 'error')
+
+
+	def __spool_writer__(self):
+		while True:
+			event = self.__events.Get(timeout = 1.0)
+			if event is None:
+				if self.__stopping:
+					return
+				continue
+			try:
+				self.__spool.Append(event)
+			except:
+				self.__logger.Exception(self.__id, "Journal write failed")
+
+
+	def Stats(self):
+		if self.__event_sink is not None:
+			# no queue and shipper, owner of event_sink reports them (ie. AsyncMonitor.Stats)
+			return { 'process': self.restarts.Stats() }
+		return {
+			'queue': self.__events.Stats(),
+			'shipper': self.__shipper.Stats(),
+			'process': self.restarts.Stats()
+		}
+
+
+	def SendEvents(self, events):
+		'''
+		POST batch of spooled events to DB, raise on failure
+		'''
+		_url = ':'.join( self.__http_url ) + '/ssmon/api/v1/batch'
+		try:
+			with SEND_LATENCY.Time():
+				postreq = http.request(	'POST', _url,
+										headers = {'Content-Type': 'application/json'},
+										body = JSONEncoder().encode(events),
+										timeout = self.__http_timeout,
+										retries = False )
+			if postreq.status != 200:
+				raise RuntimeError( "HTTP POST {} returned {}".format(_url, postreq.status) )
+		except:
+			SEND_FAILURES.Labels(self.__id).Inc()
+			raise
+		SENT.Labels(self.__id).Inc( len(events) )
 
 
 	def LineHandler(self, i_line, *args, **kwargs):
 		if isinstance(i_line, bytes):
 			i_line = i_line.decode("utf-8")
 		i_line = i_line.strip()
+		self.__lines.Inc()
+		LINE_RATE.Mark(self.__id)
 
-		if self.HandleRtlGarbage(i_line):
-			return
+		ev = self.__classifier.Classify(i_line)
 
-		self.log(i_line)
-
-		if self.HandleConnect(i_line):
-			return
-		if self.HandleDisconnect(i_line):
+		if ev.type == LineClassifier.RTL_GARBAGE:
 			return
 
+		# spyserver output other than connect / disconnect is debug level
+		self.log(i_line, level = 'debug' if ev.type == LineClassifier.OTHER else 'info', event = ev.type)
+
+		if ev.type == LineClassifier.CONNECT:
+			self.HandleConnect(ev)
+		elif ev.type == LineClassifier.DISCONNECT:
+			self.HandleDisconnect(ev)
+
+
+	def Exited(self, rc):
+		'''
+		spyserver process ended, return seconds to wait before restarting it
+		'''
+		self.CloseOpenConnections()
+		delay = self.restarts.Exited(rc)
+		RESTARTS.Labels(self.__id).Inc()
+		stats = self.restarts.Stats()
+		if self.restarts.CrashLoop():
+			self.log("Crash loop: ", len(stats['exits']), " exits, restarting in ", delay, "s",
+						level = 'error', rc = rc, restarts = stats['restarts'])
+		else:
+			self.log("spyserver exited with code ", rc, ", restart ", stats['restarts'] + 1, " in ", delay, "s",
+						level = 'warning', rc = rc, restarts = stats['restarts'])
+		return delay
+
 
 	def __run__(self):
-		self.P = pexpect.spawn(self.__ss + ' ' + self.__config, timeout=None)
-		line = self.P.readline()
-		while line:
+		while not self.__stop_requested.is_set():
+			self.restarts.Started()
+			rc = None
 			try:
-				self.LineHandler(line)
+				self.P = pexpect.spawn(self.__ss + ' ' + self.__config, timeout=None)
+				line = self.P.readline()
+				while line:
+					self.restarts.Up()
+					try:
+						self.LineHandler(line)
+					except:
+						self.__logger.Exception(self.__id, "Line handler failed")
+					line = self.P.readline()
+				self.P.close()
+				rc = self.P.exitstatus
+				if rc is None and self.P.signalstatus is not None:
+					rc = -self.P.signalstatus # same convention as subprocess
 			except:
-				print(traceback.format_exc())
-			line = self.P.readline()
+				self.__logger.Exception(self.__id, "spyserver failed")
+
+			if self.__stop_requested.is_set():
+				self.restarts.Stopped()
+				self.CloseOpenConnections()
+				break
+			self.__stop_requested.wait( self.Exited(rc) )
 
 
 	def Start(self):
+		self.__shipper.Start()
+		self.__spool_writer = threading.Thread(target = self.__spool_writer__, name = 'SpoolWriter-' + self.__id)
+		self.__spool_writer.daemon = True
+		self.__spool_writer.start()
 		self.__thread__  = threading.Thread(target = self.__run__)
 		try:
 			self.__thread__.start()
 		except KeyboardInterrupt:
-			print(self.__color, self.__id, "Sending Ctrl+C to spyserver", C_OFF)
+			self.log("Sending Ctrl+C to spyserver")
 			self.P.sendcontrol('C') # ctrl+C
 			self.__thread__.join()
 		except:
-			print(self.__color, traceback.format_exc(), C_OFF)
+			self.__logger.Exception(self.__id, "Start failed")
 
 
 	def Stop(self):
-		self.log("Sending Ctrl+C to spyserver")
-		self.P.sendcontrol('C') # ctrl+C
+		self.__stop_requested.set()
+		if self.P is not None and self.P.isalive():
+			self.log("Sending Ctrl+C to spyserver")
+			self.P.sendcontrol('C') # ctrl+C
 		if self.__thread__.is_alive():
 			self.__thread__.join()
+		self.__stopping = True
+		self.__spool_writer.join()
+		self.__shipper.Stop(timeout = 10)
+		self.__spool.Close()
 
 
 
@@ -238,16 +389,44 @@ def	main():
 	pprint(cfg())
 	print("\n")
 
+	Logger.Setup( **cfg()['LOG'] )
+
+	if cfg()['MONITOR']['metrics_port']:
+		Metrics.Serve( cfg()['MONITOR']['metrics_host'], cfg()['MONITOR']['metrics_port'] )
+		print("Metrics on http://{}:{}/metrics".format(cfg()['MONITOR']['metrics_host'], cfg()['MONITOR']['metrics_port']))
+
 	# spyserver instances
 	exec_path = cfg()['SPYSERVER']['exe']
 	spy_configs = cfg()['SPYSERVER']['cfg_list']
 
+	if cfg()['MONITOR']['mode'] == 'asyncio':
+		import AsyncMonitor
+		AsyncMonitor.Run(	exec_path, spy_configs,
+							[cfg()['DB']['ip'], cfg()['DB']['port']],
+							no_lan_skip = not cfg()['MONITOR']['ignore_local_connections'],
+							spool_dir = cfg()['MONITOR']['spool_dir'],
+							spool_batch = cfg()['MONITOR']['spool_batch'],
+							spool_fsync = cfg()['MONITOR']['spool_fsync'],
+							retry_interval = cfg()['MONITOR']['retry_interval'],
+							http_timeout = cfg()['MONITOR']['http_timeout'],
+							restart_options = cfg()['MONITOR']['restart'] )
+		Logger.Get().Stop()
+		return
+
 	SPYSERVERS = []
 	for spy_conf in spy_configs:
 		SPYSERVERS.append(
 				SpyServerMonitor( 	exec_path, spy_conf,
 									[cfg()['DB']['ip'], cfg()['DB']['port']],
-									no_lan_skip = not cfg()['MONITOR']['ignore_local_connections'] )
+									no_lan_skip = not cfg()['MONITOR']['ignore_local_connections'],
+									spool_dir = cfg()['MONITOR']['spool_dir'],
+									spool_batch = cfg()['MONITOR']['spool_batch'],
+									spool_fsync = cfg()['MONITOR']['spool_fsync'],
+									retry_interval = cfg()['MONITOR']['retry_interval'],
+									queue_size = cfg()['MONITOR']['queue_size'],
+									overflow = cfg()['MONITOR']['overflow'],
+									http_timeout = cfg()['MONITOR']['http_timeout'],
+									restart_options = cfg()['MONITOR']['restart'] )
 			)
 
 	for ss in SPYSERVERS:
@@ -268,6 +447,8 @@ def	main():
 		except:
 			print(traceback.format_exc())
 
+	Logger.Get().Stop()
+
 
 if __name__ == "__main__":
 	try:
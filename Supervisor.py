@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import time
+import collections
+
+
+class RestartBackoff():
+	'''
+	restart bookkeeping of one supervised child process
+	used by both SpyServerMonitor (threads) and AsyncMonitor (asyncio)
+
+		Started()     - child was spawned
+		Up()          - child is working (first output line), measures recovery time
+		Exited(rc)    - child is gone, returns seconds to wait before restart
+		Stopped()     - child was stopped on purpose, not restarted
+
+	Delay starts at `initial` and is multiplied by `factor` up to `maximum`
+	for every exit, and resets when child ran at least `stable_after` seconds.
+	`crash_loop_count` exits within `crash_loop_window` seconds is a crash loop,
+	then delay is `maximum` until child runs stable again.
+	'''
+	MAX_HISTORY = 20
+
+	def __init__(self, initial = 1.0, maximum = 300.0, factor = 2.0, stable_after = 60.0,
+					crash_loop_count = 5, crash_loop_window = 120.0):
+		self.__initial = initial
+		self.__maximum = maximum
+		self.__factor = factor
+		self.__stable_after = stable_after
+		self.__crash_loop_count = crash_loop_count
+		self.__crash_loop_window = crash_loop_window
+
+		self.__delay = initial
+		self.__exits = collections.deque(maxlen = self.MAX_HISTORY) # (timestamp, return code)
+		self.__started = None # current run start
+		self.__exited = None # last exit, until child is up again
+		self.__first_start = None
+		self.__total_uptime = 0.0
+		self.__restarts = 0
+		self.__crash_loop = False
+		self.__last_recovery = None
+		self.__max_recovery = None
+
+	def Started(self, now = None):
+		now = time.time() if now is None else now
+		if self.__first_start is None:
+			self.__first_start = now
+		else:
+			self.__restarts += 1
+		self.__started = now
+
+	def Up(self, now = None):
+		'''
+		child produced output after (re)start, call as often as convenient
+		'''
+		if self.__exited is None:
+			return
+		now = time.time() if now is None else now
+		self.__last_recovery = now - self.__exited
+		self.__max_recovery = max(self.__max_recovery or 0.0, self.__last_recovery)
+		self.__exited = None
+
+	def Exited(self, rc = None, now = None):
+		'''
+		return delay before restart in seconds
+		'''
+		now = time.time() if now is None else now
+		run_time = now - self.__started if self.__started is not None else 0.0
+		self.__total_uptime += run_time
+		self.__started = None
+		self.__exited = now
+		self.__exits.append( (now, rc) )
+
+		if run_time >= self.__stable_after:
+			self.__delay = self.__initial
+			self.__crash_loop = False
+		else:
+			recent = [ t for t, c in self.__exits if now - t <= self.__crash_loop_window ]
+			self.__crash_loop = len(recent) >= self.__crash_loop_count
+
+		delay = self.__maximum if self.__crash_loop else self.__delay
+		self.__delay = min( self.__delay * self.__factor, self.__maximum )
+		return delay
+
+	def Stopped(self, now = None):
+		now = time.time() if now is None else now
+		if self.__started is not None:
+			self.__total_uptime += now - self.__started
+		self.__started = None
+
+	def CrashLoop(self):
+		return self.__crash_loop
+
+	def Stats(self, now = None):
+		now = time.time() if now is None else now
+		uptime = now - self.__started if self.__started is not None else 0.0
+		return {
+			'running': self.__started is not None,
+			'uptime': uptime,
+			'total_uptime': self.__total_uptime + uptime,
+			'since_first_start': now - self.__first_start if self.__first_start is not None else 0.0,
+			'restarts': self.__restarts,
+			'crash_loop': self.__crash_loop,
+			'next_delay': self.__maximum if self.__crash_loop else self.__delay,
+			'last_recovery': self.__last_recovery,
+			'max_recovery': self.__max_recovery,
+			'exits': list(self.__exits)
+		}
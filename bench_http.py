@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+'''
+	compare HttpInterface server modes under mixed ingest and read load
+
+	./bench_http.py [seconds] [mode ...]
+	modes default to: wsgiref threaded
+
+	For each mode HttpInterface is started in a subprocess on a temporary DB
+	(prefilled with generated history, geolocation replaced by 50ms sleep),
+	then writer threads POST open/close and reader threads GET read endpoints.
+'''
+
+import os
+import sys
+import time
+import json
+import socket
+import random
+import threading
+import subprocess
+import tempfile
+import datetime
+import urllib.request
+import urllib.error
+
+WRITERS = 4
+READERS = 8
+PREFILL_ROWS = 100000
+READ_PATHS = [
+	'/ssmon/api/v1/GetConnectionCounts',
+	'/ssmon/api/v1/GetConnectionStats',
+	'/ssmon/api/v1/location',
+	'/ssmon/api/v1/active',
+	'/ssmon/api/v1/history?limit=500',
+	'/ssmon/api/v1/history?country=Country7&limit=100',
+]
+
+
+def Serve(mode, port, db_file):
+	import HttpInterface
+	from ConnectionsDB import ConnectionsDB
+	from GeoEnricher import GeoEnricher
+
+	def _slow_geoloc(ip):
+		time.sleep(0.05)
+		return {'latitude': 50.0, 'longitude': 20.0, 'country_name': 'Country1', 'city': 'City1'}
+
+	HttpInterface.DB = ConnectionsDB(db_file)
+	HttpInterface.GEO_ENRICHER = GeoEnricher(_slow_geoloc, HttpInterface.OnGeoLocated)
+	HttpInterface.RUN('127.0.0.1', port, server = mode, quiet = True)
+
+
+def FreePort():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def Percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[ min(len(values) - 1, int(len(values) * p)) ]
+
+
+def Load(base_url, seconds):
+	'''
+	return {'ingest': [latencies], 'read': [latencies]}, errors
+	'''
+	res = {'ingest': [], 'read': []}
+	errors = [0]
+	stop = time.time() + seconds
+	lock = threading.Lock()
+
+	def _request(kind, url, body = None):
+		req = urllib.request.Request(url, data = body)
+		if body:
+			req.add_header('Content-Type', 'application/json')
+		_t = time.time()
+		try:
+			urllib.request.urlopen(req, timeout = 30).read()
+		except Exception:
+			with lock:
+				errors[0] += 1
+			return
+		with lock:
+			res[kind].append(time.time() - _t)
+
+	def _writer(n):
+		i = 0
+		while time.time() < stop:
+			i += 1
+			c = {	'ip': '{}.{}.{}.{}'.format(random.randint(1, 223), random.randint(0, 255), n, i % 250 + 1),
+					'port': str(i), 'server_instance': 'bench{}.config'.format(n),
+					'sdr_version': '1700', 'os': 'Windows',
+					'start': str(datetime.datetime.utcnow()), 'end': None }
+			_request('ingest', base_url + '/ssmon/api/v1/open', json.dumps(c).encode())
+			c['end'] = str(datetime.datetime.utcnow())
+			c['duration'] = 1.0
+			_request('ingest', base_url + '/ssmon/api/v1/close', json.dumps(c).encode())
+
+	def _reader(n):
+		while time.time() < stop:
+			_request('read', base_url + random.choice(READ_PATHS))
+
+	threads = [threading.Thread(target = _writer, args = (i,)) for i in range(WRITERS)]
+	threads += [threading.Thread(target = _reader, args = (i,)) for i in range(READERS)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return res, errors[0]
+
+
+def Bench(mode, seconds, template_db):
+	tmp_dir = tempfile.mkdtemp()
+	db_file = os.path.join(tmp_dir, 'bench.db')
+	with open(template_db, 'rb') as src, open(db_file, 'wb') as dst:
+		dst.write(src.read())
+
+	port = FreePort()
+	proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, str(port), db_file],
+							stdout = subprocess.DEVNULL)
+	base_url = 'http://127.0.0.1:{}'.format(port)
+	try:
+		for i in range(100):
+			try:
+				urllib.request.urlopen(base_url + '/ssmon/api/v1/active', timeout = 1).read()
+				break
+			except Exception:
+				time.sleep(0.1)
+		res, errors = Load(base_url, seconds)
+	finally:
+		proc.terminate()
+		proc.wait()
+		for f in os.listdir(tmp_dir):
+			os.remove(os.path.join(tmp_dir, f))
+		os.rmdir(tmp_dir)
+
+	for kind in ['ingest', 'read']:
+		lat = res[kind]
+		print('{:10} {:7} {:8} {:9.1f} {:9.1f} {:9.1f} {:7}'.format(
+				mode, kind, len(lat), len(lat) / float(seconds),
+				Percentile(lat, 0.5) * 1e3, Percentile(lat, 0.99) * 1e3, errors))
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 5 and sys.argv[1] == '--serve':
+		Serve(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+		sys.exit(0)
+
+	seconds = 10
+	if len(sys.argv) > 1:
+		seconds = int(sys.argv[1])
+	modes = sys.argv[2:] or ['wsgiref', 'threaded']
+
+	import gen_db
+	template_dir = tempfile.mkdtemp()
+	template_db = os.path.join(template_dir, 'template.db')
+	print("Generating template DB with ", PREFILL_ROWS, " rows")
+	gen_db.Generate(template_db, PREFILL_ROWS)
+
+	print('{:10} {:7} {:>8} {:>9} {:>9} {:>9} {:>7}'.format('mode', 'kind', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+	try:
+		for mode in modes:
+			Bench(mode, seconds, template_db)
+	finally:
+		for f in os.listdir(template_dir):
+			os.remove(os.path.join(template_dir, f))
+		os.rmdir(template_dir)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+'''
+	time GetConnectionCounts/GetConnectionStats queries
+	on a DB without indexes (schema version 1) and after migration
+
+	python3 ./bench_indexes.py [rows] [db_file]
+	rows defaults to 1000000, DB content is generated by gen_db.py
+'''
+
+import os
+import sys
+import time
+import sqlite3
+
+import gen_db
+from ConnectionsDB import ConnectionsDB
+
+
+QUERIES = [
+	"SELECT server_instance, COUNT(server_instance) from connections GROUP by server_instance",
+	"SELECT country, COUNT(country) from connections GROUP by country",
+	"SELECT city, COUNT(city) from connections GROUP by city",
+	"SELECT ip, COUNT(ip) from connections GROUP by ip",
+	"SELECT COUNT(*) from connections",
+	"SELECT * FROM connections ORDER BY duration DESC LIMIT 1",
+	"SELECT country, COUNT(country) AS value_occurrence FROM connections GROUP BY country ORDER BY value_occurrence DESC LIMIT 1",
+	"SELECT AVG(duration) FROM connections",
+	"SELECT SUM(duration) FROM connections",
+]
+
+
+def TimeQueries(db_file, repeat = 3):
+	db = sqlite3.connect(db_file)
+	res = {}
+	for q in QUERIES:
+		best = None
+		for i in range(repeat):
+			_t = time.time()
+			db.execute(q).fetchall()
+			_dt = time.time() - _t
+			best = _dt if best is None else min(best, _dt)
+		res[q] = best
+	db.close()
+	return res
+
+
+if __name__ == "__main__":
+	rows = 1000000
+	if len(sys.argv) > 1:
+		rows = int(sys.argv[1])
+	db_file = './bench_indexes.db'
+	if len(sys.argv) > 2:
+		db_file = sys.argv[2]
+
+	for f in [db_file, db_file + '-wal', db_file + '-shm']:
+		if os.path.isfile(f):
+			os.remove(f)
+
+	print("Generating ", rows, " rows ... ", end = '')
+	sys.stdout.flush()
+	_t = time.time()
+	gen_db.Generate(db_file, rows, schema_version = 1) # no indexes
+	print(time.time() - _t, 's')
+
+	before = TimeQueries(db_file)
+
+	_t = time.time()
+	db = ConnectionsDB(db_file)
+	print("Migration to schema version ", db.SchemaVersion(), " took ", time.time() - _t, 's')
+	db.Close()
+
+	after = TimeQueries(db_file)
+
+	print('\n{:>10} {:>10} {:>8}  query'.format('before ms', 'after ms', 'speedup'))
+	for q in QUERIES:
+		print('{:10.1f} {:10.1f} {:7.1f}x  {}'.format(
+				before[q] * 1e3, after[q] * 1e3, before[q] / max(after[q], 1e-9), q))
+
+	for f in [db_file, db_file + '-wal', db_file + '-shm']:
+		if os.path.isfile(f):
+			os.remove(f)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+	end to end ingest benchmark
+
+	./bench_ingest.py [seconds] [sessions_per_second ...]
+	rates default to: 25 50 100 200 400
+
+	For every rate:
+		HttpInterface runs in a subprocess on a temporary DB (geolocation is instant),
+		SpyServerMonitor (threads mode) runs spyserver_stub.py in synthetic mode,
+		stub writes time of every connect / disconnect line to a trace file,
+		this script polls DB (read only) and takes time when each open row
+		and each close (end column set) is first visible as committed.
+
+	Latency is from stdout line to committed row, resolution is POLL_INTERVAL.
+	Rate is sustainable when every event was committed and p99 latency is below MAX_P99.
+'''
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import pathlib
+import tempfile
+import subprocess
+import urllib.request
+
+import Logger
+from bench_http import FreePort, Percentile
+from SpyServerMonitor import SpyServerMonitor
+
+
+POLL_INTERVAL = 0.005
+MAX_P99 = 1.0
+GRACE = 10.0 # seconds to wait for last events after stub finished
+STUB = os.path.join( os.path.dirname(os.path.abspath(__file__)), 'spyserver_stub.py' )
+
+
+def Serve(port, db_file):
+	import HttpInterface
+	from ConnectionsDB import ConnectionsDB
+	from GeoEnricher import GeoEnricher
+
+	def _geoloc(ip):
+		return {'latitude': 50.0, 'longitude': 20.0, 'country_name': 'Country1', 'city': 'City1'}
+
+	HttpInterface.DB = ConnectionsDB(db_file)
+	HttpInterface.GEO_ENRICHER = GeoEnricher(_geoloc, HttpInterface.OnGeoLocated)
+	HttpInterface.RUN('127.0.0.1', port, quiet = True)
+
+
+def ReadTrace(trace_file):
+	'''
+	{(kind, ip, port): emit time}
+	'''
+	res = {}
+	if not os.path.isfile(trace_file):
+		return res
+	with open(trace_file) as f:
+		for line in f:
+			parts = line.split()
+			if len(parts) == 4:
+				res[ (parts[1], parts[2], parts[3]) ] = float(parts[0])
+	return res
+
+
+class CommitWatcher():
+	'''
+	first time each open / close is visible in DB
+	'''
+	def __init__(self, db_file):
+		self.__db = sqlite3.connect(pathlib.Path(db_file).resolve().as_uri() + '?mode=ro', uri = True)
+		self.__last_rowid = 0
+		self.__open_rows = {} # rowid -> (ip, port) not closed yet
+		self.seen = {} # (kind, ip, port) -> commit time
+
+	def Poll(self):
+		now = time.time()
+		for rowid, ip, port in self.__db.execute(
+				'SELECT rowid, ip, port FROM connections WHERE rowid > ? ORDER BY rowid', (self.__last_rowid,)):
+			self.__last_rowid = rowid
+			self.__open_rows[rowid] = (ip, str(port))
+			self.seen[ ('open', ip, str(port)) ] = now
+		if self.__open_rows:
+			for rowid, ip, port in self.__db.execute(
+					'SELECT rowid, ip, port FROM connections WHERE rowid >= ? AND end IS NOT NULL',
+					(min(self.__open_rows),)):
+				if self.__open_rows.pop(rowid, None) is not None:
+					self.seen[ ('close', ip, str(port)) ] = now
+
+	def Close(self):
+		self.__db.close()
+
+
+def Bench(rate, seconds):
+	tmp_dir = tempfile.mkdtemp()
+	db_file = os.path.join(tmp_dir, 'bench.db')
+	trace_file = os.path.join(tmp_dir, 'trace.txt')
+	stub_config = os.path.join(tmp_dir, 'bench.config')
+	sessions = int(rate * seconds)
+	with open(stub_config, 'w') as f:
+		f.write('stub_mode = synthetic\n')
+		f.write('stub_rate = {}\n'.format(rate))
+		f.write('stub_clients = {}\n'.format(max(100, rate * 4)))
+		f.write('stub_duration = 1\n')
+		f.write('stub_duration_max = 5\n')
+		f.write('stub_noise = {}\n'.format(rate * 5))
+		f.write('stub_sessions = {}\n'.format(sessions))
+		f.write('stub_trace = {}\n'.format(trace_file))
+
+	port = FreePort()
+	proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port), db_file],
+							stdout = subprocess.DEVNULL)
+	monitor = None
+	watcher = None
+	try:
+		for i in range(100):
+			try:
+				urllib.request.urlopen('http://127.0.0.1:{}/ssmon/api/v1/active'.format(port), timeout = 1).read()
+				break
+			except Exception:
+				time.sleep(0.1)
+
+		watcher = CommitWatcher(db_file)
+		monitor = SpyServerMonitor(	STUB, stub_config, ['http://127.0.0.1', str(port)],
+									spool_dir = os.path.join(tmp_dir, 'spool'),
+									restart_options = {'initial': 3600, 'maximum': 3600} ) # no restarts during run
+		t_start = time.time()
+		monitor.Start()
+
+		expected = 2 * sessions
+		deadline = None
+		while True:
+			watcher.Poll()
+			if len(watcher.seen) >= expected:
+				break
+			if deadline is None and len(ReadTrace(trace_file)) >= expected:
+				deadline = time.time() + GRACE # stub is done
+			if deadline is not None and time.time() > deadline:
+				break
+			time.sleep(POLL_INTERVAL)
+		t_end = max(watcher.seen.values()) if watcher.seen else time.time()
+	finally:
+		if monitor:
+			monitor.Stop()
+		if watcher:
+			watcher.Close()
+		proc.terminate()
+		proc.wait()
+
+	trace = ReadTrace(trace_file)
+	shutil.rmtree(tmp_dir)
+
+	lat = { 'open': [], 'close': [] }
+	for key, t in trace.items():
+		if key in watcher.seen:
+			lat[key[0]].append( max(0.0, watcher.seen[key] - t) )
+	committed = len(lat['open']) + len(lat['close'])
+	lost = len(trace) - committed
+	all_lat = lat['open'] + lat['close']
+	p99 = Percentile(all_lat, 0.99)
+	print('{:9} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:6}'.format(
+			rate, len(trace) / float(seconds), committed / max(0.001, t_end - t_start),
+			Percentile(lat['open'], 0.5) * 1e3, Percentile(lat['open'], 0.99) * 1e3,
+			Percentile(lat['close'], 0.5) * 1e3, Percentile(lat['close'], 0.99) * 1e3, lost))
+	return lost == 0 and p99 < MAX_P99
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 4 and sys.argv[1] == '--serve':
+		Serve(int(sys.argv[2]), sys.argv[3])
+		sys.exit(0)
+
+	seconds = 10
+	if len(sys.argv) > 1:
+		seconds = int(sys.argv[1])
+	rates = [int(r) for r in sys.argv[2:]] or [25, 50, 100, 200, 400]
+
+	Logger.Setup(console = False)
+
+	print('{:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+			'sess/s', 'events/s', 'commit/s', 'open p50', 'open p99', 'close p50', 'close p99', 'lost'))
+	print('{:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6}'.format('', 'offered', '', 'ms', 'ms', 'ms', 'ms', ''))
+	sustainable = None
+	for rate in rates:
+		if Bench(rate, seconds):
+			sustainable = rate
+		else:
+			break
+	if sustainable:
+		print('max sustainable: {} sessions/s, {} events/s (p99 < {}s, nothing lost)'.format(sustainable, 2 * sustainable, MAX_P99))
+	else:
+		print('no tested rate was sustainable')
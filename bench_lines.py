@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+'''
+	time spyserver line classification on synthetic log
+
+	./bench_lines.py [lines]
+	lines defaults to 2000000
+
+	old - HandleRtlGarbage/HandleConnect/HandleDisconnect chain with re.match on string patterns
+	new - LineClassifier.SpyServerClassifier()
+'''
+
+import re
+import sys
+import time
+import random
+
+import LineClassifier
+
+
+def SyntheticLog(n):
+	'''
+	mostly RTL noise, some clients and other spyserver output
+	'''
+	lines = []
+	for i in range(n):
+		r = random.random()
+		if r < 0.80:
+			lines.append('[R82XX] PLL not locked!')
+		elif r < 0.85:
+			lines.append('Found Rafael Micro R820T tuner')
+		elif r < 0.90:
+			lines.append('Accepted client {}.{}.{}.{}:{} running SDR# 1700.0.0.1 on Windows'.format(
+							random.randint(1, 223), random.randint(0, 255), random.randint(0, 255),
+							random.randint(1, 254), random.randint(1024, 65535)))
+		elif r < 0.95:
+			lines.append('Client disconnected: {}.{}.{}.{}:{}'.format(
+							random.randint(1, 223), random.randint(0, 255), random.randint(0, 255),
+							random.randint(1, 254), random.randint(1024, 65535)))
+		else:
+			lines.append('Device Sample Rate: 2400000 sps')
+	return lines
+
+
+def OldClassify(i_line):
+	'''
+	line matching as done before LineClassifier
+	'''
+	if re.match('\\[R82XX\\] PLL not locked!', i_line):
+		return LineClassifier.RTL_GARBAGE
+	if re.match('Found Rafael Micro R820T tuner', i_line):
+		return LineClassifier.RTL_GARBAGE
+	m = re.match('Accepted client (\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.\\d{1,3})\\:(\\d+) running SDR# (.+) on (.+)', i_line)
+	if m:
+		return LineClassifier.CONNECT
+	m = re.match('Client disconnected: (\\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.\\d{1,3})\\:(\\d+).*', i_line)
+	if m:
+		return LineClassifier.DISCONNECT
+	return LineClassifier.OTHER
+
+
+if __name__ == "__main__":
+	n = 2000000
+	if len(sys.argv) > 1:
+		n = int(sys.argv[1])
+
+	print("Generating ", n, " lines")
+	lines = SyntheticLog(n)
+
+	_t = time.time()
+	old = [OldClassify(l) for l in lines]
+	dt_old = time.time() - _t
+
+	lc = LineClassifier.SpyServerClassifier()
+	_t = time.time()
+	new = [lc.Classify(l).type for l in lines]
+	dt_new = time.time() - _t
+
+	if old != new:
+		print("Classification differs!")
+
+	print('old: {:.2f}s {:.0f} lines/s'.format(dt_old, n / dt_old))
+	print('new: {:.2f}s {:.0f} lines/s'.format(dt_new, n / dt_new))
+	print('speedup: {:.1f}x'.format(dt_old / dt_new))
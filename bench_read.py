@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+'''
+	read path benchmark - ConnectionsDB queries and read endpoints under concurrency
+
+	./bench_read.py <rows | db_file> [seconds] [concurrency ...]
+	rows - generate temporary DB by gen_db.py (ie. 100k, 1M, 10M)
+	db_file - use existing DB (it is migrated to latest schema)
+	seconds per target and concurrency, default 5
+	concurrency defaults to: 1 4 16
+
+	For every target and concurrency, that many threads call it in a loop,
+	reported are calls per second and p50/p99 latency:
+		db     - ConnectionsDB methods called in process
+		http   - HttpInterface endpoints, server in a subprocess with response cache
+		         disabled, so every request runs queries (as after each write)
+		cached - same endpoints with response cache (data does not change)
+'''
+
+import os
+import sys
+import time
+import shutil
+import itertools
+import threading
+import tempfile
+import subprocess
+import urllib.request
+
+import gen_db
+from bench_http import FreePort, Percentile
+from ConnectionsDB import ConnectionsDB
+
+
+DB_TARGETS = [
+	('GetConnectionCounts', lambda db: db.GetConnectionCounts()),
+	('GetConnectionCountsFull', lambda db: db.GetConnectionCountsFull()),
+	('GetLocations', lambda db: db.GetLocations()),
+	('GetConnectionStats', lambda db: db.GetConnectionStats()),
+	('GetHistory', lambda db: db.GetHistory(time_from = '2020-06-01', limit = 100)),
+	('GetHistory country', lambda db: db.GetHistory(country = 'Country7', limit = 100)),
+]
+
+HTTP_TARGETS = [
+	'/ssmon/api/v1/GetConnectionCounts',
+	'/ssmon/api/v1/GetConnectionStats',
+	'/ssmon/api/v1/location',
+	'/ssmon/api/v1/country',
+	'/ssmon/api/v1/history?from=2020-06-01&limit=100',
+]
+
+
+def Serve(port, db_file, cache):
+	import HttpInterface
+
+	HttpInterface.DB = ConnectionsDB(db_file)
+	if not cache:
+		# new data version on every request - VersionedCache never hits
+		_versions = itertools.count(1)
+		HttpInterface.DB.DataVersion = lambda: next(_versions)
+	HttpInterface.RUN('127.0.0.1', port, quiet = True)
+
+
+def Run(fn, concurrency, seconds):
+	'''
+	call fn from concurrency threads for seconds
+	return [latencies], errors
+	'''
+	lat = []
+	errors = [0]
+	lock = threading.Lock()
+	stop = time.time() + seconds
+
+	def _worker():
+		while time.time() < stop:
+			_t = time.perf_counter()
+			try:
+				fn()
+			except Exception:
+				with lock:
+					errors[0] += 1
+				continue
+			_dt = time.perf_counter() - _t
+			with lock:
+				lat.append(_dt)
+
+	threads = [threading.Thread(target = _worker) for i in range(concurrency)]
+	_t = time.time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return lat, errors[0], time.time() - _t
+
+
+def Report(layer, target, concurrency, lat, errors, elapsed):
+	print('{:7} {:40} {:5} {:8} {:9.1f} {:9.1f} {:9.1f} {:7}'.format(
+			layer, target[:40], concurrency, len(lat), len(lat) / elapsed,
+			Percentile(lat, 0.5) * 1e3, Percentile(lat, 0.99) * 1e3, errors))
+	sys.stdout.flush()
+
+
+def BenchDB(db_file, concurrencies, seconds):
+	db = ConnectionsDB(db_file)
+	try:
+		for name, fn in DB_TARGETS:
+			for c in concurrencies:
+				Report('db', name, c, *Run(lambda: fn(db), c, seconds))
+	finally:
+		db.Close()
+
+
+def BenchHTTP(db_file, concurrencies, seconds, cache):
+	port = FreePort()
+	proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port), db_file,
+							'cache' if cache else 'nocache'], stdout = subprocess.DEVNULL)
+	base_url = 'http://127.0.0.1:{}'.format(port)
+	try:
+		for i in range(300):
+			try:
+				urllib.request.urlopen(base_url + '/ssmon/api/v1/active', timeout = 1).read()
+				break
+			except Exception:
+				time.sleep(0.1)
+		for path in HTTP_TARGETS:
+			_get = lambda: urllib.request.urlopen(base_url + path, timeout = 120).read()
+			for c in concurrencies:
+				Report('cached' if cache else 'http', path.replace('/ssmon/api/v1', ''), c, *Run(_get, c, seconds))
+	finally:
+		proc.terminate()
+		proc.wait()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 5 and sys.argv[1] == '--serve':
+		Serve(int(sys.argv[2]), sys.argv[3], sys.argv[4] == 'cache')
+		sys.exit(0)
+
+	if len(sys.argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+	concurrencies = [int(c) for c in sys.argv[3:]] or [1, 4, 16]
+
+	tmp_dir = None
+	if os.path.isfile(sys.argv[1]):
+		db_file = sys.argv[1]
+	else:
+		rows = gen_db.ParseRows(sys.argv[1])
+		tmp_dir = tempfile.mkdtemp()
+		db_file = os.path.join(tmp_dir, 'bench.db')
+		print("Generating DB with ", rows, " rows ... ", end = '')
+		sys.stdout.flush()
+		_t = time.time()
+		gen_db.Generate(db_file, rows)
+		print(round(time.time() - _t, 1), 's')
+
+	print('{:7} {:40} {:>5} {:>8} {:>9} {:>9} {:>9} {:>7}'.format(
+			'layer', 'target', 'conc', 'calls', 'calls/s', 'p50 ms', 'p99 ms', 'errors'))
+	try:
+		BenchDB(db_file, concurrencies, seconds)
+		BenchHTTP(db_file, concurrencies, seconds, cache = False)
+		BenchHTTP(db_file, concurrencies, seconds, cache = True)
+	finally:
+		if tmp_dir:
+			shutil.rmtree(tmp_dir)
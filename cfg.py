@@ -3,114 +3,322 @@
 import string
 import os
 import sys
+import time
+import signal
+import threading
+import traceback
 import configparser
-from copy import deepcopy
 from pprint import pprint
-from get_ip import get_ip_local, get_ip_world
+from get_ip import get_ip_local, get_ip_world, LAST_DISCOVERY
+from IpFilter import IpFilter
 
 _CFG = None
 _CFG_FILE = None
+_CFG_LOCK = threading.Lock()
+_RELOAD_CALLBACKS = []
+
+
+class ConfigSection(dict):
+	'''
+	read only dict, values also readable as attributes: cfg().DB.port
+	snapshot is never modified, so it is shared without copying
+	'''
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __readonly(self, *args, **kwargs):
+		raise TypeError('Config snapshot is read only, use cfg.Reload()')
+
+	__setitem__ = __delitem__ = __setattr__ = __delattr__ = __readonly
+	clear = pop = popitem = setdefault = update = __ior__ = __readonly
+
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __reduce__(self):
+		return (ConfigSection, (dict(self),))
+
+
+def _Freeze(value):
+	if isinstance(value, dict):
+		return ConfigSection( (k, _Freeze(v)) for k, v in value.items() )
+	if isinstance(value, list):
+		return tuple( _Freeze(v) for v in value )
+	return value
+
 
 def cfg(i_cfg_file = None):
+	'''
+	current config snapshot, loads i_cfg_file when given and not loaded yet
+	'''
 	global _CFG
 	global _CFG_FILE
 
-	if i_cfg_file == None and _CFG:
-		return deepcopy(_CFG)
+	snapshot = _CFG
+	if i_cfg_file == None and snapshot:
+		return snapshot
 
 	if not i_cfg_file or not os.path.isfile(i_cfg_file):
 		raise ValueError( "Config file does not exist: " + str(i_cfg_file) )
 
-	if _CFG_FILE and _CFG_FILE != i_cfg_file:
-		_CFG = None
+	with _CFG_LOCK:
+		if not _CFG or _CFG_FILE != i_cfg_file:
+			_CFG = _Load(i_cfg_file)
+			_CFG_FILE = i_cfg_file
+		return _CFG
+
+
+def OnReload(callback):
+	'''
+	callback(new_cfg, old_cfg) is called after Reload() swapped snapshots
+	'''
+	_RELOAD_CALLBACKS.append(callback)
 
-	if not _CFG:
-		_CFG_FILE = i_cfg_file
-		print("Loading config from ", _CFG_FILE, ' ... ' , end = '')
 
-		config = configparser.SafeConfigParser()
-		config.read(_CFG_FILE)
+def Reload():
+	'''
+	parse config file again and swap snapshot, old snapshot is kept on error
+	return True when new config is in use
+	'''
+	global _CFG
 
-		# convert config to dictionary
-		#
-		res = {
-			'default': {}
-		}
+	with _CFG_LOCK:
+		old = _CFG
+		try:
+			new = _Load(_CFG_FILE)
+		except:
+			print("Config reload failed, keeping previous config")
+			print(traceback.format_exc())
+			return False
+		_CFG = new
 
-		defaults = config.defaults()
-		for k in defaults:
-			res['default'][k] = defaults[k]
+	for callback in _RELOAD_CALLBACKS:
+		try:
+			callback(new, old)
+		except:
+			print(traceback.format_exc())
+	return True
 
-		for section in config.sections():
-			if section not in res:
-				res[section] = {}
-			for option in config.options(section):
-				res[section][option] = config.get(section,option)
 
-		# some config parsing
-		#
+def ReloadOnSIGHUP():
+	'''
+	reload config on SIGHUP, call from main thread
+	parsing may do network requests, so it runs in own thread
+	'''
+	def handler(signum, frame):
+		threading.Thread(target = Reload, name = 'cfg.Reload').start()
+	signal.signal(signal.SIGHUP, handler)
 
-		# format DB/ip_filters
-		ip_filters = res['DB']['ip_filters'].split(',')
-		ip_filters = list( map( str.strip, ip_filters ) )
 
-		ipl = None
-		while not ipl:
-			print("Checking local IP")
+def _LocalIp(attempts = 3):
+	'''
+	local IP, 127.0.0.1 when there is no route
+	'''
+	for i in range(attempts):
+		print("Checking local IP")
+		try:
 			ipl = get_ip_local()
+		except (ValueError, IndexError, OSError):
+			ipl = None
+		if ipl:
+			return ipl
+		time.sleep(1)
+	print("Local IP unknown, using 127.0.0.1")
+	return '127.0.0.1'
+
+
+def _Load(i_cfg_file):
+	'''
+	parse config file to frozen snapshot
+	'''
+	print("Loading config from ", i_cfg_file, ' ... ' , end = '')
+
+	config = configparser.ConfigParser()
+	config.read(i_cfg_file)
+
+	# convert config to dictionary
+	#
+	res = {
+		'default': {}
+	}
+
+	defaults = config.defaults()
+	for k in defaults:
+		res['default'][k] = defaults[k]
+
+	for section in config.sections():
+		if section not in res:
+			res[section] = {}
+		for option in config.options(section):
+			res[section][option] = config.get(section,option)
+
+	# some config parsing
+	#
+
+	# format DB/ip_filters
+	ip_filters = res['DB']['ip_filters'].split(',')
+	ip_filters = list( map( str.strip, ip_filters ) )
+
+	# world IP discovery, section is optional - see get_ip.get_ip_world
+	world = res.get('WORLD_IP', {})
+	res['WORLD_IP'] = {
+		'mode': world.get('mode', 'auto').lower(),
+		'cache_file': world.get('cache_file', './world_ip.json').replace('~', os.environ['HOME']),
+		'cache_ttl': float( world.get('cache_ttl', 3600) ),
+		'deadline': float( world.get('deadline', 5) ),
+		'parallel': int( world.get('parallel', 8) )
+	}
+	if res['WORLD_IP']['mode'] not in ['auto', 'offline']:
+		raise RuntimeError("INI File Error: WORLD_IP/mode should be auto or offline")
+
+	# local and world IP are looked up only when used
+	ipl = None
+	if any( 'ip_local' in f for f in ip_filters ) or res['DB']['ip'].lower() == 'ip_local':
+		ipl = _LocalIp()
+
+	ipw = None
+	if any( 'ip_world' in f for f in ip_filters ):
+		print("Checking world IP")
+		ipw = get_ip_world(	cache_file = res['WORLD_IP']['cache_file'],
+							ttl = res['WORLD_IP']['cache_ttl'],
+							deadline = res['WORLD_IP']['deadline'],
+							parallel = res['WORLD_IP']['parallel'],
+							offline = res['WORLD_IP']['mode'] == 'offline' )
+		print("World IP: {ip} from {source} in {elapsed:.2f}s".format(**LAST_DISCOVERY))
+
+	# filters with unknown IP are left out
+	for keyword, ip in [('ip_local', ipl), ('ip_world', ipw)]:
+		if ip:
+			ip_filters = [ f.replace(keyword, ip) for f in ip_filters ]
+		elif any( keyword in f for f in ip_filters ):
+			print("IP filter ", keyword, " not used, IP is unknown")
+			ip_filters = [ f for f in ip_filters if keyword not in f ]
+	# check for any new line characters - this indicates missing commas
+	if list(filter( lambda x: '\n' in x, ip_filters )):
+		raise RuntimeError("INI File Error: DB/ip_filters should be comma separated list")
+	res['DB']['ip_filters'] = ip_filters
+	try:
+		res['DB']['ip_filter'] = IpFilter(ip_filters) # compiled once, shared
+	except ValueError as e:
+		raise RuntimeError("INI File Error: DB/ip_filters - " + str(e))
+
+	# format SPYSERVER/cfg_list - it should be comma separated
+	cfg_list = res['SPYSERVER']['cfg_list'].split(',')
+	cfg_list = list( map( str.strip, cfg_list ) )
+	cfg_list = list( map( lambda x: x.replace('~', os.environ['HOME']), cfg_list) )
+	# check for any new line characters - this indicates missing commas
+	if list(filter( lambda x: '\n' in x, cfg_list )):
+		raise RuntimeError("INI File Error: SPYSERVER/cfg_list should be comma separated list")
+	res['SPYSERVER']['cfg_list'] = cfg_list
+
+	res['SPYSERVER']['exe'] = res['SPYSERVER']['exe'].replace('~', os.environ['HOME'])
+	res['DB']['file'] = res['DB']['file'].replace('~', os.environ['HOME'])
+	res['DB']['server'] = res['DB'].get('server', 'threaded').lower()
+	res['DB']['threads'] = int( res['DB'].get('threads', 16) )
+	res['DB']['events_max_clients'] = int( res['DB'].get('events_max_clients', 8) )
+	res['DB']['events_queue'] = int( res['DB'].get('events_queue', 100) )
+	res['DB']['events_keepalive'] = float( res['DB'].get('events_keepalive', 15) )
+	res['DB']['batch_size'] = int( res['DB'].get('batch_size', 100) )
+	res['DB']['flush_interval'] = float( res['DB'].get('flush_interval', 0.2) )
+	res['DB']['synchronous'] = res['DB'].get('synchronous', 'NORMAL').upper()
+	if res['DB']['synchronous'] not in ['OFF', 'NORMAL', 'FULL']:
+		raise RuntimeError("INI File Error: DB/synchronous should be OFF, NORMAL or FULL")
+
+	res['MONITOR']['ignore_local_connections'] = \
+			res['MONITOR']['ignore_local_connections'].lower() == 'yes' \
+		or	res['MONITOR']['ignore_local_connections'].lower() == '1'
+
+	res['MONITOR']['mode'] = res['MONITOR'].get('mode', 'threads').lower()
+	if res['MONITOR']['mode'] not in ['threads', 'asyncio']:
+		raise RuntimeError("INI File Error: MONITOR/mode should be threads or asyncio")
+
+	res['MONITOR']['spool_dir'] = res['MONITOR'].get('spool_dir', './spool').replace('~', os.environ['HOME'])
+	res['MONITOR']['spool_batch'] = int( res['MONITOR'].get('spool_batch', 100) )
+	res['MONITOR']['spool_fsync'] = res['MONITOR'].get('spool_fsync', 'no').lower() in ['yes', '1']
+	res['MONITOR']['retry_interval'] = float( res['MONITOR'].get('retry_interval', 5) )
+	res['MONITOR']['http_timeout'] = float( res['MONITOR'].get('http_timeout', 10) )
+	res['MONITOR']['queue_size'] = int( res['MONITOR'].get('queue_size', 10000) )
+	res['MONITOR']['overflow'] = res['MONITOR'].get('overflow', 'block').lower()
+	if res['MONITOR']['overflow'] not in ['drop_oldest', 'drop_newest', 'block']:
+		raise RuntimeError("INI File Error: MONITOR/overflow should be drop_oldest, drop_newest or block")
+
+	# monitor metrics endpoint, 0 - disabled
+	res['MONITOR']['metrics_host'] = res['MONITOR'].get('metrics_host', '127.0.0.1')
+	res['MONITOR']['metrics_port'] = int( res['MONITOR'].get('metrics_port', 0) )
 
-		ipw = None
-		while not ipw:
-			print("Checking world IP")
-			ipw = get_ip_world()
+	# spyserver restart backoff, see Supervisor.RestartBackoff
+	res['MONITOR']['restart'] = {
+		'initial': float( res['MONITOR'].get('restart_initial', 1) ),
+		'maximum': float( res['MONITOR'].get('restart_max', 300) ),
+		'stable_after': float( res['MONITOR'].get('restart_stable_after', 60) ),
+		'crash_loop_count': int( res['MONITOR'].get('crash_loop_count', 5) ),
+		'crash_loop_window': float( res['MONITOR'].get('crash_loop_window', 120) )
+	}
 
-		ip_filters = list( map( lambda x: x.replace('ip_local',ipl), ip_filters) )
-		ip_filters = list( map( lambda x: x.replace('ip_world',ipw), ip_filters) )
-		# check for any new line characters - this indicates missing commas
-		if list(filter( lambda x: '\n' in x, ip_filters )):
-			raise RuntimeError("INI File Error: DB/ip_filters should be comma separated list")
-		res['DB']['ip_filters'] = ip_filters
+	# slack
+	res['SLACK']['use'] = \
+			res['SLACK']['use'].lower() == 'yes' \
+		or	res['SLACK']['use'].lower() == '1'
 
-		# format SPYSERVER/cfg_list - it should be comma separated
-		cfg_list = res['SPYSERVER']['cfg_list'].split(',')
-		cfg_list = list( map( str.strip, cfg_list ) )
-		cfg_list = list( map( lambda x: x.replace('~', os.environ['HOME']), cfg_list) )
-		# check for any new line characters - this indicates missing commas
-		if list(filter( lambda x: '\n' in x, cfg_list )):
-			raise RuntimeError("INI File Error: SPYSERVER/cfg_list should be comma separated list")
-		res['SPYSERVER']['cfg_list'] = cfg_list
+	if res['SLACK']['use'] and not res['SLACK']['key']:
+		raise RuntimeError("No SLACK key provided. Update INI file.")
 
-		res['SPYSERVER']['exe'] = res['SPYSERVER']['exe'].replace('~', os.environ['HOME'])
-		res['DB']['file'] = res['DB']['file'].replace('~', os.environ['HOME'])
+	res['SLACK']['window'] = float( res['SLACK'].get('window', 10) )
+	res['SLACK']['max_per_minute'] = int( res['SLACK'].get('max_per_minute', 20) )
+	res['SLACK']['queue_size'] = int( res['SLACK'].get('queue_size', 1000) )
 
-		res['MONITOR']['ignore_local_connections'] = \
-				res['MONITOR']['ignore_local_connections'].lower() == 'yes' \
-			or	res['MONITOR']['ignore_local_connections'].lower() == '1'
+	# geoloc
+	res['GEOIP']['backend'] = res['GEOIP'].get('backend', 'ipgeolocation').lower()
+	if res['GEOIP']['backend'] not in ['ipgeolocation', 'offline']:
+		raise RuntimeError("INI File Error: GEOIP/backend should be ipgeolocation or offline")
 
-		# slack
-		res['SLACK']['use'] = \
-				res['SLACK']['use'].lower() == 'yes' \
-			or	res['SLACK']['use'].lower() == '1'
+	if res['GEOIP']['backend'] == 'ipgeolocation' and not res['GEOIP']['key']:
+		raise RuntimeError("No IP Geolocation key provided. Update INI file.")
 
-		if res['SLACK']['use'] and not res['SLACK']['key']:
-			raise RuntimeError("No SLACK key provided. Update INI file.")
+	if res['GEOIP']['backend'] == 'offline':
+		res['GEOIP']['ranges_csv'] = res['GEOIP'].get('ranges_csv', '').replace('~', os.environ['HOME'])
+		res['GEOIP']['ranges_index'] = res['GEOIP'].get('ranges_index', '').replace('~', os.environ['HOME'])
+		if not res['GEOIP']['ranges_index']:
+			res['GEOIP']['ranges_index'] = res['GEOIP']['ranges_csv'] + '.idx'
+		if not os.path.isfile(res['GEOIP']['ranges_csv']) and not os.path.isfile(res['GEOIP']['ranges_index']):
+			raise RuntimeError("GEOIP offline backend: no ranges_csv or ranges_index file. Update INI file.")
 
-		# geoloc
-		if not res['GEOIP']['key']:
-			raise RuntimeError("No IP Geolocation key provided. Update INI file.")
+	res['GEOIP']['cache_file'] = res['GEOIP'].get('cache_file', './GeoCache.db').replace('~', os.environ['HOME'])
+	res['GEOIP']['cache_ttl'] = float( res['GEOIP'].get('cache_ttl', 7 * 24 * 3600) )
+	res['GEOIP']['cache_size'] = int( res['GEOIP'].get('cache_size', 10000) )
+	res['GEOIP']['workers'] = int( res['GEOIP'].get('workers', 2) )
 
-		if res['DB']['ip'].lower() == 'ip_local':
-			res['DB']['ip'] = ipl
+	# log, section is optional - see Logger.Logger arguments
+	log = res.get('LOG', {})
+	res['LOG'] = {
+		'file': log.get('file', '').replace('~', os.environ['HOME']) or None,
+		'level': log.get('level', 'info').lower(),
+		'console': log.get('console', 'yes').lower() in ['yes', '1'],
+		'console_level': log.get('console_level', '').lower() or None,
+		'max_bytes': int( log.get('max_bytes', 10 * 1024 * 1024) ),
+		'backup_count': int( log.get('backup_count', 5) ),
+		'queue_size': int( log.get('queue_size', 10000) )
+	}
+	for l in [res['LOG']['level'], res['LOG']['console_level']]:
+		if l is not None and l not in ['debug', 'info', 'warning', 'error']:
+			raise RuntimeError("INI File Error: LOG/level and LOG/console_level should be debug, info, warning or error")
 
-		for f in res['SPYSERVER']['cfg_list']:
-			if not os.path.isfile(f):
-				raise RuntimeError("Spyserver config file does not exist: " + f)
+	if res['DB']['ip'].lower() == 'ip_local':
+		res['DB']['ip'] = ipl
 
+	for f in res['SPYSERVER']['cfg_list']:
+		if not os.path.isfile(f):
+			raise RuntimeError("Spyserver config file does not exist: " + f)
 
-		_CFG = res
-		print('OK')
 
-	return deepcopy(_CFG)
+	print('OK')
+	return _Freeze(res)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+'''
+	generate connections DB with realistic skew, for benchmarks
+
+	./gen_db.py <rows> <db_file> [schema_version]
+	rows - number or with k / M suffix: 100k, 1M, 10M
+	schema_version - 1 leaves DB without indexes and aggregates, default is latest
+
+	Content:
+		countries and cities with Zipf popularity, every city has fixed lat/lon
+		near its country, so /location gets realistic number of map points
+		IP pool of rows / 10 addresses, each located in one city,
+		IP popularity is Zipf too - few regulars and long tail
+		few % of connections without geolocation (failed lookup)
+		starts spread over years, log-normal durations (median 5 min)
+
+	Rows are bulk inserted by executemany into schema version 1 table,
+	then ConnectionsDB migrates it (indexes, aggregates rebuilt from scratch),
+	which is much faster than maintaining indexes and triggers row by row.
+'''
+
+import os
+import sys
+import time
+import math
+import random
+import sqlite3
+import datetime
+import itertools
+
+from ConnectionsDB import ConnectionsDB
+
+
+COUNTRIES = 120
+CITIES = 3000
+INSTANCES = [('hf.config', 50), ('vhf.config', 25), ('one.config', 15), ('two.config', 10)]
+SDR_VERSIONS = [('1700.0.0.1', 20), ('1732.0.0.0', 30), ('1784.0.0.0', 50)]
+OS_NAMES = [('Windows', 85), ('Linux', 12), ('Darwin', 3)]
+NO_GEO = 0.03 # fraction of connections without geolocation
+START = datetime.datetime(2019, 1, 1)
+SPAN = 3 * 365 * 24 * 3600 # seconds
+CHUNK = 50000
+
+
+def ParseRows(s):
+	'''
+	'100k' -> 100000, '10M' -> 10000000
+	'''
+	mult = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}.get(s[-1:], 1)
+	if mult != 1:
+		s = s[:-1]
+	return int(float(s) * mult)
+
+
+def _ZipfWeights(n, s):
+	return list( itertools.accumulate( 1.0 / (i + 1) ** s for i in range(n) ) )
+
+
+def _Weighted(pairs):
+	values = [v for v, w in pairs]
+	return values, list( itertools.accumulate(w for v, w in pairs) )
+
+
+def _Geography(rnd):
+	'''
+	[(lat, lon, country, city)] for every city, and cumulative city weights
+	'''
+	country_cum = _ZipfWeights(COUNTRIES, 1.2)
+	centers = [ (rnd.uniform(-50, 65), rnd.uniform(-170, 175)) for i in range(COUNTRIES) ]
+	cities = []
+	for i in range(CITIES):
+		# big countries have many cities
+		c = rnd.choices(range(COUNTRIES), cum_weights = country_cum)[0]
+		lat, lon = centers[c]
+		cities.append( (round(lat + rnd.gauss(0, 3), 4), round(lon + rnd.gauss(0, 4), 4),
+						'Country{}'.format(c), 'City{}'.format(i)) )
+	return cities, _ZipfWeights(CITIES, 1.0)
+
+
+def _IpPool(n, rnd):
+	'''
+	n distinct public looking IPs
+	'''
+	first = [o for o in range(1, 224) if o not in (10, 100, 127, 169, 172, 192)]
+	ips = set()
+	while len(ips) < n:
+		ips.add( '{}.{}.{}.{}'.format(rnd.choice(first), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)) )
+	ips = list(ips)
+	rnd.shuffle(ips)
+	return ips
+
+
+def _Timestamps():
+	'''
+	epoch seconds -> 'YYYY-MM-DD HH:MM:SS' (UTC), date part formatted once per day
+	'''
+	days = {}
+	def _stamp(t):
+		day, sec = divmod(int(t), 86400)
+		d = days.get(day)
+		if d is None:
+			d = days[day] = datetime.datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d ')
+		return '{}{:02}:{:02}:{:02}'.format(d, sec // 3600, sec // 60 % 60, sec % 60)
+	return _stamp
+
+
+def Rows(rows, seed = 1):
+	'''
+	yield chunks (lists) of connections table rows, oldest first
+	'''
+	rnd = random.Random(seed)
+	cities, city_cum = _Geography(rnd)
+	no_geo = (None, None, None, None)
+
+	ips = _IpPool( max(100, min(rows // 10, 2000000)), rnd )
+	ip_cum = _ZipfWeights(len(ips), 0.9)
+	ip_geo = [ no_geo if rnd.random() < NO_GEO else geo
+				for geo in rnd.choices(cities, cum_weights = city_cum, k = len(ips)) ]
+
+	instances, instance_cum = _Weighted(INSTANCES)
+	versions, version_cum = _Weighted(SDR_VERSIONS)
+	os_names, os_cum = _Weighted(OS_NAMES)
+
+	mean_gap = SPAN / float(max(rows, 1))
+	t = (START - datetime.datetime(1970, 1, 1)).total_seconds()
+	stamp = _Timestamps()
+	rand = rnd.random
+	log_median = math.log(300)
+	done = 0
+	while done < rows:
+		n = min(CHUNK, rows - done)
+		chunk = []
+		ip_idx = rnd.choices(range(len(ips)), cum_weights = ip_cum, k = n)
+		inst = rnd.choices(instances, cum_weights = instance_cum, k = n)
+		ver = rnd.choices(versions, cum_weights = version_cum, k = n)
+		osn = rnd.choices(os_names, cum_weights = os_cum, k = n)
+		for i in range(n):
+			t += rnd.expovariate(1.0 / mean_gap)
+			dur = min( rnd.lognormvariate(log_median, 1.5), 7 * 24 * 3600.0 )
+			lat, lon, country, city = ip_geo[ ip_idx[i] ]
+			chunk.append( ( ips[ ip_idx[i] ], str(1024 + int(rand() * 64512)), inst[i], ver[i], osn[i],
+							stamp(t), stamp(t + dur), round(dur, 3), lat, lon, country, city ) )
+		done += n
+		yield chunk
+
+
+def Generate(db_file, rows, schema_version = None, seed = 1, progress = None):
+	'''
+	create db_file (must not exist) with rows connections
+	schema_version - None for latest, 1 for table only (ie. to time migrations)
+	progress - callable(rows done)
+	'''
+	if os.path.exists(db_file):
+		raise ValueError('DB file already exists: ' + db_file)
+
+	db = sqlite3.connect(db_file)
+	db.execute('PRAGMA journal_mode = OFF')
+	db.execute('PRAGMA synchronous = OFF')
+	db.execute('PRAGMA cache_size = -262144') # 256MB
+	db.execute(ConnectionsDB.MIGRATIONS[0][1][0])
+	db.execute('PRAGMA user_version = 1')
+	done = 0
+	for chunk in Rows(rows, seed):
+		db.executemany("INSERT OR IGNORE INTO connections VALUES(?,?,?,?,?,?,?,?,?,?,?,?)", chunk)
+		done += len(chunk)
+		if progress:
+			progress(done)
+	db.commit()
+	db.close()
+
+	if schema_version == 1:
+		return
+
+	# indexes, aggregates rebuilt in migration
+	ConnectionsDB(db_file).Close()
+	# fold WAL into main file, so DB is a single file which can be copied
+	db = sqlite3.connect(db_file)
+	db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+	db.close()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		print(__doc__)
+		sys.exit(1)
+	rows = ParseRows(sys.argv[1])
+	schema_version = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+	def _progress(done):
+		print('\r', done, '/', rows, end = '')
+		sys.stdout.flush()
+
+	_t = time.time()
+	Generate(sys.argv[2], rows, schema_version, progress = _progress)
+	print('\nGenerated', rows, 'rows in', round(time.time() - _t, 1), 's')
@@ -39,7 +39,12 @@ __all__ = ['get_ip_local', 'get_ip_world']
 
 
 import re
+import os
+import json
+import time
+import queue
 import random
+import threading
 
 from sys import version_info
 
@@ -62,7 +67,10 @@ class IPgetter(object):
 	on a single server
 	'''
 
-	def __init__(self):
+	def __init__(self, server_list = None):
+		if server_list is not None:
+			self.server_list = list(server_list)
+			return
 		self.server_list = ['http://ip.dnsexit.com',
 							'http://ifconfig.me/ip',
 							'http://ipecho.net/plain',
@@ -124,7 +132,38 @@ class IPgetter(object):
 				continue
 		return ''
 
-	def fetch(self, server):
+	def get_externalip_race(self, deadline = 5.0, parallel = 8):
+		'''
+		Ask up to `parallel` random servers at once, first valid answer wins.
+		When a server fails next one is asked, nothing is waited for after `deadline` seconds.
+		Returns (ip, server) or ('', None)
+		'''
+		random.shuffle(self.server_list)
+		pending = list(self.server_list)
+		answers = queue.Queue()
+		end = time.time() + deadline
+
+		def ask(server):
+			answers.put( (self.fetch(server, timeout = max(0.1, end - time.time())), server) )
+
+		running = 0
+		while True:
+			while pending and running < parallel:
+				t = threading.Thread(target = ask, args = (pending.pop(0),))
+				t.daemon = True # never keeps process alive
+				t.start()
+				running += 1
+			if not running:
+				return '', None
+			try:
+				myip, server = answers.get( timeout = max(0.0, end - time.time()) )
+			except queue.Empty:
+				return '', None
+			running -= 1
+			if myip != '':
+				return myip, server
+
+	def fetch(self, server, timeout = None):
 		'''
 		This function gets your IP from a specific server
 		'''
@@ -134,7 +173,7 @@ class IPgetter(object):
 							"Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0" )]
 
 		try:
-			url = opener.open(server)
+			url = opener.open(server, timeout = timeout)
 			content = url.read()
 
 			# Didn't want to import chardet. Prefered to stick to stdlib
@@ -176,11 +215,57 @@ class IPgetter(object):
 		print(resultdict)
 
 
-def get_ip_world():
-	ipw = IPgetter().get_externalip()
+# how the last get_ip_world() got its answer, ie. for startup time reporting
+# source: cache, network, stale_cache, offline or none
+LAST_DISCOVERY = {}
+
+def _read_cache(cache_file):
+	try:
+		with open(cache_file) as f:
+			c = json.load(f)
+		return c['ip'], float(c['time'])
+	except (OSError, ValueError, KeyError, TypeError):
+		return None, 0.0
+
+def _write_cache(cache_file, ip):
+	tmp_file = cache_file + '.tmp'
+	try:
+		with open(tmp_file, 'w') as f:
+			json.dump({'ip': ip, 'time': time.time()}, f)
+		os.replace(tmp_file, cache_file)
+	except OSError:
+		pass
+
+def get_ip_world(cache_file = None, ttl = 3600.0, deadline = 5.0, parallel = 8, offline = False, servers = None):
+	'''
+	world IP or None, never takes much longer than deadline
+
+	cache_file - JSON file with last discovered IP, used while younger than ttl seconds
+	             and also when discovery fails (stale)
+	offline - do not ask servers, cached IP of any age or None
+	servers - list of URLs instead of IPgetter list (ie. local stub servers)
+	'''
+	started = time.time()
+
+	def done(ip, source, server = None):
+		LAST_DISCOVERY.clear()
+		LAST_DISCOVERY.update({ 'ip': ip, 'source': source, 'server': server, 'elapsed': time.time() - started })
+		return ip
+
+	cached, cached_time = _read_cache(cache_file) if cache_file else (None, 0.0)
+	if offline:
+		return done(cached, 'offline')
+	if cached and time.time() - cached_time < ttl:
+		return done(cached, 'cache')
+
+	ipw, server = IPgetter(servers).get_externalip_race(deadline, parallel)
 	if ipw != '':
-		return ipw
-	return None
+		if cache_file:
+			_write_cache(cache_file, ipw)
+		return done(ipw, 'network', server)
+	if cached:
+		return done(cached, 'stale_cache')
+	return done(None, 'none')
 
 # Very Linux Specific
 def get_ip_local():
@@ -200,5 +285,8 @@ def get_ip_local():
 
 
 if __name__ == '__main__':
-	print(get_ip_world())
+	# ./get_ip.py [--offline] [server_url ...]
+	import sys
+	_servers = [a for a in sys.argv[1:] if not a.startswith('--')] or None
+	print(get_ip_world(offline = '--offline' in sys.argv, servers = _servers), LAST_DISCOVERY)
 	print(get_ip_local())
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 '''
 	JUST LIST CONTENT OF *.db
+	see ExportDB.py for NDJSON/CSV export
 '''
 
 import sys
@@ -11,5 +12,6 @@ import sqlite3
 db = sqlite3.connect(sys.argv[1])
 c = db.cursor()
 c.execute('SELECT * FROM connections')
-for r in c.fetchall():
+# iterate cursor, do not load whole table
+for r in c:
 	print(r)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+'''
+	recompute aggregate tables of *.db
+	(migrates DB to current schema first)
+
+	./rebuild_aggregates.py ./SpyserverConnections.db
+'''
+
+import sys
+import time
+from pprint import pprint
+
+from ConnectionsDB import ConnectionsDB
+
+db = ConnectionsDB(sys.argv[1])
+_t = time.time()
+db.RebuildAggregates()
+print("Aggregates rebuilt in ", time.time() - _t, 's')
+pprint( db.GetConnectionStats() )
+db.Close()
@@ -1,11 +1,66 @@
 #!/usr/bin/env python3
 
+'''
+	spyserver mockup and load generator
+
+	./spyserver_stub.py <config> [key=value ...]
+
+	Started like spyserver (SPYSERVER/exe = ./spyserver_stub.py), so parameters are read
+	from stub_* lines of the config file, command line key=value pairs override them.
+	Without stub_mode it prints one open, waits 5 seconds and prints close.
+
+	stub_mode = synthetic
+		stub_rate = 10              - new clients per second (Poisson arrivals)
+		stub_clients = 100          - max concurrent clients, arrivals wait when reached
+		stub_duration = 30          - mean session duration in seconds (exponential)
+		stub_duration_max = 600
+		stub_ips = 1000             - distinct client IPs
+		stub_ip_skew = 1.1          - Zipf exponent of IP popularity, 0 - uniform
+		stub_noise = 50             - RTL noise lines per second
+		stub_sessions = 0           - stop after this many sessions, 0 - run forever
+		stub_seed = 1
+
+	stub_mode = replay
+		stub_replay = monitor.log.jsonl - Logger JSON lines (debug level) or plain spyserver output
+		stub_replay_source =        - only records of this source (spyserver config) from JSON log
+		stub_speed = 10             - time compression, 10 - ten times faster than recorded
+		stub_rate = 100             - lines per second for plain logs without timestamps
+
+	stub_trace = <file>             - append "<time> <open|close> <ip> <port>" for every emitted
+	                                  connect / disconnect, used by bench_ingest.py to measure latency
+'''
+
+import os
 import sys
 import time
+import json
+import heapq
+import bisect
+import random
+import itertools
+
+
+DEFAULTS = {
+	'stub_mode': 'once',
+	'stub_rate': '10',
+	'stub_clients': '100',
+	'stub_duration': '30',
+	'stub_duration_max': '600',
+	'stub_ips': '1000',
+	'stub_ip_skew': '1.1',
+	'stub_noise': '50',
+	'stub_sessions': '0',
+	'stub_seed': '1',
+	'stub_replay': '',
+	'stub_replay_source': '',
+	'stub_speed': '10',
+	'stub_trace': '',
+}
+
+NOISE = ['[R82XX] PLL not locked!', 'Found Rafael Micro R820T tuner']
+SDR_VERSIONS = ['1700.0.0.1', '1732.0.0.0', '1784.0.0.0']
+OS_NAMES = ['Windows', 'Windows', 'Windows', 'Linux']
 
-'''
-	spyserver mockup
-'''
 
 def TestOpen(i_pause = None):
 	print('Accepted client 100.200.30.40:5678 running SDR# 1700.0.0.1 on Windows')
@@ -13,11 +68,186 @@ def TestOpen(i_pause = None):
 def TestClose():
 	print('Client disconnected: 100.200.30.40:5678')
 
+
+def LoadParams(argv):
+	'''
+	stub_* settings from spyserver config file (key = value lines) and key=value arguments
+	'''
+	params = dict(DEFAULTS)
+	if len(argv) > 1 and os.path.isfile(argv[1]):
+		with open(argv[1]) as f:
+			for line in f:
+				if '=' in line and line.strip().startswith('stub_'):
+					k, v = line.split('=', 1)
+					params[k.strip()] = v.split('#')[0].strip()
+	for a in argv[2:]:
+		if '=' in a:
+			k, v = a.split('=', 1)
+			params[k.strip()] = v.strip()
+	return params
+
+
+class Output():
+	'''
+	stdout lines, flushed, with optional trace of connect / disconnect times
+	'''
+	def __init__(self, trace_file = None):
+		self.__trace = open(trace_file, 'a') if trace_file else None
+
+	def Line(self, line):
+		sys.stdout.write(line + '\n')
+		sys.stdout.flush()
+
+	def Open(self, ip, port, version, os_name):
+		self.Line('Accepted client {}:{} running SDR# {} on {}'.format(ip, port, version, os_name))
+		self.Trace('open', ip, port)
+
+	def Close(self, ip, port):
+		self.Line('Client disconnected: {}:{}'.format(ip, port))
+		self.Trace('close', ip, port)
+
+	def Trace(self, kind, ip, port):
+		if self.__trace:
+			self.__trace.write('{:.6f} {} {} {}\n'.format(time.time(), kind, ip, port))
+			self.__trace.flush()
+
+
+def PublicIps(n, rnd):
+	'''
+	n distinct IPs outside private / special ranges
+	'''
+	first = [o for o in range(1, 224) if o not in (10, 100, 127, 169, 172, 192)]
+	ips = set()
+	while len(ips) < n:
+		ips.add( '{}.{}.{}.{}'.format(rnd.choice(first), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)) )
+	return sorted(ips)
+
+
+def Synthetic(p, out):
+	rnd = random.Random(int(p['stub_seed']))
+	rate = float(p['stub_rate'])
+	max_clients = int(p['stub_clients'])
+	mean_duration = float(p['stub_duration'])
+	max_duration = float(p['stub_duration_max'])
+	noise = float(p['stub_noise'])
+	sessions = int(p['stub_sessions'])
+
+	ips = PublicIps(int(p['stub_ips']), rnd)
+	skew = float(p['stub_ip_skew'])
+	cum = list( itertools.accumulate( 1.0 / (i + 1) ** skew for i in range(len(ips)) ) )
+
+	ports = itertools.count()
+	active = {} # (ip, port) -> True
+	started = 0
+	now = time.time()
+	queue = [] # (time, seq, action, data)
+	seq = itertools.count()
+	heapq.heappush(queue, (now + rnd.expovariate(rate), next(seq), 'arrival', None))
+	if noise > 0:
+		heapq.heappush(queue, (now + rnd.expovariate(noise), next(seq), 'noise', None))
+
+	while queue:
+		t, _, action, data = heapq.heappop(queue)
+		delay = t - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+		if action == 'arrival':
+			if sessions and started >= sessions:
+				continue
+			if len(active) < max_clients:
+				ip = ips[ bisect.bisect_left(cum, rnd.random() * cum[-1]) ]
+				port = 1024 + next(ports) % 64000
+				while (ip, port) in active:
+					port = 1024 + next(ports) % 64000
+				active[(ip, port)] = True
+				started += 1
+				out.Open(ip, port, rnd.choice(SDR_VERSIONS), rnd.choice(OS_NAMES))
+				duration = min(rnd.expovariate(1.0 / mean_duration), max_duration)
+				heapq.heappush(queue, (t + duration, next(seq), 'close', (ip, port)))
+			if not sessions or started < sessions:
+				heapq.heappush(queue, (t + rnd.expovariate(rate), next(seq), 'arrival', None))
+		elif action == 'close':
+			del active[data]
+			out.Close(*data)
+		elif action == 'noise':
+			out.Line(rnd.choice(NOISE))
+			# noise runs as long as there are clients to come or connected
+			if not sessions or started < sessions or active:
+				heapq.heappush(queue, (t + rnd.expovariate(noise), next(seq), 'noise', None))
+
+
+def ReplayRecords(p):
+	'''
+	yield (timestamp or None, line) from recorded log
+	'''
+	source = p['stub_replay_source']
+	with open(p['stub_replay']) as f:
+		for line in f:
+			line = line.rstrip('\n')
+			if line.startswith('{'):
+				try:
+					rec = json.loads(line)
+				except ValueError:
+					continue
+				if source and rec.get('source') != source:
+					continue
+				ts = rec.get('ts', '')
+				try:
+					t = time.mktime( time.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S') ) + float('0' + ts[19:-1])
+				except ValueError:
+					t = None
+				yield t, rec.get('msg', '')
+			else:
+				yield None, line
+
+
+def Replay(p, out):
+	speed = float(p['stub_speed'])
+	interval = 1.0 / float(p['stub_rate'])
+	first = None
+	start = time.time()
+	n = 0
+	for t, line in ReplayRecords(p):
+		n += 1
+		if t is not None:
+			if first is None:
+				first = t
+			due = start + (t - first) / speed
+		else:
+			due = start + n * interval
+		delay = due - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+		parts = line.split()
+		if line.startswith('Accepted client ') and len(parts) > 2 and ':' in parts[2]:
+			ip, port = parts[2].rsplit(':', 1)
+			out.Line(line)
+			out.Trace('open', ip, port)
+		elif line.startswith('Client disconnected: ') and len(parts) > 2 and ':' in parts[2]:
+			ip, port = parts[2].rsplit(':', 1)
+			out.Line(line)
+			out.Trace('close', ip, port)
+		else:
+			out.Line(line)
+
+
 if __name__ == "__main__":
-	pause = 5 # int(sys.argv[1])
+	p = LoadParams(sys.argv)
+	out = Output(p['stub_trace'] or None)
+	try:
+		if p['stub_mode'] == 'synthetic':
+			Synthetic(p, out)
+		elif p['stub_mode'] == 'replay':
+			Replay(p, out)
+		else:
+			pause = 5 # int(sys.argv[1])
 
-	TestOpen(pause)
+			TestOpen(pause)
 
-	if pause:
-		time.sleep(pause)
-	TestClose()
\ No newline at end of file
+			if pause:
+				time.sleep(pause)
+			TestClose()
+	except KeyboardInterrupt:
+		pass